@@ -0,0 +1,98 @@
+# Compiled cache for codelists read from CSV
+# Parsing the codelist CSVs (term columns included) is most of the cost of
+# importing codelists.py. Each codelist's codes, and categories where present,
+# are stored in a small binary file keyed by a SHA of the source CSV,
+# codelists/codelists.json and the arguments used to read it, so the CSV is
+# only parsed again after it (or the codelist manifest) changes.
+# The cache is off unless CODELIST_CACHE_DIR names a directory for it (for
+# local development; nothing is written to the workspace of a job run on
+# the backend). If the cache directory cannot be written the codelists are
+# read from CSV as before.
+
+import functools
+import hashlib
+import marshal
+import os
+
+from cohortextractor import codelist, codelist_from_csv
+
+CACHE_DIR = os.environ.get("CODELIST_CACHE_DIR")
+MANIFEST = "codelists/codelists.json"
+# Bump when the layout of the cache files changes
+CACHE_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def manifest_sha():
+    try:
+        with open(MANIFEST, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def cache_key(source, system, column, category_column):
+    key = hashlib.sha1(source)
+    key.update(
+        repr(
+            (CACHE_VERSION, manifest_sha(), system, column, category_column)
+        ).encode()
+    )
+    return key.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.bin")
+
+
+def read_cache(path):
+    # Returns (codes, categories) or None if there is no usable cache file
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(path, codes, categories):
+    # Written to a temporary file first so concurrent runs never read a
+    # partial cache file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            marshal.dump((codes, categories), f)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached_codelist_from_csv(filename, system, column="code", category_column=None):
+    # Drop-in replacement for cohortextractor's codelist_from_csv
+    if not CACHE_DIR:
+        return codelist_from_csv(
+            filename, system, column=column, category_column=category_column
+        )
+    with open(filename, "rb") as f:
+        source = f.read()
+    path = cache_path(cache_key(source, system, column, category_column))
+    cached = read_cache(path)
+    if cached is not None:
+        codes, categories = cached
+        if categories is None:
+            return codelist(codes, system)
+        # Categories were checked for consistency when the cache was written
+        return codelist(list(zip(codes, categories)), system, check_categories=False)
+
+    parsed = codelist_from_csv(
+        filename, system, column=column, category_column=category_column
+    )
+    if parsed.has_categories:
+        codes = [code for code, _ in parsed]
+        categories = [category for _, category in parsed]
+    else:
+        codes = list(parsed)
+        categories = None
+    write_cache(path, codes, categories)
+    return parsed
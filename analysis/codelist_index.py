@@ -0,0 +1,115 @@
+# Array index for codelist membership tests
+# Codelist matching is the inner loop of every with_these_clinical_events /
+# with_these_medications variable. Instead of comparing strings, a codelist
+# is held as a sorted array: SNOMED CT (and dm+d) codes as int64, other
+# systems such as CTV3 as fixed-width bytes. A column of event codes is
+# encoded once (see `encode_codes`) as its distinct codes, in the same form,
+# plus the position of each event's code among them; every codelist is then
+# matched with one searchsorted over the distinct codes and a take. The
+# index of a codelist is built once and reused by every later lookup of a
+# codelist with the same codes (see `CodelistIndex.from_codelist`).
+
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Systems whose codes are numeric identifiers
+INTEGER_SYSTEMS = ("snomed", "dmd")
+
+# Encoded value for codes that cannot be in an integer codelist
+NO_CODE = -1
+
+# Up to 18 digits always fits in int64; SNOMED CT identifiers never have a
+# leading zero
+INTEGER_CODE_REGEX = r"[1-9][0-9]{0,17}"
+
+
+def is_integer_system(system):
+    return system in INTEGER_SYSTEMS
+
+
+def encode_values(values, system):
+    # Encodes distinct code strings as int64 (integer systems, NO_CODE for
+    # invalid codes) or fixed-width bytes
+    values = pd.Series(values, dtype=object).fillna("").astype(str)
+    if not is_integer_system(system):
+        # UTF-8, as numpy's bytes dtype only accepts ASCII strings
+        return values.str.encode("utf-8").to_numpy().astype("S")
+    encoded = np.full(len(values), NO_CODE, dtype="int64")
+    valid = values.str.fullmatch(INTEGER_CODE_REGEX).to_numpy()
+    encoded[valid] = values[valid].astype("int64").to_numpy()
+    return encoded
+
+
+class EncodedCodes:
+    # A column of codes as its encoded distinct codes (`uniques`) and the
+    # position of each row's code in `uniques` (`inverse`)
+
+    def __init__(self, uniques, inverse):
+        self.uniques = uniques
+        self.inverse = inverse
+
+    def __len__(self):
+        return len(self.inverse)
+
+
+def encode_codes(codes, system):
+    inverse, uniques = pd.factorize(pd.Series(codes, dtype=object).fillna(""))
+    return EncodedCodes(encode_values(uniques, system), inverse)
+
+
+class CodelistIndex:
+    # Sorted, de-duplicated codes of a codelist, with the category of each
+    # code if the codelist has categories
+
+    def __init__(self, codes, system, categories=None):
+        self.system = system
+        encoded = encode_values(codes, system)
+        if is_integer_system(system) and (encoded == NO_CODE).any():
+            raise ValueError(f"Codelist has codes that are not valid {system} codes")
+        self.codes, first = np.unique(encoded, return_index=True)
+        self.categories = None
+        if categories is not None:
+            self.categories = np.asarray(categories, dtype=object)[first]
+
+    @classmethod
+    def from_codelist(cls, codelist):
+        # Memoised by content rather than identity, since StudyDefinition
+        # copies the codelists of its variables; the index is not modified
+        has_categories = getattr(codelist, "has_categories", False)
+        return codelist_index(cls, tuple(codelist), codelist.system, has_categories)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, codes):
+        return encode_codes(codes, self.system)
+
+    def searchsorted(self, values):
+        # Position of each encoded value in the index, and whether it is there
+        if len(self.codes) == 0:
+            return np.zeros(len(values), dtype="int64"), np.zeros(len(values), dtype=bool)
+        positions = np.searchsorted(self.codes, values)
+        positions = np.minimum(positions, len(self.codes) - 1)
+        return positions, self.codes[positions] == values
+
+    def isin(self, encoded):
+        # Membership of each row of an encoded column (see `encode`)
+        return self.searchsorted(encoded.uniques)[1][encoded.inverse]
+
+    def category(self, encoded):
+        # Category of each row of an encoded column, "" if not in the codelist
+        positions, found = self.searchsorted(encoded.uniques)
+        values = np.full(len(encoded.uniques), "", dtype=object)
+        values[found] = self.categories[positions[found]]
+        return values[encoded.inverse]
+
+
+@functools.lru_cache(maxsize=256)
+def codelist_index(cls, items, system, has_categories):
+    if has_categories:
+        codes = [code for code, _ in items]
+        categories = [category for _, category in items]
+        return cls(codes, system, categories)
+    return cls(list(items), system)
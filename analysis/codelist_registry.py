@@ -0,0 +1,82 @@
+# Lazy loading of the codelists defined in codelists.py
+# Codelists are defined as deferred values and only read (through the
+# compiled cache, see codelist_cache.py) when the attribute is first accessed,
+# so importing codelists.py for one variable group does not load the others.
+# The registry records which codelists have been touched, and which of them
+# a study definition uses (see used_by). StudyDefinition copies the codelists
+# it is given, so a study's codelists are matched to the registry's by their
+# codes; codelists built with combine are matched to the codelists combined.
+
+
+def codelist_key(value):
+    return (value.system, tuple(value))
+
+
+class DeferredCodelist:
+    # A codelist that is built by calling `build(*args, **kwargs)` on first use
+
+    def __init__(self, build, *args, **kwargs):
+        self.build = build
+        self.args = args
+        self.kwargs = kwargs
+
+    def load(self):
+        return self.build(*self.args, **self.kwargs)
+
+
+class CodelistRegistry:
+    # Takes the deferred codelists out of a module namespace and resolves them
+    # on first attribute access (use `__getattr__ = registry.resolve` in the
+    # module)
+
+    def __init__(self, module_name, namespace):
+        self.module_name = module_name
+        self.namespace = namespace
+        self.deferred = {
+            name: value
+            for name, value in namespace.items()
+            if isinstance(value, DeferredCodelist)
+        }
+        for name in self.deferred:
+            del namespace[name]
+        # Loaded codelists by name, in order of first access
+        self.touched = {}
+        # Names of the codelists each loaded or combined codelist is made of,
+        # by codelist_key
+        self.sources = {}
+
+    def names(self):
+        return list(self.deferred)
+
+    def resolve(self, name):
+        if name not in self.deferred:
+            raise AttributeError(
+                f"module '{self.module_name}' has no attribute '{name}'"
+            )
+        value = self.deferred[name].load()
+        self.touched[name] = value
+        self.sources.setdefault(codelist_key(value), set()).add(name)
+        # Later lookups find the loaded codelist directly
+        self.namespace[name] = value
+        return value
+
+    def dir(self):
+        return sorted(set(self.namespace) | set(self.deferred))
+
+    def combine(self, combine_codelists, *codelists):
+        # combine_codelists(*codelists), recording the codelists combined
+        value = combine_codelists(*codelists)
+        names = self.sources.setdefault(codelist_key(value), set())
+        for codelist in codelists:
+            names.update(self.sources.get(codelist_key(codelist), ()))
+        return value
+
+    def used_by(self, covariate_definitions):
+        # Names of the loaded codelists that the covariates use, directly or
+        # combined, in order of first access
+        used = set()
+        for _, query_args in covariate_definitions.values():
+            for value in query_args.values():
+                if isinstance(value, list) and hasattr(value, "system"):
+                    used.update(self.sources.get(codelist_key(value), ()))
+        return [name for name in self.touched if name in used]
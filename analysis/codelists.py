@@ -9,10 +9,26 @@
 
 # --- IMPORT STATEMENTS ---
 # Import code building blocks from cohort extractor package
-from cohortextractor import (
-    codelist,
-    codelist_from_csv,
-)
+from cohortextractor import codelist as build_codelist
+from cohortextractor import combine_codelists as build_combined_codelist
+
+# Read codelist CSVs through the compiled cache (see codelist_cache.py)
+from codelist_cache import cached_codelist_from_csv
+
+# Codelists are loaded on first access (see codelist_registry.py)
+from codelist_registry import CodelistRegistry, DeferredCodelist
+
+
+def codelist(codes, system, **kwargs):
+    return DeferredCodelist(build_codelist, codes, system, **kwargs)
+
+
+def codelist_from_csv(filename, system, **kwargs):
+    return DeferredCodelist(cached_codelist_from_csv, filename, system, **kwargs)
+
+
+def combine_codelists(*codelists):
+    return registry.combine(build_combined_codelist, *codelists)
 
 # --- CODELISTS ---
 
@@ -273,3 +289,18 @@ covid_primary_care_sequalae = codelist_from_csv(
     system = "ctv3",
     column = "CTV3ID",
 )
+
+
+# --- LAZY LOADING ---
+# The codelists above are read on first access; `registry.touched` records
+# the ones that have been used, and `registry.used_by(covariate_definitions)`
+# the ones a study definition uses (see study_factory.study_codelists)
+registry = CodelistRegistry(__name__, globals())
+
+
+def __getattr__(name):
+    return registry.resolve(name)
+
+
+def __dir__():
+    return registry.dir()
@@ -5,7 +5,6 @@
 
 from cohortextractor import (
     patients,
-    combine_codelists,
 )
 
 import codelists
@@ -157,7 +156,7 @@ comorbidity_variables = dict(
     ),
     # variable indicating whether patient has had a recent test yes/no
     hba1c_flag=patients.with_these_clinical_events(
-        combine_codelists(
+        codelists.combine_codelists(
             codelists.hba1c_new_codes,
             codelists.hba1c_old_codes
         ),
@@ -251,7 +250,7 @@ comorbidity_variables = dict(
     
     # Cancer
     cancer=patients.with_these_clinical_events(
-        combine_codelists(
+        codelists.combine_codelists(
             codelists.lung_cancer_codes,
             codelists.other_cancer_codes
         ),
@@ -378,7 +377,7 @@ comorbidity_variables = dict(
     
     # Asplenia (splenectomy or a spleen dysfunction, including sickle cell disease)
     asplenia=patients.with_these_clinical_events(
-        combine_codelists(
+        codelists.combine_codelists(
             codelists.sickle_cell_codes,
             codelists.spleen_codes
          ),  # imported from codelists.py
@@ -296,13 +296,13 @@ demographic_variables = dict(
         return_expectations={
             "rate": "universal",
             "category": {
+                # IMD ranks (rounded to 100) in the middle of each quintile
                 "ratios": {
-                    "0": 0,
-                    "1": 0.2,
-                    "2": 0.2,
-                    "3": 0.2,
-                    "4": 0.2,
-                    "5": 0.2,
+                    "3300": 0.2,
+                    "9800": 0.2,
+                    "16400": 0.2,
+                    "23000": 0.2,
+                    "29500": 0.2,
                 }
             },
         },
@@ -2,306 +2,92 @@
 
 from cohortextractor import (
     patients,
-    combine_codelists,
 )
 
 import codelists
 
-era_exposure_variables = dict(
-
+# Variant eras (name, start date, end date); eras must not overlap
+# Every era has a positive test, hospitalisation and A&E variable
+# (<era>_positive_test_date, <era>_hospitalisation_date, <era>_emergency_date),
+# WT also has primary care case identification (wt_primary_care_date).
+# Adding an era here adds its variables; the local extraction layer reads
+# each source once for all eras (see extraction/planner.py)
+eras = [
     # WT
-    # Positive test
-    wt_positive_test_date = patients.with_test_result_in_sgss(
-        pathogen = "SARS-CoV-2",
-        test_result = "positive",
-        returning = "date",
-        date_format = "YYYY-MM-DD",
-        between=["2020-03-23","2020-09-06"],
-        find_last_match_in_period=True,
-        restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2020-03-23", "latest": "2020-09-06"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-  
-    # Case identification
-    wt_primary_care_date = patients.with_these_clinical_events(
-        combine_codelists(
-            codelists.covid_primary_care_code,
-            codelists.covid_primary_care_positive_test,
-            codelists.covid_primary_care_sequalae,
-        ),
-        returning="date",
-        date_format="YYYY-MM-DD",
-        between=["2020-03-23","2020-09-06"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2020-03-23", "latest": "2020-09-06"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
-    # Hospitalisation
-    wt_hospitalisation_date = patients.admitted_to_hospital(
-        with_these_diagnoses = codelists.covid_icd10,
-        with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
-        returning = "date_admitted",
-        date_format="YYYY-MM-DD",
-        between=["2020-03-23","2020-09-06"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2020-03-23", "latest": "2020-09-06"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
-    # A&E
-    wt_emergency_date = patients.attended_emergency_care(
-        with_these_diagnoses = codelists.covid_emergency,
-        returning="date_arrived",
-        date_format="YYYY-MM-DD",
-        between=["2020-03-23","2020-09-06"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2020-03-23", "latest": "2020-09-06"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
+    ("wt", "2020-03-23", "2020-09-06"),
     # ALPHA
-    # Positive test
-    alpha_positive_test_date = patients.with_test_result_in_sgss(
-        pathogen = "SARS-CoV-2",
-        test_result = "positive",
-        returning = "date",
-        date_format = "YYYY-MM-DD",
-        between=["2020-09-07","2021-05-27"],
-        find_last_match_in_period=True,
-        restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2020-09-07", "latest": "2021-05-27"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
-    # Hospitalisation
-    alpha_hospitalisation_date = patients.admitted_to_hospital(
-        with_these_diagnoses = codelists.covid_icd10,
-        with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
-        returning = "date_admitted",
-        date_format="YYYY-MM-DD",
-        between=["2020-09-07","2021-05-27"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2020-09-07", "latest": "2021-05-27"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
-    # A&E
-    alpha_emergency_date = patients.attended_emergency_care(
-        with_these_diagnoses = codelists.covid_emergency,
-        returning="date_arrived",
-        date_format="YYYY-MM-DD",
-        between=["2020-09-07","2021-05-27"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2020-09-07", "latest": "2021-05-27"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
+    ("alpha", "2020-09-07", "2021-05-27"),
     # DELTA
-    # Positive test
-    delta_positive_test_date = patients.with_test_result_in_sgss(
-        pathogen = "SARS-CoV-2",
-        test_result = "positive",
-        returning = "date",
-        date_format = "YYYY-MM-DD",
-        between=["2021-05-28","2021-12-14"],
-        find_last_match_in_period=True,
-        restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2021-05-28", "latest": "2021-12-14"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
-    # Hospitalisation
-    delta_hospitalisation_date = patients.admitted_to_hospital(
-        with_these_diagnoses = codelists.covid_icd10,
-        with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
-        returning = "date_admitted",
-        date_format="YYYY-MM-DD",
-        between=["2021-05-28","2021-12-14"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2021-05-28", "latest": "2021-12-14"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
-    # A&E
-    delta_emergency_date = patients.attended_emergency_care(
-        with_these_diagnoses = codelists.covid_emergency,
-        returning="date_arrived",
-        date_format="YYYY-MM-DD",
-        between=["2021-05-28","2021-12-14"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2021-05-28", "latest": "2021-12-14"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-   
+    ("delta", "2021-05-28", "2021-12-14"),
     # EARLY OMICRON (BA.1, BA.2) # BA.1 dominant from 15-Dec-2021, BA.5 dominant from 06-Jun-2022
-    # Positive test
-    BA1_2_omicron_positive_test_date = patients.with_test_result_in_sgss(
-        pathogen = "SARS-CoV-2",
-        test_result = "positive",
-        returning = "date",
-        date_format = "YYYY-MM-DD",
-        between=["2021-12-15","2022-06-05"],
-        find_last_match_in_period=True,
-        restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2021-12-15", "latest": "2022-06-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
-    # Hospitalisation
-    BA1_2_omicron_hospitalisation_date = patients.admitted_to_hospital(
-        with_these_diagnoses = codelists.covid_icd10,
-        with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
-        returning = "date_admitted",
-        date_format="YYYY-MM-DD",
-        between=["2021-12-15","2022-06-05"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2021-12-15", "latest": "2022-06-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
-    # A&E
-    BA1_2_omicron_emergency_date = patients.attended_emergency_care(
-        with_these_diagnoses = codelists.covid_emergency,
-        returning="date_arrived",
-        date_format="YYYY-MM-DD",
-        between=["2021-12-15","2022-06-05"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2021-12-15", "latest": "2022-06-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
+    ("BA1_2_omicron", "2021-12-15", "2022-06-05"),
     # MID OMICRON (BA.5)  # BA.5 dominant from 06-Jun-2022, XBB dominant from 06-Feb-2023
-    # Positive test
-    BA5_omicron_positive_test_date = patients.with_test_result_in_sgss(
-        pathogen = "SARS-CoV-2",
-        test_result = "positive",
-        returning = "date",
-        date_format = "YYYY-MM-DD",
-        between=["2022-06-06","2023-02-05"],
-        find_last_match_in_period=True,
-        restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2022-06-06", "latest": "2023-02-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
-    # Hospitalisation
-    BA5_omicron_hospitalisation_date = patients.admitted_to_hospital(
-        with_these_diagnoses = codelists.covid_icd10,
-        with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
-        returning = "date_admitted",
-        date_format="YYYY-MM-DD",
-        between=["2022-06-06","2023-02-05"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2022-06-06", "latest": "2023-02-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
-    # A&E
-    BA5_omicron_emergency_date = patients.attended_emergency_care(
-        with_these_diagnoses = codelists.covid_emergency,
-        returning="date_arrived",
-        date_format="YYYY-MM-DD",
-        between=["2022-06-06","2023-02-05"],
-        find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2022-06-06", "latest": "2023-02-05"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-
+    ("BA5_omicron", "2022-06-06", "2023-02-05"),
     # LATE OMICRON (XBB) # XBB dominant from 06-Feb-2023, JN.1 dominant from 04-Dec-2023
+    ("XBB_omicron", "2023-02-06", "2023-12-03"),
+]
+
+
+def era_variables(era, start_date, end_date):
+    # need both earliest/latest to obtain expected incidence
+    return_expectations = {
+        "date": {"earliest": start_date, "latest": end_date},
+        "rate": "uniform",
+        "incidence": 0.02,
+    }
+    variables = {}
+
     # Positive test
-    XBB_omicron_positive_test_date = patients.with_test_result_in_sgss(
+    variables[f"{era}_positive_test_date"] = patients.with_test_result_in_sgss(
         pathogen = "SARS-CoV-2",
         test_result = "positive",
         returning = "date",
         date_format = "YYYY-MM-DD",
-        between=["2023-02-06","2023-12-03"],
+        between=[start_date, end_date],
         find_last_match_in_period=True,
         restrict_to_earliest_specimen_date=False,
-        return_expectations = {
-            "date": {"earliest": "2023-02-06", "latest": "2023-12-03"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-      
+        return_expectations = return_expectations,
+    )
+
+    # Case identification
+    if era == "wt":
+        variables[f"{era}_primary_care_date"] = patients.with_these_clinical_events(
+            codelists.combine_codelists(
+                codelists.covid_primary_care_code,
+                codelists.covid_primary_care_positive_test,
+                codelists.covid_primary_care_sequalae,
+            ),
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=[start_date, end_date],
+            find_last_match_in_period=True,
+            return_expectations = return_expectations,
+        )
+
     # Hospitalisation
-    XBB_omicron_hospitalisation_date = patients.admitted_to_hospital(
+    variables[f"{era}_hospitalisation_date"] = patients.admitted_to_hospital(
         with_these_diagnoses = codelists.covid_icd10,
         with_admission_method = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
         returning = "date_admitted",
         date_format="YYYY-MM-DD",
-        between=["2023-02-06","2023-12-03"],
+        between=[start_date, end_date],
         find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2023-02-06", "latest": "2023-12-03"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
-    
+        return_expectations = return_expectations,
+    )
+
     # A&E
-    XBB_omicron_emergency_date = patients.attended_emergency_care(
+    variables[f"{era}_emergency_date"] = patients.attended_emergency_care(
         with_these_diagnoses = codelists.covid_emergency,
         returning="date_arrived",
         date_format="YYYY-MM-DD",
-        between=["2023-02-06","2023-12-03"],
+        between=[start_date, end_date],
         find_last_match_in_period=True,
-        return_expectations = {
-            "date": {"earliest": "2023-02-06", "latest": "2023-12-03"}, # need both earliest/latest to obtain expected incidence
-            "rate": "uniform",
-            "incidence": 0.02,
-            },
-    ),
+        return_expectations = return_expectations,
+    )
 
+    return variables
 
-)
+
+era_exposure_variables = {}
+for era, start_date, end_date in eras:
+    era_exposure_variables.update(era_variables(era, start_date, end_date))
@@ -0,0 +1,91 @@
+# Define immunosuppression variables needed accross waves
+# (population subgroups; none of these depend on the wave dates)
+
+from cohortextractor import (
+    patients,
+)
+
+import codelists
+
+immunosuppression_variables = dict(
+
+    # Bone marrow transplant
+    bone_marrow_transplant=patients.with_these_clinical_events(
+        codelists.bone_marrow_transplant_codes,  # imported from codelists.py
+        returning="binary_flag",
+        on_or_before="index_date",
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: bone_marrow_transplant_date
+        date_format="YYYY-MM-DD",
+    ),
+    
+    # Kidney transplant
+    kidney_transplant=patients.with_these_clinical_events(
+        codelists.kidney_transplant_codes,  # imported from codelists.py
+        returning="binary_flag",
+        on_or_before="index_date",
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: kidney_transplant_date
+        date_format="YYYY-MM-DD",
+    ),
+
+    # Other solid organ transplant
+    other_organ_transplant=patients.with_these_clinical_events(
+        codelists.other_organ_transplant_codes,  # imported from codelists.py
+        returning="binary_flag",
+        on_or_before="index_date",
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: other_organ_transplant_date
+        date_format="YYYY-MM-DD",
+    ),
+  
+    # Haematological malignancy (binary and date of last match)
+    haem_cancer=patients.with_these_clinical_events(
+        codelists.haem_cancer_codes,  # imported from codelists.py
+        returning="binary_flag",
+        on_or_before="index_date",
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: haem_cancer_date
+        date_format="YYYY-MM-DD",
+    ),
+  
+    # Immunosuppression diagnosis
+    immunosuppression_diagnosis = patients.with_these_clinical_events(
+        codelists.immunosupression_diagnosis_codes,
+        returning="binary_flag",
+        on_or_before="index_date",
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: immunosuppression_diagnosis_date
+        date_format="YYYY-MM-DD",
+    ),
+    
+    # Immunosuppression medication
+    immunosuppression_medication = patients.with_these_medications(
+        codelists.immunosuppression_medication_codes,
+        returning="binary_flag",
+        between=["index_date - 182 days", "index_date"],
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: immunosuppression_medication_date
+        date_format="YYYY-MM-DD",
+    ),
+    
+    # Immunosuppression admin code
+    immunosuppression_admin = patients.with_these_clinical_events(
+        codelists.immunosuppression_admin_codes,
+        returning="binary_flag",
+        between=["index_date - 182 days", "index_date"],
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: immunosuppression_admin_date
+        date_format="YYYY-MM-DD",
+    ),
+    
+    # Radiotherapy/chemotherapy
+    radio_chemo = patients.with_these_clinical_events(
+        codelists.radio_chemo_codes,
+        returning="binary_flag",
+        between=["index_date - 182 days", "index_date"],
+        find_last_match_in_period=True,
+        include_date_of_match=True, # variable: radio_chemo_date
+        date_format="YYYY-MM-DD",
+    ),
+)
@@ -0,0 +1,220 @@
+######################################
+
+# This script extracts the cohorts for all waves in config.json in one run.
+# Each source table is scanned once and shared by every wave, instead of
+# running a separate generate_cohort action per wave, and the era exposures
+# are extracted once for all waves (input_era).
+# It runs the local extraction engine (analysis/extraction) against local
+# copies of the source tables, for development and benchmarking only: it is
+# not part of project.yaml, and on the OpenSAFELY backend each wave is still
+# extracted by its own generate_study_population_* (generate_cohort) action.
+# Usage (see --help for the options):
+#   python analysis/extract_multiwave.py [options] <input_source> [output_dir] [waves...]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import argparse
+import json
+import sys
+
+from extraction.multiwave import (
+    extract_waves,
+    load_era_study,
+    load_series_studies,
+    load_wave_studies,
+    wave_keys,
+)
+from extraction.output import OUTPUT_FORMATS
+from extraction.profile import format_summary, profile_path, read_profile
+from extraction.shards import extract_sharded
+from extraction.streaming import extract_streamed
+from extraction.tables import open_source
+
+# Import config variables (start_date and end_date of waves)
+with open("analysis/config.json", "r") as f:
+    config = json.load(f)
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description="Extract the cohorts of every wave with one scan of each source table.",
+    allow_abbrev=False,
+)
+parser.add_argument(
+    "input_source",
+    help="a directory of Parquet files, or a SQLite (.sqlite, .sqlite3, .db) or "
+    "DuckDB (.duckdb) database file (see analysis/extraction/tables.py)",
+)
+parser.add_argument(
+    "output_dir", nargs="?", default="output", help="output unless given"
+)
+parser.add_argument(
+    "waves", nargs="*", help="waves of config.json to extract (all unless given)"
+)
+parser.add_argument(
+    "--output-format",
+    choices=OUTPUT_FORMATS,
+    default="feather",
+    help="feather (typed Arrow IPC, as the generate_study_population_* actions "
+    "write) unless given",
+)
+parser.add_argument(
+    "--cache-dir",
+    help="cache each variable's result, so that a rerun only evaluates the "
+    "variables whose definition or source data has changed (and those that "
+    "refer to them); the least recently used entries are removed above 2 GB",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="threads evaluating covariates that do not refer to each other",
+)
+parser.add_argument(
+    "--population-pushdown",
+    action="store_true",
+    help="evaluate each population first, and the other variables only for its "
+    "patients",
+)
+parser.add_argument(
+    "--connections",
+    type=int,
+    default=1,
+    help="source tables scanned concurrently, each over its own connection",
+)
+parser.add_argument(
+    "--query-timeout",
+    type=float,
+    metavar="SECONDS",
+    help="fail the extraction when a scan runs longer than this (a Parquet scan "
+    "is stopped between record batches)",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="split the patients into this many contiguous patient_id ranges, "
+    "extracted in parallel and merged (see analysis/extraction/shards.py)",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    help="processes extracting the shards (one per shard, up to the number of "
+    "CPUs, unless given)",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    metavar="PATIENTS",
+    help="scan, evaluate and write the patients a batch at a time (within each "
+    "shard with --shards; see analysis/extraction/streaming.py)",
+)
+parser.add_argument(
+    "--max-rss-mb",
+    type=float,
+    metavar="MB",
+    help="extract in batches (of 100000 patients unless --batch-size is given), "
+    "made smaller while the resident set size is above this; the extraction "
+    "fails if it stays above it",
+)
+parser.add_argument(
+    "--compression-threads",
+    type=int,
+    help="compress csv.gz output on this many threads as independent gzip "
+    "blocks, with an index of the blocks in <output>.index.csv (see "
+    "analysis/extraction/blocks.py)",
+)
+parser.add_argument(
+    "--series-start",
+    metavar="DATE",
+    help="extract a calendar series of cohorts (input_series_<index date>) "
+    "instead of the waves: the wave variables at every index date from this "
+    "date to --series-end, each followed up until the next; the era exposures "
+    "are not extracted",
+)
+parser.add_argument("--series-end", metavar="DATE")
+parser.add_argument(
+    "--series-step",
+    default="1 month",
+    help='days, weeks, months or years between index dates ("1 month" unless '
+    "given); series of months or years must start on day 1 to 28 of a month",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="record each variable's timings and rows in "
+    "logs/extract_<wave>_profile.jsonl and print the slowest variables",
+)
+parser.add_argument(
+    "--profile-dir", help="directory of the profiles (logs unless given)"
+)
+parser.add_argument(
+    "--profile-top",
+    type=int,
+    default=10,
+    help="number of the slowest variables printed (10 unless given)",
+)
+options = parser.parse_args()
+if (options.series_start is None) != (options.series_end is None):
+    parser.error("--series-start and --series-end must be given together")
+profile_dir = (
+    (options.profile_dir or "logs")
+    if options.profile or options.profile_dir
+    else None
+)
+
+# EXTRACT ----
+if options.series_start:
+    try:
+        studies = load_series_studies(
+            options.series_start, options.series_end, options.series_step
+        )
+    except ValueError as error:
+        sys.exit(f"Invalid series: {error}")
+else:
+    studies = load_wave_studies(options.waves or wave_keys(config))
+    studies["era"] = load_era_study()
+extract_options = dict(
+    output_format=options.output_format,
+    cache_dir=options.cache_dir,
+    workers=options.workers,
+    population_pushdown=options.population_pushdown,
+    profile_dir=profile_dir,
+    connections=options.connections,
+    timeout=options.query_timeout,
+    compression_threads=options.compression_threads,
+)
+source = open_source(options.input_source)
+if options.shards > 1:
+    paths = extract_sharded(
+        source,
+        studies,
+        options.output_dir,
+        shards=options.shards,
+        processes=options.processes,
+        batch_size=options.batch_size,
+        max_rss_mb=options.max_rss_mb,
+        **extract_options,
+    )
+elif options.batch_size or options.max_rss_mb:
+    paths = extract_streamed(
+        source,
+        studies,
+        options.output_dir,
+        batch_size=options.batch_size,
+        max_rss_mb=options.max_rss_mb,
+        **extract_options,
+    )
+else:
+    paths = extract_waves(source, studies, options.output_dir, **extract_options)
+for wave, path in paths.items():
+    print(f"{wave}: {path}")
+
+# PROFILE ----
+if profile_dir:
+    records = [
+        record
+        for wave in paths
+        for record in read_profile(profile_path(profile_dir, wave))
+    ]
+    print(format_summary(records, options.profile_top))
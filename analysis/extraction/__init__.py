@@ -0,0 +1,4 @@
+# Local extraction layer
+# Evaluates processed cohortextractor study definitions over source tables
+# held in memory, so that several study definitions (e.g. all waves in
+# config.json) can share one scan of each source table.
@@ -0,0 +1,1138 @@
+# Local evaluation of processed cohortextractor covariate definitions
+# Takes `study.covariate_definitions` (index dates already substituted by
+# StudyDefinition) and evaluates each `patients.*` query with vectorised
+# numpy/pandas operations over the source tables in `extraction.tables`.
+# Results follow the TPP backend conventions: one row per patient in the
+# population, empty values for patients without a match.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+from codelist_index import (
+    CodelistIndex,
+    EncodedCodes,
+    encode_codes,
+    is_integer_system,
+)
+from extraction.dates import (
+    NAT,
+    OPEN_END_DATE,
+    format_dates,
+    resolve_date,
+    to_date,
+    truncate_dates,
+)
+from extraction.dependencies import (
+    required_variables,
+    topological_levels,
+    variable_dependencies,
+)
+from extraction.expressions import evaluate_expression
+from extraction.planner import (
+    code_bitmasks,
+    plan_era_bins,
+    plan_shared_scans,
+    variable_bit,
+)
+from extraction.timelines import EventTimeline, timeline_key
+from extraction.vaccinations import dose_sequence, plan_vaccination_sequences
+
+# Query types which read from each event table
+EVENT_QUERY_TABLES = {
+    "with_these_clinical_events": "clinical_events",
+    "mean_recorded_value": "clinical_events",
+    "most_recent_bmi": "clinical_events",
+    "with_these_medications": "medications",
+    "admitted_to_hospital": "apcs",
+    "attended_emergency_care": "ecds",
+    "with_test_result_in_sgss": "sgss",
+    "with_tpp_vaccination_record": "vaccinations",
+    "died_from_any_cause": "ons_deaths",
+    "with_these_codes_on_death_certificate": "ons_deaths",
+}
+
+# CTV3 code for recorded BMI
+BMI_CODE = "22K.."
+
+# Mapping from the first letter of the NHS ethnic category code to the
+# 6-level grouping (as used by the TPP backend)
+ETHNICITY_GROUP_6 = {
+    "A": "1", "B": "1", "C": "1",
+    "D": "2", "E": "2", "F": "2", "G": "2",
+    "H": "3", "J": "3", "K": "3", "L": "3",
+    "M": "4", "N": "4", "P": "4",
+    "R": "5", "S": "5",
+}
+
+EMPTY_VALUES = {"bool": False, "int": 0, "float": 0.0, "str": "", "date": NAT}
+
+# `returning` value for which event queries return their matched events
+# (patient positions and dates) rather than a column; used to bin events
+MATCHED_EVENTS = "matched_events"
+
+# Arguments that describe the output column rather than the query
+OUTPUT_ARGS = (
+    "return_expectations",
+    "hidden",
+    "date_format",
+    "include_date_of_match",
+    "column_type",
+)
+
+
+def codelist_codes(codelist):
+    # Codes (and category lookup, if the codelist has categories)
+    if getattr(codelist, "has_categories", False):
+        return [code for code, _ in codelist], dict(codelist)
+    return list(codelist), None
+
+
+def frame_dates(frame, column):
+    return frame[column].to_numpy().astype("datetime64[D]")
+
+
+class LocalBackend:
+    def __init__(self, tables, cache=None, workers=1, population_pushdown=False):
+        self.tables = tables
+        # Per-variable result cache (extraction.cache.VariableCache), if any
+        self.cache = cache
+        # Number of threads evaluating independent covariates concurrently
+        self.workers = workers
+        # Whether to evaluate the population first and restrict the tables
+        # to its patients before evaluating the other covariates
+        self.population_pushdown = population_pushdown
+        patients = tables["patients"].sort_values("patient_id")
+        self.tables["patients"] = patients.reset_index(drop=True)
+        self.patient_ids = patients["patient_id"].to_numpy()
+        self.size = len(self.patient_ids)
+        self.source_tables = self.tables
+        self.source_patient_ids = self.patient_ids
+        # Rows of each source table kept by restrict_to_population
+        self.table_rows = {}
+        # Code columns encoded for codelist matching, by (table, column, kind)
+        self.encoded_columns = {}
+        self.restricted_encoded_columns = {}
+        # Event timelines of the code-matching variables over the source
+        # tables, by timeline key (see extraction.timelines); kept for every
+        # later study
+        self.timelines = {}
+        # Positions in the source patients of the patients restricted to by
+        # restrict_to_population, if any
+        self.population_positions = None
+        # Wall time (seconds), source rows read and rows returned by each
+        # covariate in the last evaluation; see record_stats
+        self.variable_stats = {}
+        # Tables read (through read_table) by the covariate or shared scan
+        # each thread is evaluating
+        self.local = threading.local()
+        # Objects notified around the evaluation of each covariate, through
+        # variable_started(name, query_type, query_args) and
+        # variable_finished(name, query_type, query_args, stats), e.g.
+        # extraction.profile.ExtractionProfile
+        self.hooks = []
+
+    # --- EVALUATION ---
+
+    def evaluate(self, covariate_definitions):
+        # Evaluates every covariate, returning a dict of raw column arrays
+        # aligned with self.patient_ids (only the population's patients with
+        # population_pushdown)
+        self.tables = self.source_tables
+        self.patient_ids = self.source_patient_ids
+        self.size = len(self.patient_ids)
+        self.table_rows = {}
+        self.restricted_encoded_columns = {}
+        self.population_positions = None
+        self.columns = {}
+        self.empty_values = {}
+        self.match_dates = {}
+        self.match_comparators = {}
+        self.shared_results = {}
+        self.variable_stats = {}
+        keys = self.cache.keys(covariate_definitions) if self.cache else {}
+        if not self.population_pushdown:
+            self.evaluate_covariates(covariate_definitions, keys)
+            return self.columns
+        population = required_variables(
+            variable_dependencies(covariate_definitions), ["population"]
+        )
+        self.evaluate_covariates(
+            {
+                name: definition
+                for name, definition in covariate_definitions.items()
+                if name in population
+            },
+            keys,
+        )
+        self.restrict_to_population(self.columns["population"].astype(bool))
+        # The other covariates are only evaluated for the population, so are
+        # cached for that population
+        self.evaluate_covariates(
+            {
+                name: definition
+                for name, definition in covariate_definitions.items()
+                if name not in population
+            },
+            {
+                name: self.cache.scoped_key(key, keys["population"])
+                for name, key in keys.items()
+                if name not in population
+            },
+        )
+        return self.columns
+
+    def evaluate_covariates(self, covariate_definitions, keys):
+        # Evaluates the covariates, or restores them from the cache where
+        # `keys` has a cached entry
+        cached = {name for name, key in keys.items() if self.cache.contains(key)}
+        # Only the variables that are not cached are planned and evaluated
+        pending = {
+            name: definition
+            for name, definition in covariate_definitions.items()
+            if name not in cached
+        }
+        for table, names in plan_shared_scans(pending).items():
+            started = time.perf_counter()
+            self.local.reads = {}
+            variables = {name: pending[name] for name in names}
+            self.shared_results.update(self.evaluate_shared_scan(table, variables))
+            self.record_shared_stats(names, time.perf_counter() - started)
+        for sequence in plan_vaccination_sequences(pending):
+            started = time.perf_counter()
+            self.local.reads = {}
+            variables = {name: pending[name][1] for name, _ in sequence}
+            gaps = [gap for _, gap in sequence[1:]]
+            self.shared_results.update(
+                self.evaluate_vaccination_sequence(variables, gaps)
+            )
+            self.record_shared_stats(list(variables), time.perf_counter() - started)
+        for query_type, names in plan_era_bins(pending):
+            started = time.perf_counter()
+            self.local.reads = {}
+            variables = {name: pending[name][1] for name in names}
+            self.shared_results.update(self.evaluate_era_bins(query_type, variables))
+            self.record_shared_stats(names, time.perf_counter() - started)
+
+        # Covariates are evaluated after the covariates they refer to; those
+        # in the same level are independent of each other
+        def evaluate_or_restore(name):
+            query_type, query_args = covariate_definitions[name]
+            for hook in self.hooks:
+                hook.variable_started(name, query_type, query_args)
+            started = time.perf_counter()
+            self.local.reads = {}
+            if name in cached and self.restore_covariate(name, self.cache.load(keys[name])):
+                self.record_stats(name, True, time.perf_counter() - started)
+            else:
+                self.evaluate_covariate(name, query_type, query_args)
+                self.record_stats(name, False, time.perf_counter() - started)
+                if self.cache:
+                    self.cache.store(keys[name], self.covariate_entry(name))
+            stats = self.variable_stats[name]
+            for hook in self.hooks:
+                hook.variable_finished(name, query_type, query_args, stats)
+
+        # (references to covariates evaluated earlier are not in the graph)
+        levels = topological_levels(variable_dependencies(covariate_definitions))
+        if self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for level in levels:
+                    list(executor.map(evaluate_or_restore, level))
+        else:
+            for level in levels:
+                for name in level:
+                    evaluate_or_restore(name)
+
+    def read_table(self, table, source=False):
+        # A table (the source table if `source`, else the table restricted to
+        # the population, if any) read in full by the covariate or shared
+        # scan being evaluated; its rows are counted by record_stats
+        frame = (self.source_tables if source else self.tables)[table]
+        reads = getattr(self.local, "reads", None)
+        if reads is not None:
+            reads[(table, source)] = len(frame)
+        return frame
+
+    def rows_read(self):
+        reads = getattr(self.local, "reads", None) or {}
+        self.local.reads = None
+        return sum(reads.values())
+
+    def record_stats(self, name, cached, seconds):
+        # Covariates restored from the cache read no source rows; covariates
+        # evaluated from a shared scan read only what that scan read (see
+        # record_shared_stats)
+        stats = self.variable_stats.setdefault(
+            name, {"seconds": 0.0, "rows_scanned": 0}
+        )
+        stats["seconds"] += seconds
+        stats["rows_scanned"] += self.rows_read()
+        stats["rows_returned"] = count_returned(
+            self.columns[name], self.empty_values[name]
+        )
+        stats["cached"] = cached
+
+    def record_shared_stats(self, names, seconds):
+        # The time and rows read of a scan shared by several covariates are
+        # split between them
+        rows = self.rows_read()
+        for number, name in enumerate(names):
+            stats = self.variable_stats.setdefault(
+                name, {"seconds": 0.0, "rows_scanned": 0}
+            )
+            stats["seconds"] += seconds / len(names)
+            stats["rows_scanned"] += rows // len(names) + (number < rows % len(names))
+
+    def restrict_to_population(self, population):
+        # Semi-joins every table with the patients in `population` (a mask
+        # over self.patient_ids) and restricts the evaluated columns to them,
+        # so that the remaining covariates only read the population's rows
+        patient_ids = self.patient_ids[population]
+        tables = {}
+        for table, frame in self.source_tables.items():
+            table_patient_ids = frame["patient_id"].to_numpy()
+            positions = np.minimum(
+                np.searchsorted(patient_ids, table_patient_ids),
+                max(len(patient_ids) - 1, 0),
+            )
+            if len(patient_ids):
+                rows = np.flatnonzero(patient_ids[positions] == table_patient_ids)
+            else:
+                rows = np.array([], dtype="int64")
+            self.table_rows[table] = rows
+            tables[table] = frame.take(rows).reset_index(drop=True)
+        self.tables = tables
+        self.patient_ids = patient_ids
+        self.size = len(patient_ids)
+        self.population_positions = np.flatnonzero(population)
+        for name, values in self.columns.items():
+            self.columns[name] = values[population]
+        for lookup in (self.match_dates, self.match_comparators):
+            for name, values in lookup.items():
+                if values is not None:
+                    lookup[name] = values[population]
+
+    def evaluate_covariate(self, name, query_type, query_args):
+        query_args = dict(query_args)
+        query_args.pop("return_expectations", None)
+        query_args.pop("hidden", None)
+        query_args.pop("date_format", None)
+        query_args.pop("include_date_of_match", None)
+        column_type = query_args.pop("column_type")
+        method = getattr(self, f"patients_{query_type}", None)
+        if method is None:
+            raise ValueError(f"Unsupported query type for {name}: {query_type}")
+        if name in self.shared_results:
+            result = self.shared_results.pop(name)
+        else:
+            result = method(**query_args)
+        if isinstance(result, dict):
+            self.match_dates[name] = result.get("date")
+            self.match_comparators[name] = result.get("comparator")
+            result = result["value"]
+        empty_value = EMPTY_VALUES[column_type]
+        if query_args.get("returning") == "index_of_multiple_deprivation":
+            empty_value = -1
+        self.columns[name] = coerce_column(result, column_type, empty_value)
+        self.empty_values[name] = empty_value
+
+    def covariate_entry(self, name):
+        # Everything later covariates may read from an evaluated covariate
+        entry = {"value": self.columns[name], "empty_value": self.empty_values[name]}
+        if name in self.match_dates:
+            entry["date"] = self.match_dates[name]
+            entry["comparator"] = self.match_comparators[name]
+        return entry
+
+    def restore_covariate(self, name, entry):
+        # Restores a covariate from a cache entry, False if there is none
+        if entry is None or len(entry["value"]) != self.size:
+            return False
+        self.columns[name] = entry["value"]
+        self.empty_values[name] = entry["empty_value"]
+        if "date" in entry:
+            self.match_dates[name] = entry["date"]
+            self.match_comparators[name] = entry["comparator"]
+        return True
+
+    def to_dataframe(self, covariate_definitions, typed=False):
+        # Evaluates and formats the output columns for the population, in the
+        # same layout cohortextractor writes (patient_id, then each visible
+        # column in definition order). With `typed`, columns keep their types
+        # (dates as datetime64[D], flags as bool) for typed output formats
+        columns = self.evaluate(covariate_definitions)
+        population = columns["population"].astype(bool)
+        return output_frame(
+            self.patient_ids, columns, covariate_definitions, typed, population
+        )
+
+    # --- HELPERS ---
+
+    def positions(self, patient_ids):
+        # Maps patient ids to row positions, with a mask for known patients
+        positions = np.searchsorted(self.patient_ids, patient_ids)
+        positions = np.minimum(positions, max(self.size - 1, 0))
+        known = self.patient_ids[positions] == patient_ids if self.size else (
+            np.zeros(len(patient_ids), dtype=bool)
+        )
+        return positions, known
+
+    def resolve(self, date_expression):
+        return resolve_date(date_expression, self.columns, self.size)
+
+    def window_mask(self, positions, dates, between):
+        # Restricts events to `between`, where either bound may be None or may
+        # refer to another (per-patient) date column
+        mask = ~np.isnat(dates)
+        if not between:
+            return mask
+        start, end = between
+        if start is not None:
+            mask &= dates >= self.resolve(start)[positions]
+        if end is not None:
+            mask &= dates <= self.resolve(end)[positions]
+        return mask
+
+    def select_rows(self, positions, dates, find_first_match_in_period, size=None):
+        # Index of the first or last event (by date) for each patient, -1 if
+        # there is none; ties on date resolve to the later row. `size` allows
+        # for positions beyond the patient array (see evaluate_era_bins)
+        rows = np.full(self.size if size is None else size, -1, dtype="int64")
+        if len(positions) == 0:
+            return rows
+        order = np.lexsort((dates, positions))
+        sorted_positions = positions[order]
+        change = sorted_positions[1:] != sorted_positions[:-1]
+        if find_first_match_in_period:
+            boundary = np.concatenate([[True], change])
+        else:
+            boundary = np.concatenate([change, [True]])
+        rows[sorted_positions[boundary]] = order[boundary]
+        return rows
+
+    def encoded_codes(self, table, column, system, restricted=True):
+        # Code column of a table encoded for matching against codelists of
+        # `system` (encoded once and shared by every variable and wave); of
+        # the source table unless `restricted` and the table is restricted
+        key = (table, column, is_integer_system(system))
+        if key not in self.encoded_columns:
+            self.encoded_columns[key] = encode_codes(
+                self.read_table(table, source=True)[column].to_numpy(), system
+            )
+        if not restricted or table not in self.table_rows:
+            return self.encoded_columns[key]
+        # Restricted tables take the codes of their rows from the encoding
+        # of the source table
+        if key not in self.restricted_encoded_columns:
+            encoded = self.encoded_columns[key]
+            self.restricted_encoded_columns[key] = EncodedCodes(
+                encoded.uniques, encoded.inverse[self.table_rows[table]]
+            )
+        return self.restricted_encoded_columns[key]
+
+    def code_mask(self, table, column, codelist):
+        # Rows of the table whose code is in the codelist
+        index = CodelistIndex.from_codelist(codelist)
+        return index.isin(self.encoded_codes(table, column, index.system))
+
+    def match_events(self, table, mask_function, date_column, between):
+        # Filters an event table to rows for known patients that satisfy
+        # `mask_function(frame)` and the date window
+        frame = self.read_table(table)
+        positions, known = self.positions(frame["patient_id"].to_numpy())
+        dates = frame_dates(frame, date_column)
+        mask = known & mask_function(frame)
+        mask &= self.window_mask(positions, dates, between)
+        return frame[mask], positions[mask], dates[mask]
+
+    def event_result(
+        self,
+        frame,
+        positions,
+        dates,
+        returning,
+        find_first_match_in_period,
+        category_lookup=None,
+        code_column="code",
+    ):
+        # Turns matched events into the value requested by `returning`
+        if returning == MATCHED_EVENTS:
+            return {"positions": positions, "dates": dates}
+        counts = np.bincount(positions, minlength=self.size)
+        rows = self.select_rows(positions, dates, find_first_match_in_period)
+        return self.match_result(
+            frame, dates, rows, counts, returning, category_lookup, code_column
+        )
+
+    def match_result(
+        self,
+        frame,
+        dates,
+        rows,
+        counts,
+        returning,
+        category_lookup=None,
+        code_column="code",
+    ):
+        # Value requested by `returning`, given each patient's selected row of
+        # `frame` (-1 for no match) and number of matches
+        has_match = rows >= 0
+        matched_dates = np.full(self.size, NAT, dtype="datetime64[D]")
+        matched_dates[has_match] = dates[rows[has_match]]
+        if returning == "binary_flag":
+            value = has_match
+        elif returning in ("date", "date_admitted", "date_arrived", "date_of_death"):
+            value = matched_dates
+        elif returning == "number_of_matches_in_period":
+            value = counts
+        elif returning == "numeric_value":
+            value = np.zeros(self.size, dtype="float64")
+            value[has_match] = frame["numeric_value"].iloc[rows[has_match]].to_numpy()
+        elif returning in ("code", "category"):
+            codes = frame[code_column].iloc[rows[has_match]].to_numpy()
+            if returning == "category":
+                codes = [category_lookup[code] for code in codes]
+            value = np.full(self.size, "", dtype=object)
+            value[has_match] = codes
+        else:
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        comparator = None
+        if "comparator" in frame:
+            comparator = np.full(self.size, "", dtype=object)
+            comparator[has_match] = frame["comparator"].iloc[rows[has_match]].to_numpy()
+        return {"value": value, "date": matched_dates, "comparator": comparator}
+
+    def evaluate_shared_scan(self, table, variables):
+        # Evaluates a group of code-matching variables over `table` (see
+        # extraction.planner) from the event timeline of each codelist,
+        # building in one pass the timelines earlier studies have not built;
+        # returns results by variable name. Timelines cover the source table,
+        # so with a population their results are taken for its patients
+        frame = self.source_tables[table]
+        keys = {
+            name: timeline_key(query_type, query_args)
+            for name, (query_type, query_args) in variables.items()
+        }
+        missing = {}
+        for name, key in keys.items():
+            if key not in self.timelines:
+                missing.setdefault(key, variables[name][1])
+        if missing:
+            self.timelines.update(self.build_timelines(table, missing))
+
+        dates = frame_dates(frame, "date")
+        results = {}
+        for name, (_, query_args) in variables.items():
+            rows, counts = self.timelines[keys[name]].window(
+                query_args.get("between"), query_args.get("find_first_match_in_period")
+            )
+            if self.population_positions is not None:
+                rows = rows[self.population_positions]
+                counts = counts[self.population_positions]
+            results[name] = self.match_result(
+                frame,
+                dates,
+                rows,
+                counts,
+                query_args.get("returning", "binary_flag"),
+                codelist_codes(query_args["codelist"])[1],
+            )
+        return results
+
+    def build_timelines(self, table, variables):
+        # Event timelines for `variables` (query arguments by timeline key)
+        # from one pass over the source `table`: each distinct code in the
+        # table is given a bitmask of the keys whose codelist contains it,
+        # and the rows any key could match are sorted once by patient and date
+        frame = self.read_table(table, source=True)
+        keys = list(variables)
+        indexes = [
+            CodelistIndex.from_codelist(variables[key]["codelist"]) for key in keys
+        ]
+        encoded = [
+            self.encoded_codes(table, "code", index.system, restricted=False)
+            for index in indexes
+        ]
+        # Every encoding of a column comes from the same factorisation, so the
+        # distinct codes line up across systems
+        bitmasks = code_bitmasks(
+            [
+                index.searchsorted(codes.uniques)[1]
+                for index, codes in zip(indexes, encoded)
+            ]
+        )
+        inverse = encoded[0].inverse
+
+        size = len(self.source_patient_ids)
+        patient_ids = frame["patient_id"].to_numpy()
+        positions = np.minimum(
+            np.searchsorted(self.source_patient_ids, patient_ids), max(size - 1, 0)
+        )
+        known = (
+            self.source_patient_ids[positions] == patient_ids
+            if size
+            else np.zeros(len(patient_ids), dtype=bool)
+        )
+        dates = frame_dates(frame, "date")
+        candidates = known & ~np.isnat(dates) & bitmasks.any(axis=1)[inverse]
+        candidate_rows = np.flatnonzero(candidates)
+        order = np.lexsort((dates[candidate_rows], positions[candidate_rows]))
+        candidate_rows = candidate_rows[order]
+        row_bitmasks = bitmasks[inverse[candidate_rows]]
+        row_positions = positions[candidate_rows]
+        row_dates = dates[candidate_rows]
+        row_values = None
+        if "numeric_value" in frame:
+            row_values = frame["numeric_value"].fillna(0).to_numpy()[candidate_rows]
+
+        timelines = {}
+        for number, key in enumerate(keys):
+            word, bit = variable_bit(number)
+            mask = (row_bitmasks[:, word] & bit) != 0
+            if variables[key].get("ignore_missing_values"):
+                mask = mask & (row_values != 0)
+            # Matches stay sorted by patient and date
+            timelines[key] = EventTimeline(
+                candidate_rows[mask], row_positions[mask], row_dates[mask], size
+            )
+        return timelines
+
+    def evaluate_vaccination_sequence(self, variables, gaps):
+        # Evaluates a chain of dose dates (see extraction.vaccinations) from
+        # one sort of the matching vaccination records
+        first_args = next(iter(variables.values()))
+        frame = self.read_table("vaccinations")
+        positions, known = self.positions(frame["patient_id"].to_numpy())
+        mask = known & vaccination_mask(
+            frame,
+            first_args.get("target_disease_matches"),
+            first_args.get("product_name_matches"),
+        )
+        start, end = first_args.get("between") or (None, None)
+        doses = dose_sequence(
+            positions[mask], frame_dates(frame, "date")[mask], self.size, start, end, gaps
+        )
+        return {
+            name: {"value": dose, "date": dose, "comparator": None}
+            for name, dose in zip(variables, doses)
+        }
+
+    def evaluate_era_bins(self, query_type, variables):
+        # Evaluates variables that differ only in their (non-overlapping)
+        # date windows from one query over the union of the windows (see
+        # extraction.planner); returns results by variable name
+        names = list(variables)
+        query_args = {
+            key: value
+            for key, value in variables[names[0]].items()
+            if key not in OUTPUT_ARGS
+        }
+        find_first_match_in_period = query_args.get("find_first_match_in_period")
+        starts = np.array([to_date(variables[name]["between"][0]) for name in names])
+        ends = np.array([to_date(variables[name]["between"][1]) for name in names])
+        query_args["between"] = [str(starts.min()), str(ends.max())]
+        query_args["returning"] = MATCHED_EVENTS
+        events = getattr(self, f"patients_{query_type}")(**query_args)
+
+        # Window of each event (windows sorted by start, -1 for none)
+        order = np.argsort(starts)
+        dates = events["dates"]
+        window = np.searchsorted(starts[order], dates, side="right") - 1
+        inside = window >= 0
+        window = np.where(inside, window, 0)
+        inside &= dates <= ends[order][window]
+        bins = order[window[inside]]
+        keys = bins * self.size + events["positions"][inside]
+        # One selected row per (variable, patient) key
+        rows = self.select_rows(
+            keys, dates[inside], find_first_match_in_period, size=len(names) * self.size
+        )
+        results = {}
+        for number, name in enumerate(names):
+            selected = rows[number * self.size:(number + 1) * self.size]
+            matched = np.full(self.size, NAT, dtype="datetime64[D]")
+            has_match = selected >= 0
+            matched[has_match] = dates[inside][selected[has_match]]
+            results[name] = {"value": matched, "date": matched, "comparator": None}
+        return results
+
+    def active_rows(self, table, date):
+        # Row of the record (registration/address) active on `date` for each
+        # patient, preferring the latest start date then the latest end date
+        frame = self.read_table(table)
+        positions, known = self.positions(frame["patient_id"].to_numpy())
+        start = frame_dates(frame, "start_date")
+        end = frame_dates(frame, "end_date")
+        reference = self.resolve(date)[positions]
+        mask = known & (start <= reference) & (end > reference)
+        candidates = np.flatnonzero(mask)
+        order = np.lexsort((end[candidates], start[candidates], positions[candidates]))
+        candidates = candidates[order]
+        candidate_positions = positions[candidates]
+        last = np.concatenate([candidate_positions[1:] != candidate_positions[:-1], [True]])
+        rows = np.full(self.size, -1, dtype="int64")
+        if len(candidates):
+            rows[candidate_positions[last]] = candidates[last]
+        return rows
+
+    def categorise(self, category_definitions, columns, empty_values):
+        size = len(next(iter(columns.values()))) if columns else self.size
+        return categorise(category_definitions, columns, empty_values, size)
+
+    # --- PATIENT-LEVEL QUERIES ---
+
+    def patients_sex(self):
+        return self.read_table("patients")["sex"].to_numpy(dtype=object)
+
+    def patients_age_as_of(self, reference_date):
+        date_of_birth = frame_dates(self.read_table("patients"), "date_of_birth")
+        reference = self.resolve(reference_date)
+        return age_in_years(date_of_birth, reference)
+
+    def patients_registered_with_one_practice_between(
+        self, start_date, end_date, practice_used_systm_one_throughout_period=False
+    ):
+        frame = self.read_table("registrations")
+        positions, known = self.positions(frame["patient_id"].to_numpy())
+        mask = known & (frame_dates(frame, "start_date") <= to_date(start_date))
+        mask &= frame_dates(frame, "end_date") > to_date(end_date)
+        return np.bincount(positions[mask], minlength=self.size) > 0
+
+    def patients_registered_practice_as_of(self, date, returning=None):
+        if returning not in ("stp_code", "nuts1_region_name"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        rows = self.active_rows("registrations", date)
+        values = np.full(self.size, "", dtype=object)
+        values[rows >= 0] = self.tables["registrations"][returning].to_numpy()[
+            rows[rows >= 0]
+        ]
+        return values
+
+    def patients_date_deregistered_from_all_supported_practices(self, between=None):
+        frame = self.read_table("registrations")
+        positions, known = self.positions(frame["patient_id"].to_numpy())
+        last_end = np.full(self.size, NAT, dtype="datetime64[D]")
+        end = frame_dates(frame, "end_date")
+        np.maximum.at(last_end.view("int64"), positions[known], end[known].view("int64"))
+        start, stop = between or (None, None)
+        in_window = (last_end >= to_date(start or "1900-01-01")) & (
+            last_end <= to_date(stop or "3000-01-01")
+        )
+        last_end[~in_window | (last_end == OPEN_END_DATE)] = NAT
+        return last_end
+
+    def patients_address_as_of(self, date, returning=None, round_to_nearest=None):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        rows = self.active_rows("addresses", date)
+        values = np.full(self.size, -1, dtype="int64")
+        values[rows >= 0] = self.tables["addresses"]["imd_rounded"].to_numpy()[
+            rows[rows >= 0]
+        ]
+        return values
+
+    def patients_care_home_status_as_of(self, date, categorised_as):
+        rows = self.active_rows("addresses", date)
+        frame = self.tables["addresses"]
+        has_address = rows >= 0
+        columns = {}
+        for name, column in (
+            ("IsPotentialCareHome", "is_potential_care_home"),
+            ("LocationRequiresNursing", "location_requires_nursing"),
+            ("LocationDoesNotRequireNursing", "location_does_not_require_nursing"),
+        ):
+            values = frame[column].to_numpy()
+            empty = 0 if column == "is_potential_care_home" else ""
+            column_values = np.full(self.size, empty, dtype=object)
+            column_values[has_address] = values[rows[has_address]]
+            if column == "is_potential_care_home":
+                column_values = column_values.astype("int64")
+            columns[name] = column_values
+        empty_values = {"IsPotentialCareHome": 0, "LocationRequiresNursing": "",
+                        "LocationDoesNotRequireNursing": ""}
+        return self.categorise(categorised_as, columns, empty_values)
+
+    def patients_with_ethnicity_from_sus(self, returning="code", use_most_frequent_code=None):
+        if returning not in ("code", "group_6"):
+            raise ValueError(f"Unsupported `returning` value: {returning}")
+        codes = pd.concat(
+            [self.read_table("apcs")[["patient_id", "ethnicity"]],
+             self.read_table("ecds")[["patient_id", "ethnicity"]]]
+        )
+        codes = codes[codes["ethnicity"] != ""]
+        counts = codes.groupby(["patient_id", "ethnicity"]).size().reset_index(name="n")
+        counts = counts.sort_values(["patient_id", "n", "ethnicity"])
+        most_frequent = counts.drop_duplicates("patient_id", keep="last")
+        positions, known = self.positions(most_frequent["patient_id"].to_numpy())
+        values = np.full(self.size, "", dtype=object)
+        ethnicity = most_frequent["ethnicity"].to_numpy()[known]
+        if returning == "group_6":
+            ethnicity = [ETHNICITY_GROUP_6.get(code[:1], "0") for code in ethnicity]
+        values[positions[known]] = ethnicity
+        return values
+
+    # --- EVENT-LEVEL QUERIES ---
+
+    def patients_with_these_clinical_events(
+        self,
+        codelist,
+        returning="binary_flag",
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        ignore_missing_values=False,
+        ignore_days_where_these_codes_occur=None,
+        episode_defined_as=None,
+        include_reference_range_columns=False,
+    ):
+        if ignore_days_where_these_codes_occur or episode_defined_as:
+            raise ValueError("Episode and ignored-day matching is not supported")
+        _, category_lookup = codelist_codes(codelist)
+
+        def mask_function(frame):
+            mask = self.code_mask("clinical_events", "code", codelist)
+            if ignore_missing_values:
+                mask = mask & (frame["numeric_value"].fillna(0).to_numpy() != 0)
+            return mask
+
+        frame, positions, dates = self.match_events(
+            "clinical_events", mask_function, "date", between
+        )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period,
+            category_lookup,
+        )
+
+    def patients_with_these_medications(
+        self,
+        codelist,
+        returning="binary_flag",
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        ignore_days_where_these_codes_occur=None,
+        episode_defined_as=None,
+    ):
+        if ignore_days_where_these_codes_occur or episode_defined_as:
+            raise ValueError("Episode and ignored-day matching is not supported")
+        frame, positions, dates = self.match_events(
+            "medications",
+            lambda frame: self.code_mask("medications", "code", codelist),
+            "date",
+            between,
+        )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period
+        )
+
+    def patients_mean_recorded_value(
+        self, codelist, on_most_recent_day_of_measurement=None, between=None
+    ):
+        frame, positions, dates = self.match_events(
+            "clinical_events",
+            lambda frame: self.code_mask("clinical_events", "code", codelist),
+            "date",
+            between,
+        )
+        rows = self.select_rows(positions, dates, find_first_match_in_period=False)
+        has_match = rows >= 0
+        last_dates = np.full(self.size, NAT, dtype="datetime64[D]")
+        last_dates[has_match] = dates[rows[has_match]]
+        on_last_day = dates == last_dates[positions]
+        values = frame["numeric_value"].fillna(0).to_numpy()[on_last_day]
+        totals = np.bincount(positions[on_last_day], weights=values, minlength=self.size)
+        counts = np.bincount(positions[on_last_day], minlength=self.size)
+        means = np.divide(totals, counts, out=np.zeros(self.size), where=counts > 0)
+        return {"value": means, "date": last_dates}
+
+    def patients_most_recent_bmi(self, between=None, minimum_age_at_measurement=16):
+        date_of_birth = frame_dates(self.read_table("patients"), "date_of_birth")
+
+        def mask_function(frame):
+            positions, _ = self.positions(frame["patient_id"].to_numpy())
+            age = age_in_years(date_of_birth[positions], frame_dates(frame, "date"))
+            return (
+                (frame["code"] == BMI_CODE).to_numpy()
+                & (frame["numeric_value"].fillna(0).to_numpy() > 0)
+                & (age >= minimum_age_at_measurement)
+            )
+
+        frame, positions, dates = self.match_events(
+            "clinical_events", mask_function, "date", between
+        )
+        return self.event_result(
+            frame, positions, dates, "numeric_value", find_first_match_in_period=False
+        )
+
+    def patients_admitted_to_hospital(
+        self,
+        returning="binary_flag",
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        with_these_diagnoses=None,
+        with_admission_method=None,
+        **unsupported_filters,
+    ):
+        if any(value not in (None, False) for value in unsupported_filters.values()):
+            raise ValueError("Only diagnosis and admission method filters are supported")
+
+        def mask_function(frame):
+            mask = np.ones(len(frame), dtype=bool)
+            if with_these_diagnoses is not None:
+                mask &= prefix_match(frame["diagnosis"], with_these_diagnoses)
+            if with_admission_method is not None:
+                mask &= frame["admission_method"].isin(with_admission_method).to_numpy()
+            return mask
+
+        frame, positions, dates = self.match_events(
+            "apcs", mask_function, "admission_date", between
+        )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period
+        )
+
+    def patients_attended_emergency_care(
+        self,
+        returning="binary_flag",
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        with_these_diagnoses=None,
+        discharged_to=None,
+    ):
+        if discharged_to is not None:
+            raise ValueError("Discharge destination filters are not supported")
+
+        def mask_function(frame):
+            if with_these_diagnoses is None:
+                return np.ones(len(frame), dtype=bool)
+            return frame["diagnosis"].isin(list(with_these_diagnoses)).to_numpy()
+
+        frame, positions, dates = self.match_events(
+            "ecds", mask_function, "arrival_date", between
+        )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period
+        )
+
+    def patients_with_test_result_in_sgss(
+        self,
+        pathogen=None,
+        test_result="any",
+        returning="binary_flag",
+        between=None,
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+        restrict_to_earliest_specimen_date=True,
+    ):
+        def mask_function(frame):
+            mask = (frame["pathogen"] == pathogen).to_numpy()
+            if test_result != "any":
+                mask = mask & (frame["result"] == test_result).to_numpy()
+            return mask
+
+        if restrict_to_earliest_specimen_date:
+            # Only the earliest specimen for each patient is considered, so the
+            # window is applied after picking it
+            frame, positions, dates = self.match_events(
+                "sgss", mask_function, "specimen_date", None
+            )
+            rows = self.select_rows(positions, dates, find_first_match_in_period=True)
+            earliest = np.zeros(len(frame), dtype=bool)
+            earliest[rows[rows >= 0]] = True
+            earliest &= self.window_mask(positions, dates, between)
+            frame, positions, dates = frame[earliest], positions[earliest], dates[earliest]
+        else:
+            frame, positions, dates = self.match_events(
+                "sgss", mask_function, "specimen_date", between
+            )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period
+        )
+
+    def patients_with_tpp_vaccination_record(
+        self,
+        target_disease_matches=None,
+        product_name_matches=None,
+        between=None,
+        returning="binary_flag",
+        find_first_match_in_period=None,
+        find_last_match_in_period=None,
+    ):
+        frame, positions, dates = self.match_events(
+            "vaccinations",
+            lambda frame: vaccination_mask(
+                frame, target_disease_matches, product_name_matches
+            ),
+            "date",
+            between,
+        )
+        return self.event_result(
+            frame, positions, dates, returning, find_first_match_in_period
+        )
+
+    def patients_died_from_any_cause(self, between=None, returning="binary_flag"):
+        frame, positions, dates = self.match_events(
+            "ons_deaths", lambda frame: np.ones(len(frame), dtype=bool), "date", between
+        )
+        return self.event_result(frame, positions, dates, returning, True)
+
+    def patients_with_these_codes_on_death_certificate(
+        self, codelist, between=None, match_only_underlying_cause=False,
+        returning="binary_flag",
+    ):
+        codes, _ = codelist_codes(codelist)
+
+        def mask_function(frame):
+            mask = prefix_match(frame["cause"], codes)
+            if match_only_underlying_cause:
+                mask &= frame["underlying"].to_numpy()
+            return mask
+
+        frame, positions, dates = self.match_events(
+            "ons_deaths", mask_function, "date", between
+        )
+        return self.event_result(frame, positions, dates, returning, True)
+
+    # --- DERIVED COLUMNS ---
+
+    def patients_value_from(self, source, returning):
+        if returning == "date":
+            return self.match_dates[source]
+        if returning == "comparator":
+            return self.match_comparators[source]
+        raise ValueError(f"Unsupported `returning` value: {returning}")
+
+    def patients_categorised_as(self, category_definitions, **extra_columns):
+        # Nested columns have already been hoisted to the top level by
+        # StudyDefinition
+        return self.categorise(category_definitions, self.columns, self.empty_values)
+
+
+def categorise(category_definitions, columns, empty_values, size):
+    # CASE expression: the first matching category wins, otherwise DEFAULT
+    default = [key for key, value in category_definitions.items() if value == "DEFAULT"]
+    if len(default) != 1:
+        raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+    result = np.full(size, default[0], dtype=object)
+    assigned = np.zeros(size, dtype=bool)
+    for category, expression in category_definitions.items():
+        if expression == "DEFAULT":
+            continue
+        matches = evaluate_expression(expression, columns, empty_values)
+        result[matches & ~assigned] = category
+        assigned |= matches
+    return result
+
+
+def to_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def vaccination_mask(frame, target_disease_matches, product_name_matches):
+    mask = np.ones(len(frame), dtype=bool)
+    if target_disease_matches is not None:
+        mask &= frame["target_disease"].isin(to_list(target_disease_matches)).to_numpy()
+    if product_name_matches is not None:
+        mask &= frame["product_name"].isin(to_list(product_name_matches)).to_numpy()
+    return mask
+
+
+def prefix_match(codes, prefixes):
+    # ICD-10 matching: a code matches if it starts with any listed code
+    codes = codes.astype(str)
+    mask = np.zeros(len(codes), dtype=bool)
+    for length in sorted({len(prefix) for prefix in prefixes}):
+        subset = [prefix for prefix in prefixes if len(prefix) == length]
+        mask |= codes.str[:length].isin(subset).to_numpy()
+    return mask
+
+
+def age_in_years(date_of_birth, reference):
+    # Whole years between two date arrays, 0 where either date is missing
+    years = reference.astype("datetime64[Y]").astype("int64") - date_of_birth.astype(
+        "datetime64[Y]"
+    ).astype("int64")
+    birthday = add_years(date_of_birth, years)
+    years = years - (birthday > reference)
+    missing = np.isnat(date_of_birth) | np.isnat(reference)
+    return np.where(missing, 0, years)
+
+
+def add_years(dates, years):
+    months = dates.astype("datetime64[M]")
+    days = dates - months.astype("datetime64[D]")
+    return (months + (years * 12).astype("timedelta64[M]")).astype("datetime64[D]") + days
+
+
+def coerce_column(values, column_type, empty_value):
+    values = np.asarray(values)
+    if column_type == "date":
+        return values.astype("datetime64[D]")
+    if column_type == "bool":
+        if values.dtype == object:
+            return pd.Series(values).isin([1, True, "1"]).to_numpy()
+        return values.astype(bool)
+    if column_type == "int":
+        if values.dtype == object:
+            values = np.where(values == "", empty_value, values)
+        return values.astype("int64")
+    if column_type == "float":
+        return np.nan_to_num(values.astype("float64"), nan=empty_value)
+    values = values.astype(object)
+    values[pd.isna(values)] = empty_value
+    # Query results are usually strings already
+    if infer_dtype(values, skipna=False) == "string":
+        return values
+    return values.astype(str).astype(object)
+
+
+def count_returned(values, empty_value):
+    # Patients with a non-empty value in a covariate's column
+    if values.dtype.kind == "M":
+        return int(np.count_nonzero(~np.isnat(values)))
+    return int(np.count_nonzero(values != empty_value))
+
+
+def output_frame(patient_ids, columns, covariate_definitions, typed=False, rows=None):
+    # Frame of patient_id and each visible column in definition order, for
+    # the selected `rows` (a mask, or all rows); see LocalBackend.to_dataframe
+    return pd.DataFrame(
+        output_columns(patient_ids, columns, covariate_definitions, typed, rows)
+    )
+
+
+def output_columns(patient_ids, columns, covariate_definitions, typed=False, rows=None):
+    # The columns of output_frame, as a dict of arrays
+    rows = slice(None) if rows is None else rows
+    format_function = typed_column if typed else format_column
+    output = {"patient_id": patient_ids[rows]}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if name == "population" or query_args.get("hidden"):
+            continue
+        output[name] = format_function(
+            columns[name][rows],
+            query_args["column_type"],
+            query_args.get("date_format"),
+        )
+    return output
+
+
+def format_column(values, column_type, date_format):
+    if column_type == "date":
+        return format_dates(values, date_format)
+    if column_type == "bool":
+        return values.astype("int64")
+    return values
+
+
+def typed_column(values, column_type, date_format):
+    if column_type == "date":
+        return truncate_dates(values, date_format)
+    return values
@@ -0,0 +1,194 @@
+# Extraction benchmarks against synthetic source tables
+# Each case extracts one study (a wave, or the era exposures) from fixture
+# tables of a given number of patients (see extraction/fixtures.py), in a
+# fresh process so that its peak RSS is its own. A case records the wall
+# time of the scan and of the evaluation, the peak RSS, and for each
+# variable its time and the source rows it read (LocalBackend.variable_stats)
+# and the peak RSS of its evaluation (PeakMemory), summed (the peak RSS,
+# the largest) by variable group (study_factory.variable_groups).
+# Results are compared with a baseline of earlier results: a group is a
+# regression when it is slower than its baseline by more than a threshold
+# (and by more than MINIMUM_SECONDS, below which timings are noise).
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from extraction.backend import LocalBackend
+from extraction.multiwave import (
+    load_era_study,
+    load_wave_studies,
+    plan_scans,
+    scan_tables,
+)
+from extraction.tables import ParquetSource
+
+# Group differences smaller than this are not regressions
+MINIMUM_SECONDS = 0.05
+
+
+def load_study(key):
+    if key == "era":
+        return load_era_study()
+    return load_wave_studies([key])[key]
+
+
+def peak_rss_mb():
+    # Peak RSS of the process since it started, or since reset_peak_rss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (2**20 if sys.platform == "darwin" else 1024)
+
+
+def reset_peak_rss():
+    # Resets the peak RSS to the current RSS (Linux only; False elsewhere)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    # LocalBackend hook recording the peak RSS (MB) of each variable's
+    # evaluation. Where the peak cannot be reset, a variable's peak is the
+    # process's peak so far, so only the variables that raise it are told
+    # apart. Scans shared by several variables run before their variables,
+    # so are only in the process's peak (process_peak_mb)
+    def __init__(self):
+        self.peak = peak_rss_mb()
+        self.resettable = reset_peak_rss()
+        self.peaks = {}
+
+    def variable_started(self, name, query_type, query_args):
+        if self.resettable:
+            self.peak = max(self.peak, peak_rss_mb())
+            reset_peak_rss()
+
+    def variable_finished(self, name, query_type, query_args, stats):
+        self.peaks[name] = peak_rss_mb()
+        self.peak = max(self.peak, self.peaks[name])
+
+    def process_peak_mb(self):
+        return max(self.peak, peak_rss_mb())
+
+
+def run_case(fixtures_dir, key):
+    # Extracts study `key` from the tables in `fixtures_dir`
+    from study_factory import variable_groups
+
+    study = load_study(key)
+    groups = variable_groups()
+    started = time.perf_counter()
+    tables = scan_tables(ParquetSource(fixtures_dir), plan_scans([study]))
+    scan_seconds = time.perf_counter() - started
+    backend = LocalBackend(tables)
+    memory = PeakMemory()
+    backend.hooks = [memory]
+    started = time.perf_counter()
+    columns = backend.evaluate(study.covariate_definitions)
+    evaluate_seconds = time.perf_counter() - started
+    backend.hooks = []
+
+    variables = {}
+    group_totals = {}
+    for name, stats in backend.variable_stats.items():
+        group = groups.get(name, "other")
+        peak = memory.peaks[name]
+        variables[name] = {"group": group, "peak_rss_mb": peak, **stats}
+        totals = group_totals.setdefault(
+            group,
+            {"seconds": 0.0, "rows_scanned": 0, "peak_rss_mb": 0.0, "variables": 0},
+        )
+        totals["seconds"] += stats["seconds"]
+        totals["rows_scanned"] += stats["rows_scanned"]
+        totals["peak_rss_mb"] = max(totals["peak_rss_mb"], peak)
+        totals["variables"] += 1
+    return {
+        "patients": int(backend.size),
+        "population": int(columns["population"].astype(bool).sum()),
+        "scan_seconds": scan_seconds,
+        "evaluate_seconds": evaluate_seconds,
+        "wall_seconds": scan_seconds + evaluate_seconds,
+        "peak_rss_mb": memory.process_peak_mb(),
+        "groups": group_totals,
+        "variables": variables,
+    }
+
+
+def run_case_in_process(fixtures_dir, key):
+    # run_case in a new interpreter, so the peak RSS is the case's alone
+    code = (
+        "import json, sys\n"
+        "from extraction.benchmarks import run_case\n"
+        "with open(sys.argv[3], 'w') as f:\n"
+        "    json.dump(run_case(sys.argv[1], sys.argv[2]), f)\n"
+    )
+    analysis_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        path for path in (analysis_dir, environment.get("PYTHONPATH")) if path
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "result.json")
+        subprocess.run(
+            [sys.executable, "-c", code, fixtures_dir, key, path],
+            env=environment,
+            check=True,
+        )
+        with open(path) as f:
+            return json.load(f)
+
+
+def compare(results, baseline, threshold):
+    # Regressions of `results` against `baseline` (both keyed by scale, then
+    # study): groups more than `threshold` (a fraction) slower
+    regressions = []
+    for scale, studies in results.items():
+        for key, result in studies.items():
+            baseline_groups = baseline.get(scale, {}).get(key, {}).get("groups", {})
+            for group, totals in result["groups"].items():
+                if group not in baseline_groups:
+                    continue
+                before = baseline_groups[group]["seconds"]
+                after = totals["seconds"]
+                if after > before * (1 + threshold) and after - before > MINIMUM_SECONDS:
+                    regressions.append(
+                        {
+                            "scale": scale,
+                            "study": key,
+                            "group": group,
+                            "baseline_seconds": before,
+                            "seconds": after,
+                            "change": after / before - 1 if before else None,
+                        }
+                    )
+    return regressions
+
+
+def read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(data, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp_path, path)
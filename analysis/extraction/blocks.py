@@ -0,0 +1,166 @@
+# Block-compressed CSV output with a patient index
+# A csv.gz written by gzip is a single deflate stream: it is compressed on
+# one core and can only be read from its start. Block-compressed, the CSV
+# is written as a series of independent gzip members, each holding whole
+# rows (at most BLOCK_SIZE bytes of them), in the BGZF layout: each member
+# records its compressed size in a "BC" extra field and the file ends with
+# an empty member, so it is still read by any gzip reader. The blocks of
+# each write are compressed concurrently (zlib releases the GIL while it
+# compresses), and an index written next to the output (see index_path)
+# gives the first and last patient_id, the number of rows, and the offset
+# and size in the file of each block of rows. The header row is a block of
+# its own before the indexed blocks. With the index, a reader decompresses
+# the blocks in parallel, or only the blocks of a patient range (see
+# read_blocks); the rows are in patient_id order, as they are extracted.
+
+import io
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from extraction.pool import bounded_map
+
+# Uncompressed bytes of a block, so that its compressed size fits BGZF's
+# 16-bit block size field
+BLOCK_SIZE = 0xFF00
+
+COMPRESSION_LEVEL = 6
+
+# Bytes of a block's gzip header (with the BC extra field) and trailer
+HEADER_SIZE = 18
+TRAILER_SIZE = 8
+
+# The empty block that ends a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+INDEX_COLUMNS = ["first_patient_id", "last_patient_id", "rows", "offset", "size"]
+
+
+def index_path(path):
+    return f"{path}.index.csv"
+
+
+def compress_block(data):
+    # One gzip member holding `data`, with its size in the BC extra field
+    deflated = zlib.compress(data, COMPRESSION_LEVEL, wbits=-15)
+    if HEADER_SIZE + len(deflated) + TRAILER_SIZE > 0x10000:
+        # Incompressible data is stored, which always fits
+        deflated = zlib.compress(data, 0, wbits=-15)
+    size = HEADER_SIZE + len(deflated) + TRAILER_SIZE
+    header = struct.pack(
+        "<4BI2BH2BHH", 0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, ord("B"), ord("C"), 2, size - 1
+    )
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def decompress_block(block):
+    return zlib.decompress(block[HEADER_SIZE:-TRAILER_SIZE], wbits=-15)
+
+
+def block_size(header):
+    # Size of the block starting with `header` (its first HEADER_SIZE bytes)
+    return struct.unpack("<H", header[16:18])[0] + 1
+
+
+def row_blocks(data, rows):
+    # The blocks of `data` (`rows` CSV rows), as (first row, stop row, start
+    # byte, stop byte), each of whole rows and at most BLOCK_SIZE bytes
+    ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n")) + 1
+    if len(ends) != rows:
+        raise ValueError(f"Expected {rows} CSV rows, found {len(ends)} lines")
+    ranges = []
+    row = 0
+    start = 0
+    while row < rows:
+        stop_row = int(np.searchsorted(ends, start + BLOCK_SIZE, side="right"))
+        if stop_row == row:
+            raise ValueError(f"CSV row {row} is longer than {BLOCK_SIZE} bytes")
+        ranges.append((row, stop_row, start, int(ends[stop_row - 1])))
+        row = stop_row
+        start = int(ends[stop_row - 1])
+    return ranges
+
+
+class BlockWriter:
+    # Writes CSV text to `path` as blocks compressed by up to `threads`
+    # threads, and the index of the blocks when closed
+
+    def __init__(self, path, threads=1):
+        self.path = path
+        self.threads = threads
+        self.file = open(path, "wb")
+        self.offset = 0
+        self.index = []
+
+    def write_header(self, text):
+        self.write_block(compress_block(text.encode()))
+
+    def write_rows(self, text, patient_ids):
+        # `text` holds one CSV row for each of `patient_ids`, in order
+        data = text.encode()
+        ranges = row_blocks(data, len(patient_ids))
+        view = memoryview(data)
+        blocks = bounded_map(
+            compress_block,
+            (view[start:stop] for _, _, start, stop in ranges),
+            self.threads,
+        )
+        for (first_row, stop_row, _, _), block in zip(ranges, blocks):
+            self.index.append(
+                (
+                    int(patient_ids[first_row]),
+                    int(patient_ids[stop_row - 1]),
+                    stop_row - first_row,
+                    self.offset,
+                    len(block),
+                )
+            )
+            self.write_block(block)
+
+    def write_block(self, block):
+        self.file.write(block)
+        self.offset += len(block)
+
+    def close(self):
+        self.file.write(EOF_BLOCK)
+        self.file.close()
+        pd.DataFrame(self.index, columns=INDEX_COLUMNS).to_csv(
+            index_path(self.path), index=False
+        )
+
+
+def read_index(path):
+    return pd.read_csv(index_path(path))
+
+
+def read_blocks(
+    path, first_patient_id=None, stop_patient_id=None, threads=1, **read_csv_options
+):
+    # The rows of a block-compressed CSV with patient_ids from
+    # `first_patient_id` up to (not including) `stop_patient_id`, either
+    # unbounded if None, decompressing only the blocks of those patients on
+    # up to `threads` threads. Column types are inferred from the rows read
+    # unless given (as `dtype` of pandas.read_csv)
+    index = read_index(path)
+    if first_patient_id is not None:
+        index = index[index["last_patient_id"] >= first_patient_id]
+    if stop_patient_id is not None:
+        index = index[index["first_patient_id"] < stop_patient_id]
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+        header += f.read(block_size(header) - HEADER_SIZE)
+        blocks = [header]
+        for offset, size in zip(index["offset"], index["size"]):
+            f.seek(offset)
+            blocks.append(f.read(size))
+    data = b"".join(bounded_map(decompress_block, blocks, threads))
+    frame = pd.read_csv(io.BytesIO(data), **read_csv_options)
+    patient_ids = frame["patient_id"].to_numpy().astype("int64")
+    rows = np.ones(len(frame), dtype=bool)
+    if first_patient_id is not None:
+        rows &= patient_ids >= first_patient_id
+    if stop_patient_id is not None:
+        rows &= patient_ids < stop_patient_id
+    return frame[rows].reset_index(drop=True)
@@ -0,0 +1,171 @@
+# Per-variable result cache
+# Each evaluated covariate is stored under a key hashed from its query (type
+# and arguments, with index dates already substituted and codelists by their
+# codes), the keys of the covariates it refers to (see dependencies.py) and a
+# snapshot of the source tables. After a change to the study definitions
+# only the changed variables, and those that depend on them, are evaluated
+# again; the other columns are read from the cache and spliced into the
+# output in definition order.
+# Keys also hash the source of the extraction package, so entries written
+# by an earlier version of the evaluation are never read.
+# Entries are written to a temporary file first so concurrent runs never
+# read a partial entry; unreadable entries are evaluated again. Once the
+# entries take more than `max_bytes`, the least recently used are removed.
+
+import functools
+import glob
+import hashlib
+import os
+import pickle
+
+from extraction.dependencies import (
+    is_codelist,
+    topological_order,
+    variable_dependencies,
+)
+
+# Bump when the layout of the entries changes (changes to the evaluation
+# are covered by source_hash)
+CACHE_VERSION = 1
+
+# Default bound on the size of the cache directory
+MAX_CACHE_BYTES = 2 * 1024**3
+
+EXTRACTION_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules outside the extraction package that evaluation depends on
+SOURCE_FILES = [os.path.join(os.path.dirname(EXTRACTION_DIR), "codelist_index.py")]
+
+# Arguments that only affect how a column is written, not its values
+IGNORED_ARGS = ("return_expectations", "hidden", "date_format", "include_date_of_match")
+
+
+def fingerprint(value):
+    # Canonical representation of an argument value (dict order ignored,
+    # codelists by their system and codes)
+    if isinstance(value, dict):
+        return (
+            "dict",
+            tuple(sorted((repr(key), fingerprint(item)) for key, item in value.items())),
+        )
+    if is_codelist(value):
+        return ("codelist", value.system, tuple(fingerprint(code) for code in value))
+    if isinstance(value, (list, tuple)):
+        return ("list", tuple(fingerprint(item) for item in value))
+    return repr(value)
+
+
+@functools.lru_cache(maxsize=None)
+def source_hash():
+    # Hash of the source of the extraction package (tests excluded)
+    paths = sorted(glob.glob(os.path.join(EXTRACTION_DIR, "*.py"))) + SOURCE_FILES
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def query_fingerprint(query_type, query_args):
+    query_args = {
+        key: value for key, value in query_args.items() if key not in IGNORED_ARGS
+    }
+    return (query_type, fingerprint(query_args))
+
+
+class VariableCache:
+    def __init__(self, directory, snapshot, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.snapshot = snapshot
+        self.max_bytes = max_bytes
+        # Size of the entries, counted on the first store
+        self.used_bytes = None
+
+    def keys(self, covariate_definitions):
+        # Cache key of each covariate, by name
+        keys = {}
+        dependencies = variable_dependencies(covariate_definitions)
+        for name in topological_order(dependencies):
+            query_type, query_args = covariate_definitions[name]
+            key = hashlib.sha1()
+            key.update(
+                repr(
+                    (
+                        CACHE_VERSION,
+                        source_hash(),
+                        self.snapshot,
+                        query_fingerprint(query_type, query_args),
+                        [(other, keys[other]) for other in dependencies[name]],
+                    )
+                ).encode()
+            )
+            keys[name] = key.hexdigest()
+        return keys
+
+    def scoped_key(self, key, scope):
+        # Key of a covariate evaluated only for the patients selected by the
+        # covariate with key `scope` (see LocalBackend.population_pushdown)
+        return hashlib.sha1(f"{key}:{scope}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        # Returns the stored entry or None if there is no usable entry
+        try:
+            with open(self.path(key), "rb") as f:
+                entry = pickle.load(f)
+            # The modification time orders entries by last use for eviction
+            os.utime(self.path(key))
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+            return None
+
+    def store(self, key, entry):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.used_bytes is None:
+            self.used_bytes = sum(size for _, size, _ in self.entries())
+        else:
+            self.used_bytes += os.path.getsize(path)
+        if self.used_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        # (modification time, size, path) of each entry
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.pkl")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        # Removes the least recently used entries until the cache holds at
+        # most three quarters of `max_bytes`, so eviction runs once per
+        # many stores
+        entries = sorted(self.entries())
+        self.used_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.used_bytes <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.used_bytes -= size
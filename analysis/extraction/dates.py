@@ -0,0 +1,146 @@
+# Date handling for the local extraction layer
+# Dates are held as numpy datetime64[D] arrays, with NaT for missing values,
+# so that window filters and comparisons stay vectorised. Missing dates
+# compare as False, which matches the NULL semantics of the TPP backend.
+
+import datetime
+import re
+
+import numpy as np
+import pandas as pd
+
+NAT = np.datetime64("NaT", "D")
+
+# Open-ended registrations and addresses are recorded with this end date
+# (as in the TPP RegistrationHistory and PatientAddress tables)
+OPEN_END_DATE = np.datetime64("9999-12-31", "D")
+
+# Column-relative date expressions left in place by cohortextractor,
+# e.g. "covid_vax_date_1 + 14 days"
+DATE_REFERENCE_REGEX = re.compile(
+    r"^(?P<name>[A-Za-z][A-Za-z0-9_]*)"
+    r"(?:(?P<operator>[+-])(?P<quantity>\d+)(?P<units>[A-Za-z]+))?$"
+)
+
+DATE_FORMAT_LENGTHS = {None: 4, "YYYY": 4, "YYYY-MM": 7, "YYYY-MM-DD": 10}
+
+
+def is_iso_date(value):
+    try:
+        datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def to_date(value):
+    # Single ISO date string (or None) to a datetime64[D] scalar
+    if value is None or value == "":
+        return NAT
+    return np.datetime64(value, "D")
+
+
+def to_date_array(values):
+    # Any array-like of dates/ISO strings to datetime64[D], missing as NaT
+    return pd.to_datetime(pd.Series(values), errors="coerce").to_numpy(
+        dtype="datetime64[D]"
+    )
+
+
+def add_to_dates(dates, quantity, units):
+    # Vectorised version of cohortextractor's date arithmetic; month and year
+    # arithmetic clamps to the end of the month (as SQL Server's DATEADD does)
+    units = units.rstrip("s")
+    if units == "day":
+        return dates + np.timedelta64(quantity, "D")
+    if units == "year":
+        quantity = quantity * 12
+    elif units != "month":
+        raise ValueError(f"Unknown date unit: {units}")
+    months = dates.astype("datetime64[M]")
+    day_offset = dates - months.astype("datetime64[D]")
+    new_months = months + np.timedelta64(quantity, "M")
+    month_length = (new_months + 1).astype("datetime64[D]") - new_months.astype(
+        "datetime64[D]"
+    )
+    day_offset = np.minimum(day_offset, month_length - np.timedelta64(1, "D"))
+    return new_months.astype("datetime64[D]") + day_offset
+
+
+def parse_step(step):
+    # A series step such as "1 month" or "7 days" as (quantity, units), with
+    # weeks as days
+    match = re.match(r"^(\d+)\s*(day|week|month|year)s?$", step.strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid step: {step}")
+    quantity, units = int(match.group(1)), match.group(2)
+    if units == "week":
+        return quantity * 7, "days"
+    return quantity, f"{units}s"
+
+
+def date_series(start, end, step):
+    # ISO dates from `start` to `end` (inclusive) every `step`, with the date
+    # one step after the last date. Series of months or years must start on
+    # day 1 to 28: the wave variables offset the index date by months
+    # ("index_date - 3 months"), which cohortextractor rejects for dates
+    # such as 31 May, so every index date must fall on a day that all
+    # months have
+    quantity, units = parse_step(step)
+    start = to_date(start)
+    day = (start - start.astype("datetime64[M]")).astype("int64") + 1
+    if units in ("months", "years") and day > 28:
+        raise ValueError(
+            f"A series stepping by {units} must start on day 1 to 28 of a "
+            f"month, not {start} (later days do not exist in every month)"
+        )
+    dates = []
+    while True:
+        date = add_to_dates(np.array([start]), quantity * len(dates), units)[0]
+        dates.append(str(date))
+        if date > to_date(end):
+            return dates[:-1], dates[-1]
+
+
+def parse_date_reference(expression, column_names):
+    # Returns (column_name, quantity, units) for expressions referring to
+    # another column, or None for ISO date literals
+    if expression is None:
+        return None
+    match = DATE_REFERENCE_REGEX.match(expression.replace(" ", ""))
+    if not match or match.group("name") not in column_names:
+        return None
+    quantity = int(match.group("quantity") or 0)
+    if match.group("operator") == "-":
+        quantity = -quantity
+    return match.group("name"), quantity, match.group("units") or "days"
+
+
+def resolve_date(expression, columns, size):
+    # Evaluates a date argument to a datetime64[D] array of length `size`
+    # `columns` maps already-evaluated column names to their date arrays
+    reference = parse_date_reference(expression, columns)
+    if reference is None:
+        return np.full(size, to_date(expression), dtype="datetime64[D]")
+    name, quantity, units = reference
+    dates = columns[name]
+    if quantity:
+        dates = add_to_dates(dates, quantity, units)
+    return dates
+
+
+def format_dates(dates, date_format):
+    # Truncates dates to `date_format` as strings, with "" for missing dates
+    length = DATE_FORMAT_LENGTHS[date_format]
+    formatted = np.datetime_as_string(dates, unit="D").astype(f"<U{length}")
+    formatted[np.isnat(dates)] = ""
+    return formatted.astype(object)
+
+
+def truncate_dates(dates, date_format):
+    # Truncates dates to the start of the year/month for `date_format`, as
+    # datetime64[D] (for typed output, where dates are not strings)
+    unit = {4: "Y", 7: "M", 10: "D"}[DATE_FORMAT_LENGTHS[date_format]]
+    if unit == "D":
+        return dates
+    return dates.astype(f"datetime64[{unit}]").astype("datetime64[D]")
@@ -0,0 +1,171 @@
+# Dependency graph of covariates
+# Variables refer to other variables by name: in satisfying/categorised_as
+# expressions (e.g. bp_ht uses bp_sys and bp_dia), in column-relative date
+# bounds ("covid_vax_date_1 + 14 days") and as the source of value_from.
+# References are found by scanning the string arguments of each covariate
+# (nested column definitions included) for the names of the other
+# covariates. The resulting graph gives an evaluation order in which every
+# variable follows the variables it refers to, the levels of variables that
+# can be evaluated concurrently, and the variables that can be pruned because
+# neither the outputs nor any other needed variable refers to them.
+
+import re
+
+NAME_REGEX = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def is_codelist(value):
+    return isinstance(value, (list, tuple)) and hasattr(value, "system")
+
+
+def argument_strings(value):
+    # Every string in a (nested) argument value, codelists excluded
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from argument_strings(key)
+            yield from argument_strings(item)
+    elif isinstance(value, (list, tuple)) and not is_codelist(value):
+        for item in value:
+            yield from argument_strings(item)
+
+
+def variable_references(query_args, names):
+    # Names in `names` referred to by a covariate's arguments, in order of
+    # first reference
+    references = {}
+    for key, value in query_args.items():
+        # `returning` names a column of the source table, not a covariate
+        if key in ("return_expectations", "returning"):
+            continue
+        for string in argument_strings(value):
+            for token in NAME_REGEX.findall(string):
+                if token in names:
+                    references[token] = True
+    return list(references)
+
+
+def flatten_variables(variables):
+    # Variables as passed to StudyDefinition, with the columns defined in
+    # `extra_columns` (of satisfying/categorised_as) pulled out to the top
+    # level as StudyDefinition does. Returns the flattened definitions (the
+    # extra columns before the variable defining them) and the top-level
+    # variable defining each name
+    flattened = {}
+    owners = {}
+
+    def add(name, definition, owner):
+        query_type, query_args = definition
+        extra_columns = query_args.get("extra_columns") or {}
+        for extra_name, extra_definition in extra_columns.items():
+            add(extra_name, extra_definition, owner)
+        query_args = {
+            key: value for key, value in query_args.items() if key != "extra_columns"
+        }
+        flattened.setdefault(name, (query_type, query_args))
+        owners.setdefault(name, owner)
+
+    for name, definition in variables.items():
+        add(name, definition, name)
+    return flattened, owners
+
+
+def variable_dependencies(covariate_definitions):
+    # Direct references of each covariate, by name
+    names = set(covariate_definitions)
+    return {
+        name: [
+            other
+            for other in variable_references(query_args, names)
+            if other != name
+        ]
+        for name, (_, query_args) in covariate_definitions.items()
+    }
+
+
+def topological_levels(dependencies):
+    # Names grouped into levels, where every name only depends on names in
+    # earlier levels; within a level names keep their definition order
+    levels = []
+    placed = set()
+    remaining = list(dependencies)
+    while remaining:
+        level = [
+            name
+            for name in remaining
+            if all(other in placed for other in dependencies[name])
+        ]
+        if not level:
+            raise ValueError(f"Circular references between: {', '.join(remaining)}")
+        levels.append(level)
+        placed.update(level)
+        remaining = [name for name in remaining if name not in placed]
+    return levels
+
+
+def topological_order(dependencies):
+    return [name for level in topological_levels(dependencies) for name in level]
+
+
+def required_variables(dependencies, outputs):
+    # The names in `outputs` and every name they depend on, directly or not
+    required = set()
+    pending = [name for name in outputs if name in dependencies]
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(dependencies[name])
+    return required
+
+
+def extra_column(variables, name):
+    # Definition of the extra column `name`, searching nested definitions
+    for query_type, query_args in variables.values():
+        extra_columns = query_args.get("extra_columns") or {}
+        if name in extra_columns:
+            return extra_columns[name]
+        found = extra_column(extra_columns, name)
+        if found is not None:
+            return found
+    return None
+
+
+def prune_variables(variables, outputs):
+    # Drops the variables (as passed to StudyDefinition) that are not needed
+    # for `outputs`; the population is always needed. Extra columns of a
+    # dropped variable that other variables still refer to are moved to the
+    # extra columns of the first variable referring to them, so they stay
+    # hidden
+    flattened, owners = flatten_variables(variables)
+    dependencies = variable_dependencies(flattened)
+    required = required_variables(dependencies, list(outputs) + ["population"])
+    kept = {name: variables[name] for name in variables if name in required}
+
+    def destination(name):
+        # Top-level variable that will hold the extra column `name`
+        if owners[name] in kept:
+            return owners[name]
+        consumer = next(
+            other
+            for other in topological_order(dependencies)
+            if other in required and name in dependencies[other]
+        )
+        return destination(consumer)
+
+    moved = {}
+    for name in flattened:
+        if name in required and owners[name] not in kept:
+            moved.setdefault(destination(name), {})[name] = extra_column(
+                variables, name
+            )
+    for name, extra_columns in moved.items():
+        query_type, query_args = kept[name]
+        query_args = dict(query_args)
+        query_args["extra_columns"] = {
+            **(query_args.get("extra_columns") or {}),
+            **extra_columns,
+        }
+        kept[name] = (query_type, query_args)
+    return kept
@@ -0,0 +1,354 @@
+# Vectorised dummy data from the return_expectations of a study definition
+# Follows cohortextractor's make_df_from_expectations (each column from its
+# return_expectations merged over the study's default_expectations: date
+# ranges and rates, incidence, category ratios, int and float distributions;
+# value_from dates use the expectations of their source), but draws every
+# column with numpy for a chunk of patients at a time, so cohorts of tens of
+# millions of patients can be generated and written in bounded memory.
+# Columns are generated in the topological order of the dependency graph
+# (see dependencies.py), hidden columns included, so that they agree with
+# each other as extracted columns would:
+# - dates are drawn within their `between` bounds, per patient where a bound
+#   refers to another column (each vaccination dose at least 14 days after
+#   the previous one); patients whose window is empty have no date
+# - columns referring to other columns (value_from, column-relative dates)
+#   are only present where those columns are, and a source is empty where
+#   its date of match is
+# - categorised_as and satisfying columns (rrt_cat from dialysis_date and
+#   kidney_transplant_date, the population) are evaluated from their inputs
+#   with the expression evaluator of the backend; only those with inputs that
+#   have no expectations to draw from fall back to their category ratios
+# Only patients in the population are written, so each chunk is drawn with
+# enough extra patients for the population's share seen so far.
+# Incidence is applied per patient (each value is present with probability
+# `incidence`) rather than as an exact count. Patients are numbered from 1.
+# Each chunk has its own seed, derived from the study's seed, so a cohort is
+# reproducible for a given seed and chunk size.
+
+import functools
+import os
+import zlib
+
+import cohortextractor
+import numpy as np
+import pandas as pd
+from cohortextractor.study_definition import merge
+
+from extraction.backend import (
+    EMPTY_VALUES,
+    categorise,
+    coerce_column,
+    output_columns,
+    output_frame,
+)
+from extraction.dates import NAT, resolve_date, to_date
+from extraction.dependencies import topological_order, variable_dependencies
+from extraction.output import CohortWriter, is_typed_format
+
+# Scale of cohortextractor's exponential_increase date distribution, as a
+# fraction of the date range
+EXPONENTIAL_SCALE = 0.1
+
+
+def study_seed(seed, name):
+    # Seed for one study (e.g. a wave), so that each wave differs
+    return np.random.SeedSequence([seed, zlib.crc32(name.encode())])
+
+
+@functools.lru_cache(maxsize=None)
+def population_age_probabilities(max_age=110):
+    # Probability of each age from 0 to max_age - 1, from the UK population
+    # bands shipped with cohortextractor (as its population_ages)
+    bands = pd.read_csv(
+        os.path.join(
+            os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv"
+        )
+    )
+    ends = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    counts = bands["range"].str.replace(",", "").astype(int).to_numpy()
+    ages = np.arange(max_age)
+    probabilities = counts[np.searchsorted(ends, ages)] / counts.sum() / 5
+    # Ensure the probabilities add up to 1 by trimming the largest
+    probabilities[np.argmax(probabilities)] -= probabilities.sum() - 1
+    return probabilities
+
+
+def sample_dates(rng, earliest, latest, rate):
+    # Dates between `earliest` and `latest` (datetime64[D] arrays, one window
+    # per patient) counted back from `latest`: uniform over the window, or
+    # increasingly common towards `latest` (exponential_increase)
+    elapsed_days = (latest - earliest).astype("int64")
+    # Empty windows (and NaT, the smallest int64) give `latest`
+    elapsed_days = np.maximum(elapsed_days, 0)
+    size = len(latest)
+    if rate == "exponential_increase":
+        # Exponential distribution truncated to the window, by inversion
+        limit = 1 - np.exp(-1 / EXPONENTIAL_SCALE)
+        fractions = -EXPONENTIAL_SCALE * np.log1p(-rng.random(size) * limit)
+        days = (fractions * elapsed_days).astype("int64")
+    elif rate in ("uniform", "universal"):
+        days = (rng.random(size) * (elapsed_days + 1)).astype("int64")
+    else:
+        raise ValueError(
+            "Only exponential_increase and uniform distributions currently supported"
+        )
+    return latest - days.astype("timedelta64[D]")
+
+
+def sample_categories(rng, size, ratios):
+    # Indices into the categories of `ratios`, drawn in proportion
+    weights = np.cumsum(np.array(list(ratios.values()), dtype="float64"))
+    codes = np.searchsorted(weights / weights[-1], rng.random(size), side="right")
+    return np.minimum(codes, len(weights) - 1)
+
+
+def sample_ints(rng, size, distribution):
+    if distribution["distribution"] == "normal":
+        return rng.normal(distribution["mean"], distribution["stddev"], size).astype(
+            "int64"
+        )
+    if distribution["distribution"] == "poisson":
+        return rng.poisson(distribution["mean"], size).astype("int64")
+    if distribution["distribution"] == "population_ages":
+        probabilities = population_age_probabilities()
+        return rng.choice(len(probabilities), size=size, p=probabilities)
+    raise ValueError(
+        "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+    )
+
+
+def sample_floats(rng, size, distribution):
+    if distribution["distribution"] == "normal":
+        return rng.normal(distribution["mean"], distribution["stddev"], size)
+    raise ValueError("Only `normal` distributions currently supported for floats")
+
+
+def category_column(codes, present, ratios, column_type, empty_value):
+    # Values of the drawn categories as `column_type`; str columns are kept
+    # as categoricals, with empty categories (and absent values) as missing
+    categories = np.array(list(ratios), dtype=object)
+    if column_type == "str":
+        mapping, labels = pd.factorize(coerce_column(categories, "str", ""))
+        labels = pd.Index(labels)
+        if "" in labels:
+            empty = labels.get_loc("")
+            mapping = np.where(mapping == empty, -1, mapping - (mapping > empty))
+            labels = labels.delete(empty)
+        codes = np.where(present, mapping[codes], -1)
+        return pd.Categorical.from_codes(codes, categories=labels)
+    values = coerce_column(categories, column_type, empty_value)[codes]
+    values[~present] = empty_value
+    return values
+
+
+def expression_column(values):
+    # Categorical str columns as the object arrays the evaluator expects
+    if isinstance(values, pd.Categorical):
+        values = np.asarray(values, dtype=object)
+        values[pd.isna(values)] = ""
+    return values
+
+
+class DummyGenerator:
+    def __init__(self, study, seed):
+        self.covariate_definitions = study.covariate_definitions
+        self.default_expectations = study.default_expectations or {}
+        self.seed = seed
+        self.columns = [
+            name
+            for name, (_, query_args) in self.covariate_definitions.items()
+            if name != "population" and not query_args.get("hidden")
+        ]
+        self.dependencies = variable_dependencies(self.covariate_definitions)
+        # Date column (value_from) of each source, drawn with the source
+        self.date_columns = {}
+        for name, (query_type, query_args) in self.covariate_definitions.items():
+            if query_type == "value_from" and query_args["column_type"] == "date":
+                self.date_columns.setdefault(query_args["source"], name)
+        # Columns that can be drawn or evaluated, and the categorised_as
+        # columns evaluated from their inputs
+        self.available = set()
+        self.evaluated = set()
+        self.order = []
+        for name in topological_order(self.dependencies):
+            query_type, _ = self.covariate_definitions[name]
+            inputs_available = all(
+                other in self.available for other in self.dependencies[name]
+            )
+            if query_type == "categorised_as" and inputs_available:
+                self.evaluated.add(name)
+            elif query_type == "categorised_as" or not (
+                inputs_available and self.can_sample(name)
+            ):
+                # Drawn from its own expectations, if it is needed at all
+                if name in self.columns:
+                    self.order.append(name)
+                continue
+            self.available.add(name)
+            self.order.append(name)
+
+    def expectations(self, name):
+        query_type, query_args = self.covariate_definitions[name]
+        if query_type == "value_from" and query_args["column_type"] == "date":
+            query_args = self.covariate_definitions[query_args["source"]][1]
+        return merge(self.default_expectations, query_args.get("return_expectations") or {})
+
+    def column_type(self, name):
+        query_type, query_args = self.covariate_definitions[name]
+        if query_type == "categorised_as" and query_args["column_type"] == "date":
+            return "str"
+        return query_args["column_type"]
+
+    def empty_value(self, name):
+        if self.covariate_definitions[name][1].get("returning") == (
+            "index_of_multiple_deprivation"
+        ):
+            return -1
+        return EMPTY_VALUES[self.column_type(name)]
+
+    def can_sample(self, name):
+        # Whether the expectations of `name` describe values of its type
+        column_type = self.column_type(name)
+        kwargs = self.expectations(name)
+        if column_type == "date" or name in self.date_columns:
+            dates = kwargs.get("date") or {}
+            if not {"earliest", "latest"} <= set(dates):
+                return False
+        if column_type in ("date", "bool") or "category" in kwargs:
+            return True
+        return column_type in ("int", "float") and column_type in kwargs
+
+    def generate(self, rng, size):
+        # Raw columns (as LocalBackend.evaluate returns) for the patients in
+        # the population out of `size` drawn, and the number of those
+        columns = {}
+        present = {}
+        for name in self.order:
+            if name in columns:
+                # A date of match, drawn with its source
+                continue
+            if name in self.evaluated:
+                columns[name] = self.evaluate_column(size, name, columns)
+            else:
+                columns[name], present[name] = self.generate_column(
+                    rng, size, name, columns, present
+                )
+        if "population" not in self.evaluated:
+            return {name: columns[name] for name in self.columns}, size
+        population = columns["population"].astype(bool)
+        return (
+            {name: columns[name][population] for name in self.columns},
+            int(population.sum()),
+        )
+
+    def evaluate_column(self, size, name, columns):
+        query_type, query_args = self.covariate_definitions[name]
+        inputs = {
+            other: expression_column(columns[other]) for other in self.dependencies[name]
+        }
+        empty_values = {other: self.empty_value(other) for other in inputs}
+        values = categorise(query_args["category_definitions"], inputs, empty_values, size)
+        return coerce_column(values, self.column_type(name), self.empty_value(name))
+
+    def generate_column(self, rng, size, name, columns, present):
+        query_type, query_args = self.covariate_definitions[name]
+        column_type = self.column_type(name)
+        kwargs = self.expectations(name)
+        rate = kwargs.get("rate", "exponential_increase")
+        if query_type == "value_from" and column_type == "date":
+            is_present = present[query_args["source"]].copy()
+        elif rate == "universal":
+            is_present = np.ones(size, dtype=bool)
+        else:
+            is_present = rng.random(size) < kwargs["incidence"]
+        # Only present where the columns it refers to are
+        for other in self.dependencies[name]:
+            if other in present:
+                is_present &= present[other]
+
+        if column_type == "date" or name in self.date_columns:
+            dates, is_present = self.generate_dates(
+                rng, size, name, kwargs, columns, is_present
+            )
+            if column_type == "date":
+                return dates, is_present
+            columns[self.date_columns[name]] = dates
+            present[self.date_columns[name]] = is_present
+        if "category" in kwargs:
+            ratios = kwargs["category"]["ratios"]
+            codes = sample_categories(rng, size, ratios)
+            return (
+                category_column(
+                    codes, is_present, ratios, column_type, self.empty_value(name)
+                ),
+                is_present,
+            )
+        if column_type == "bool":
+            return is_present.copy(), is_present
+        if column_type == "int" and "int" in kwargs:
+            values = sample_ints(rng, size, kwargs["int"])
+        elif column_type == "float" and "float" in kwargs:
+            values = sample_floats(rng, size, kwargs["float"])
+        else:
+            raise ValueError(
+                f"Column definition {name} does not return expected type {column_type}"
+            )
+        values[~is_present] = self.empty_value(name)
+        return values, is_present
+
+    def generate_dates(self, rng, size, name, kwargs, columns, is_present):
+        # Dates of `name` within both its expected date range and its
+        # `between` bounds; patients with an empty window have no date
+        if "date" not in kwargs or not {"earliest", "latest"} <= set(kwargs["date"]):
+            raise ValueError(f"{name} must define a date expectation")
+        earliest = np.full(size, to_date(kwargs["date"]["earliest"]))
+        latest = np.full(size, to_date(kwargs["date"]["latest"]))
+        start, end = self.covariate_definitions[name][1].get("between") or (None, None)
+        # NaT bounds (a referenced date that is missing) propagate
+        if start is not None:
+            earliest = np.maximum(earliest, resolve_date(start, columns, size))
+        if end is not None:
+            latest = np.minimum(latest, resolve_date(end, columns, size))
+        is_present = is_present & (earliest <= latest)
+        dates = sample_dates(rng, earliest, latest, kwargs.get("rate", "exponential_increase"))
+        dates[~is_present] = NAT
+        return dates, is_present
+
+    def chunks(self, population_size, chunk_size):
+        # Raw columns (with patient_id) for each chunk of patients in the
+        # population; each chunk draws enough patients for the share of the
+        # population so far, and any extra patients are dropped
+        written = 0
+        drawn = 0
+        while written < population_size:
+            size = min(chunk_size, population_size - written)
+            if drawn:
+                size = min(chunk_size, -(-size * drawn // written) + 100)
+            rng = np.random.default_rng(self.seed.spawn(1)[0])
+            columns, count = self.generate(rng, size)
+            drawn += size
+            count = min(count, population_size - written)
+            if count == 0 and written == 0:
+                raise ValueError("No dummy patients satisfy the population definition")
+            columns = {name: values[:count] for name, values in columns.items()}
+            patient_ids = np.arange(written + 1, written + count + 1, dtype="int64")
+            written += count
+            yield patient_ids, columns
+
+
+def write_dummy_cohort(study, path, population_size, seed, chunk_size=1_000_000):
+    # Generates and writes the study's dummy cohort one chunk at a time
+    # Typed formats are written from the arrays, without building a frame
+    output_function = output_columns if is_typed_format(path) else output_frame
+    generator = DummyGenerator(study, seed)
+    with CohortWriter(path, study.covariate_definitions) as writer:
+        for patient_ids, columns in generator.chunks(population_size, chunk_size):
+            writer.write(
+                output_function(
+                    patient_ids,
+                    columns,
+                    study.covariate_definitions,
+                    typed=is_typed_format(path),
+                )
+            )
+    return path
@@ -0,0 +1,246 @@
+# Evaluation of categorised_as / satisfying expressions
+# Supports the same limited SQL dialect as cohortextractor: AND, OR, NOT,
+# comparisons (= != < > <= >=), + - * /, numbers, quoted strings, brackets
+# and column names. A column name that is not part of a comparison or
+# arithmetic is treated as a boolean, true when the column is not empty.
+
+import functools
+import re
+
+import numpy as np
+
+TOKEN_REGEX = re.compile(
+    r"""
+    \s*(?:
+      (?P<number>\d+(?:\.\d+)?)
+    | (?P<string>'[^']*'|"[^"]*")
+    | (?P<comparison>>=|<=|!=|=|<|>)
+    | (?P<operator>[-+*/])
+    | (?P<bracket>[()])
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+
+class InvalidExpressionError(ValueError):
+    pass
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_REGEX.match(expression, position)
+        if not match or match.end() == position:
+            raise InvalidExpressionError(
+                f"Cannot parse expression at {expression[position:]!r}"
+            )
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.upper() in KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    # Recursive descent parser producing a tree of tuples:
+    # ("or", a, b), ("and", a, b), ("not", a), ("compare", op, a, b),
+    # ("arith", op, a, b), ("neg", a), ("name", x), ("literal", x)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() != (None, None):
+            raise InvalidExpressionError(f"Unexpected token: {self.peek()[1]}")
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        if self.peek()[0] == "comparison":
+            operator = self.take()[1]
+            node = ("compare", operator, node, self.parse_sum())
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while self.peek() in (("operator", "+"), ("operator", "-")):
+            operator = self.take()[1]
+            node = ("arith", operator, node, self.parse_product())
+        return node
+
+    def parse_product(self):
+        node = self.parse_factor()
+        while self.peek() in (("operator", "*"), ("operator", "/")):
+            operator = self.take()[1]
+            node = ("arith", operator, node, self.parse_factor())
+        return node
+
+    def parse_factor(self):
+        kind, value = self.take()
+        if kind == "number":
+            return ("literal", float(value) if "." in value else int(value))
+        if kind == "string":
+            return ("literal", value[1:-1])
+        if kind == "name":
+            return ("name", value)
+        if (kind, value) == ("operator", "-"):
+            return ("neg", self.parse_factor())
+        if (kind, value) == ("bracket", "("):
+            node = self.parse_or()
+            if self.take() != ("bracket", ")"):
+                raise InvalidExpressionError("Unbalanced brackets")
+            return node
+        raise InvalidExpressionError(f"Unexpected token: {value}")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_expression(expression):
+    return Parser(tokenize(expression)).parse()
+
+
+def names_in_expression(expression):
+    # Column names referenced by an expression (used for dependency analysis)
+    names = set()
+    stack = [parse_expression(expression)]
+    while stack:
+        node = stack.pop()
+        if node[0] == "name":
+            names.add(node[1])
+        elif node[0] != "literal":
+            stack.extend(child for child in node[1:] if isinstance(child, tuple))
+    return names
+
+
+def evaluate_expression(expression, columns, empty_values):
+    # Evaluates `expression` over `columns` (name -> array), returning a
+    # boolean array. `empty_values` gives the falsey value for each column.
+    evaluator = Evaluator(columns, empty_values)
+    return evaluator.truth(parse_expression(expression))
+
+
+class Evaluator:
+    def __init__(self, columns, empty_values):
+        self.columns = columns
+        self.empty_values = empty_values
+
+    def truth(self, node):
+        kind = node[0]
+        if kind == "or":
+            return self.truth(node[1]) | self.truth(node[2])
+        if kind == "and":
+            return self.truth(node[1]) & self.truth(node[2])
+        if kind == "not":
+            return ~self.truth(node[1])
+        if kind == "compare":
+            return self.compare(*node[1:])
+        if kind == "name":
+            return self.is_not_empty(node[1])
+        return np.asarray(self.value(node)).astype(bool)
+
+    def is_not_empty(self, name):
+        values = self.column(name)
+        if values.dtype.kind == "M":
+            return ~np.isnat(values)
+        if values.dtype.kind == "b":
+            return values.copy()
+        return values != self.empty_values[name]
+
+    def column(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise InvalidExpressionError(f"Unknown column: {name}")
+
+    def value(self, node):
+        kind = node[0]
+        if kind == "literal":
+            return node[1]
+        if kind == "name":
+            return self.column(node[1])
+        if kind == "neg":
+            return -self.value(node[1])
+        if kind == "arith":
+            left, right = self.value(node[2]), self.value(node[3])
+            if node[1] == "+":
+                return left + right
+            if node[1] == "-":
+                return left - right
+            if node[1] == "*":
+                return left * right
+            return left / right
+        # Boolean sub-expressions used as values
+        return self.truth(node)
+
+    def compare(self, operator, left_node, right_node):
+        left = self.value(left_node)
+        right = self.value(right_node)
+        left, right = coerce_for_comparison(left, right)
+        if operator == "=":
+            result = left == right
+        elif operator == "!=":
+            result = left != right
+        elif operator == "<":
+            result = left < right
+        elif operator == ">":
+            result = left > right
+        elif operator == "<=":
+            result = left <= right
+        else:
+            result = left >= right
+        # Missing dates never satisfy a comparison (SQL NULL semantics)
+        for side in (left, right):
+            if isinstance(side, np.ndarray) and side.dtype.kind == "M":
+                result = result & ~np.isnat(side)
+        return np.asarray(result, dtype=bool)
+
+
+def coerce_for_comparison(left, right):
+    # Date columns are compared against ISO date literals, and string
+    # columns holding numeric categories against numeric literals
+    for a, b, swap in ((left, right, False), (right, left, True)):
+        if isinstance(a, np.ndarray) and not isinstance(b, np.ndarray):
+            if a.dtype.kind == "M" and isinstance(b, str):
+                b = np.datetime64(b, "D")
+            elif a.dtype.kind == "O" and not isinstance(b, str):
+                b = str(b)
+            return (b, a) if swap else (a, b)
+    return left, right
@@ -0,0 +1,585 @@
+# Synthetic event-level source tables for the local backend
+# Generates every table in extraction.tables for a number of patients, so
+# that extraction can be run and benchmarked at production-like volume.
+# Coded events use the codes of the codelists the studies actually query
+# (read from the CSVs under codelists/ through analysis/codelists.py), each
+# codelist weighted by the incidence its variable expects and its codes by
+# rank, mixed with background codes that no variable matches. Numeric values
+# of measurement codes follow the float expectations of their variables.
+# Event dates are spread over the wave windows in config.json and the years
+# before them; no event follows the patient's death.
+# Patients are generated in chunks, each with its own seed and written as
+# one part file per table (<output_dir>/<table>.parquet/part-<chunk>.parquet,
+# which ParquetSource reads as one table), by a pool of processes.
+
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cohortextractor.study_definition import merge
+
+from extraction.backend import (
+    BMI_CODE,
+    ETHNICITY_GROUP_6,
+    EVENT_QUERY_TABLES,
+    codelist_codes,
+)
+from extraction.dates import add_to_dates, to_date
+from extraction.dummy import population_age_probabilities, sample_categories
+from extraction.tables import TABLE_COLUMNS
+
+# Years of history before the first wave that events are spread over
+HISTORY_YEARS = 10
+
+# Share of events dated within the wave windows (the rest are spread
+# uniformly from HISTORY_YEARS before the first wave to the end of the last)
+WINDOW_SHARE = 0.5
+
+# Share of coded events whose code is in a codelist of the studies
+MATCHING_SHARE = 0.1
+
+# Number of background codes for each coded table
+BACKGROUND_CODES = 5000
+
+# Events per patient in each event table, relative to --events-per-patient
+TABLE_EVENT_RATES = {
+    "clinical_events": 1.0,
+    "medications": 0.4,
+    "apcs": 0.02,
+    "ecds": 0.02,
+    "sgss": 0.05,
+}
+
+# Shape of the gamma distribution of each patient's event rate (smaller is
+# more dispersed: a few patients have most of the events)
+EVENT_RATE_SHAPE = 0.5
+
+# Deaths per patient per year, from the first wave start
+DEATH_RATE = 0.01
+
+# Share of living patients deregistered during the waves
+DEREGISTRATION_SHARE = 0.05
+
+CARE_HOME_SHARE = 0.02
+
+SEX_RATIOS = {"F": 0.49, "M": 0.49, "U": 0.01, "I": 0.01}
+
+COMPARATOR_RATIOS = {"=": 0.94, "<": 0.02, ">": 0.02, "<=": 0.01, ">=": 0.01}
+
+ADMISSION_METHOD_RATIOS = {
+    "11": 0.45,
+    "12": 0.1,
+    "13": 0.05,
+    "21": 0.25,
+    "22": 0.05,
+    "2A": 0.05,
+    "28": 0.05,
+}
+
+SGSS_RESULT_RATIOS = {"positive": 0.2, "negative": 0.8}
+
+# COVID-19 vaccinations start on this date, with doses at least this many
+# days apart; other vaccinations (influenza) make up VACCINATION_OTHER_SHARE
+VACCINATION_START_DATE = "2020-12-08"
+DOSE_INTERVAL_DAYS = 21
+DOSES_PER_PATIENT = 3.0
+VACCINATION_OTHER_SHARE = 0.3
+VACCINE_PRODUCTS = (
+    "COVID-19 mRNA Vaccine Comirnaty (Pfizer)",
+    "COVID-19 Vaccine Vaxzevria (AstraZeneca)",
+    "COVID-19 mRNA Vaccine Spikevax (Moderna)",
+)
+
+
+class CodePool:
+    # Codes of one table, with the probability of each and, for measurement
+    # codes, the normal distribution of their numeric values
+
+    def __init__(self):
+        self.weights = {}
+        self.distributions = {}
+
+    def add(self, codes, weight, distribution=None):
+        # Codes in codelist order are weighted by rank (as a few codes make
+        # up most records of a codelist)
+        codes = list(dict.fromkeys(codes))
+        ranks = 1 / np.arange(1, len(codes) + 1)
+        for code, share in zip(codes, weight * ranks / ranks.sum()):
+            self.weights[code] = self.weights.get(code, 0) + share
+            if distribution is not None:
+                self.distributions.setdefault(code, distribution)
+
+    def finish(self, background_codes):
+        # Arrays of codes, cumulative probabilities, and numeric value means
+        # and standard deviations (NaN for codes without values)
+        matching = np.array(list(self.weights.values()), dtype="float64")
+        if matching.sum() > 0:
+            matching = MATCHING_SHARE * matching / matching.sum()
+        ranks = 1 / np.arange(1, len(background_codes) + 1)
+        background = (1 - MATCHING_SHARE if len(matching) else 1) * ranks / ranks.sum()
+        self.codes = np.array(list(self.weights) + list(background_codes), dtype=object)
+        self.cumulative = np.cumsum(np.concatenate([matching, background]))
+        self.cumulative /= self.cumulative[-1]
+        self.means = np.full(len(self.codes), np.nan)
+        self.stddevs = np.full(len(self.codes), np.nan)
+        for position, code in enumerate(self.weights):
+            if code in self.distributions:
+                self.means[position] = self.distributions[code]["mean"]
+                self.stddevs[position] = self.distributions[code]["stddev"]
+        del self.weights, self.distributions
+        return self
+
+    def sample(self, rng, size):
+        positions = np.searchsorted(self.cumulative, rng.random(size), side="right")
+        return np.minimum(positions, len(self.codes) - 1)
+
+
+def background_codes(table, matching_codes, count):
+    # Codes that no variable matches, shaped like the codes of the table
+    # (ICD-10 codes are prefix-matched, so none may share a prefix)
+    if table in ("apcs", "ons_deaths"):
+        candidates = (
+            f"{letter}{number:03d}"
+            for letter in "ABCDEFGHIJKLMNOPQRSTVWXYZ"
+            for number in range(1000)
+        )
+        prefixes = tuple(matching_codes)
+        return [code for code in candidates if not code.startswith(prefixes)][:count]
+    if table == "ecds":
+        candidates = (str(1000000000 + 7919 * number) for number in range(count * 2))
+    else:
+        candidates = (f"Y{number:04X}" for number in range(count * 2))
+    return [code for code in candidates if code not in matching_codes][:count]
+
+
+def query_pool_entries(study, query_type, query_args):
+    # (table, codes, incidence, float distribution) of a coded query
+    table = EVENT_QUERY_TABLES.get(query_type)
+    if query_type == "most_recent_bmi":
+        codes = [BMI_CODE]
+    elif "codelist" in query_args:
+        codes, _ = codelist_codes(query_args["codelist"])
+    elif query_args.get("with_these_diagnoses"):
+        codes, _ = codelist_codes(query_args["with_these_diagnoses"])
+    else:
+        return []
+    expectations = merge(
+        study.default_expectations or {}, query_args.get("return_expectations") or {}
+    )
+    distribution = None
+    if query_args.get("column_type") == "float" and "float" in expectations:
+        distribution = expectations["float"]
+    return [(table, codes, expectations.get("incidence", 1.0), distribution)]
+
+
+def category_ratios(studies, returning, default):
+    # Category ratios expected of a registered_practice_as_of column
+    for study in studies:
+        for query_type, query_args in study.covariate_definitions.values():
+            if (
+                query_type == "registered_practice_as_of"
+                and query_args.get("returning") == returning
+            ):
+                expectations = query_args.get("return_expectations") or {}
+                category = expectations.get("category")
+                if category:
+                    return category["ratios"]
+    return default
+
+
+class FixtureSpec:
+    # Everything a chunk needs that is derived from the studies and config
+
+    def __init__(self, studies, config, events_per_patient):
+        self.events_per_patient = events_per_patient
+        windows = [
+            (to_date(wave["start_date"]), to_date(wave["end_date"]))
+            for key, wave in config.items()
+            if key.startswith("wave")
+        ]
+        self.window_starts = np.array([start for start, _ in windows])
+        self.window_days = np.array(
+            [(end - start).astype("int64") + 1 for start, end in windows]
+        )
+        self.first_start = self.window_starts.min()
+        self.last_end = max(end for _, end in windows)
+        self.history_start = add_to_dates(
+            np.array([self.first_start]), -12 * HISTORY_YEARS, "months"
+        )[0]
+        pools = {
+            table: CodePool()
+            for table in ("clinical_events", "medications", "apcs", "ecds", "ons_deaths")
+        }
+        for study in studies:
+            for query_type, query_args in study.covariate_definitions.values():
+                for table, codes, incidence, distribution in query_pool_entries(
+                    study, query_type, query_args
+                ):
+                    if table in pools:
+                        pools[table].add(codes, incidence, distribution)
+        self.pools = {
+            table: pool.finish(
+                background_codes(table, set(pool.weights), BACKGROUND_CODES)
+            )
+            for table, pool in pools.items()
+        }
+        self.regions = category_ratios(studies, "nuts1_region_name", {"London": 1})
+        self.stps = category_ratios(studies, "stp_code", {"STP1": 1})
+
+
+def sample_event_dates(rng, spec, size):
+    # WINDOW_SHARE of dates within a wave window (chosen by length), the
+    # rest uniform over the history and waves
+    in_window = rng.random(size) < WINDOW_SHARE
+    windows = sample_categories(rng, size, dict(enumerate(spec.window_days)))
+    window_dates = spec.window_starts[windows] + (
+        rng.random(size) * spec.window_days[windows]
+    ).astype("int64").astype("timedelta64[D]")
+    span = (spec.last_end - spec.history_start).astype("int64") + 1
+    history_dates = spec.history_start + (rng.random(size) * span).astype("int64").astype(
+        "timedelta64[D]"
+    )
+    return np.where(in_window, window_dates, history_dates)
+
+
+def sample_event_patients(rng, patient_ids, mean):
+    # Patient id of each event, with an overdispersed count per patient
+    rates = rng.gamma(EVENT_RATE_SHAPE, mean / EVENT_RATE_SHAPE, len(patient_ids))
+    counts = rng.poisson(rates)
+    return np.repeat(np.arange(len(patient_ids)), counts)
+
+
+def choose(rng, size, ratios):
+    return np.array(list(ratios), dtype=object)[sample_categories(rng, size, ratios)]
+
+
+def before_death(dates, date_of_death):
+    # Events of dead patients are moved back to their date of death
+    return np.where(
+        ~np.isnat(date_of_death) & (dates > date_of_death), date_of_death, dates
+    )
+
+
+def generate_patients(rng, spec, patient_ids):
+    size = len(patient_ids)
+    probabilities = population_age_probabilities()
+    ages = rng.choice(len(probabilities), size=size, p=probabilities)
+    date_of_birth = spec.first_start - (
+        (ages + rng.random(size)) * 365.25
+    ).astype("int64").astype("timedelta64[D]")
+    years = (spec.last_end - spec.first_start).astype("int64") / 365.25
+    died = rng.random(size) < DEATH_RATE * years
+    days = (spec.last_end - spec.first_start).astype("int64")
+    date_of_death = spec.first_start + (rng.random(size) * days).astype("int64").astype(
+        "timedelta64[D]"
+    )
+    date_of_death[~died] = np.datetime64("NaT")
+    return {
+        "patient_id": patient_ids,
+        "date_of_birth": date_of_birth.astype("datetime64[M]").astype("datetime64[D]"),
+        "sex": choose(rng, size, SEX_RATIOS),
+        "date_of_death": date_of_death,
+    }
+
+
+def generate_coded_events(rng, spec, table, patients, mean):
+    rows = sample_event_patients(rng, patients["patient_id"], mean)
+    pool = spec.pools[table]
+    codes = pool.sample(rng, len(rows))
+    dates = before_death(
+        sample_event_dates(rng, spec, len(rows)), patients["date_of_death"][rows]
+    )
+    return rows, pool.codes[codes], codes, dates
+
+
+def generate_clinical_events(rng, spec, patients):
+    rows, codes, positions, dates = generate_coded_events(
+        rng,
+        spec,
+        "clinical_events",
+        patients,
+        spec.events_per_patient * TABLE_EVENT_RATES["clinical_events"],
+    )
+    pool = spec.pools["clinical_events"]
+    means = pool.means[positions]
+    measured = ~np.isnan(means)
+    numeric_value = np.zeros(len(rows))
+    numeric_value[measured] = rng.normal(means[measured], pool.stddevs[positions][measured])
+    comparator = np.full(len(rows), "", dtype=object)
+    comparator[measured] = choose(rng, int(measured.sum()), COMPARATOR_RATIOS)
+    return {
+        "patient_id": patients["patient_id"][rows],
+        "date": dates,
+        "code": codes,
+        "numeric_value": numeric_value,
+        "comparator": comparator,
+    }
+
+
+def generate_medications(rng, spec, patients):
+    rows, codes, _, dates = generate_coded_events(
+        rng,
+        spec,
+        "medications",
+        patients,
+        spec.events_per_patient * TABLE_EVENT_RATES["medications"],
+    )
+    return {"patient_id": patients["patient_id"][rows], "date": dates, "code": codes}
+
+
+def ethnicity_codes(rng, size):
+    # NHS ethnic category codes, missing for a third of records
+    codes = np.array(sorted(ETHNICITY_GROUP_6) + ["Z"], dtype=object)[
+        rng.integers(0, len(ETHNICITY_GROUP_6) + 1, size)
+    ]
+    codes[rng.random(size) < 1 / 3] = ""
+    return codes
+
+
+def generate_apcs(rng, spec, patients):
+    rows, codes, _, dates = generate_coded_events(
+        rng, spec, "apcs", patients, spec.events_per_patient * TABLE_EVENT_RATES["apcs"]
+    )
+    return {
+        "patient_id": patients["patient_id"][rows],
+        "admission_date": dates,
+        "admission_method": choose(rng, len(rows), ADMISSION_METHOD_RATIOS),
+        "diagnosis": codes,
+        "ethnicity": ethnicity_codes(rng, len(rows)),
+    }
+
+
+def generate_ecds(rng, spec, patients):
+    rows, codes, _, dates = generate_coded_events(
+        rng, spec, "ecds", patients, spec.events_per_patient * TABLE_EVENT_RATES["ecds"]
+    )
+    return {
+        "patient_id": patients["patient_id"][rows],
+        "arrival_date": dates,
+        "diagnosis": codes,
+        "ethnicity": ethnicity_codes(rng, len(rows)),
+    }
+
+
+def generate_sgss(rng, spec, patients):
+    rows = sample_event_patients(
+        rng, patients["patient_id"], spec.events_per_patient * TABLE_EVENT_RATES["sgss"]
+    )
+    # Testing only started with the pandemic
+    dates = sample_event_dates(rng, spec, len(rows))
+    dates = np.maximum(dates, spec.first_start)
+    return {
+        "patient_id": patients["patient_id"][rows],
+        "specimen_date": before_death(dates, patients["date_of_death"][rows]),
+        "pathogen": np.full(len(rows), "SARS-CoV-2", dtype=object),
+        "result": choose(rng, len(rows), SGSS_RESULT_RATIOS),
+    }
+
+
+def generate_vaccinations(rng, spec, patients):
+    # COVID-19 doses in sequence, DOSE_INTERVAL_DAYS or more apart, up to the
+    # end of the last wave, and influenza vaccinations at any time
+    size = len(patients["patient_id"])
+    doses = rng.poisson(DOSES_PER_PATIENT, size)
+    rows = np.repeat(np.arange(size), doses)
+    intervals = DOSE_INTERVAL_DAYS + rng.exponential(120, len(rows)).astype("int64")
+    # The first dose of each patient is some time after the start of
+    # vaccination; each later dose follows the previous one
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    intervals[first] = rng.exponential(90, int(first.sum())).astype("int64")
+    offsets = np.cumsum(intervals)
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(rows)), 0))
+    days = offsets - offsets[group_start] + intervals[group_start]
+    dates = to_date(VACCINATION_START_DATE) + days.astype("timedelta64[D]")
+    # Doses after death or after the last wave are dropped
+    date_of_death = patients["date_of_death"][rows]
+    keep = (dates <= spec.last_end) & (np.isnat(date_of_death) | (dates <= date_of_death))
+    rows, dates = rows[keep], dates[keep]
+
+    other_rows = sample_event_patients(
+        rng, patients["patient_id"], DOSES_PER_PATIENT * VACCINATION_OTHER_SHARE
+    )
+    other_dates = before_death(
+        sample_event_dates(rng, spec, len(other_rows)),
+        patients["date_of_death"][other_rows],
+    )
+    products = np.array(VACCINE_PRODUCTS, dtype=object)[
+        rng.integers(0, len(VACCINE_PRODUCTS), len(rows))
+    ]
+    order = np.argsort(np.concatenate([rows, other_rows]), kind="stable")
+    return {
+        "patient_id": patients["patient_id"][np.concatenate([rows, other_rows])][order],
+        "date": np.concatenate([dates, other_dates])[order],
+        "target_disease": np.concatenate(
+            [
+                np.full(len(rows), "SARS-2 CORONAVIRUS", dtype=object),
+                np.full(len(other_rows), "INFLUENZA", dtype=object),
+            ]
+        )[order],
+        "product_name": np.concatenate(
+            [products, np.full(len(other_rows), "Influenza vaccine", dtype=object)]
+        )[order],
+    }
+
+
+def generate_ons_deaths(rng, spec, patients):
+    # One to three causes for each death, the first the underlying cause
+    dead = np.flatnonzero(~np.isnat(patients["date_of_death"]))
+    rows = np.repeat(dead, rng.integers(1, 4, len(dead)))
+    underlying = np.ones(len(rows), dtype=bool)
+    underlying[1:] = rows[1:] != rows[:-1]
+    pool = spec.pools["ons_deaths"]
+    return {
+        "patient_id": patients["patient_id"][rows],
+        "date": patients["date_of_death"][rows],
+        "cause": pool.codes[pool.sample(rng, len(rows))],
+        "underlying": underlying,
+    }
+
+
+def generate_registrations(rng, spec, patients):
+    # One registration per patient, from before the history to their death
+    # or deregistration, if any
+    size = len(patients["patient_id"])
+    start_date = spec.history_start - (rng.random(size) * 365.25 * 20).astype(
+        "int64"
+    ).astype("timedelta64[D]")
+    start_date = np.maximum(start_date, patients["date_of_birth"])
+    days = (spec.last_end - spec.first_start).astype("int64")
+    end_date = spec.first_start + (rng.random(size) * days).astype("int64").astype(
+        "timedelta64[D]"
+    )
+    end_date[rng.random(size) >= DEREGISTRATION_SHARE] = np.datetime64("NaT")
+    dead = ~np.isnat(patients["date_of_death"])
+    end_date[dead] = patients["date_of_death"][dead]
+    return {
+        "patient_id": patients["patient_id"],
+        "start_date": start_date,
+        "end_date": end_date,
+        "stp_code": choose(rng, size, spec.stps),
+        "nuts1_region_name": choose(rng, size, spec.regions),
+    }
+
+
+def generate_addresses(rng, patients, registrations):
+    size = len(patients["patient_id"])
+    care_home = rng.random(size) < CARE_HOME_SHARE
+    nursing = np.where(rng.random(size) < 0.5, "Y", "N").astype(object)
+    not_nursing = np.where(nursing == "Y", "N", "Y").astype(object)
+    nursing[~care_home] = ""
+    not_nursing[~care_home] = ""
+    return {
+        "patient_id": patients["patient_id"],
+        "start_date": registrations["start_date"],
+        "end_date": registrations["end_date"],
+        "imd_rounded": rng.integers(0, 329, size) * 100,
+        "is_potential_care_home": care_home,
+        "location_requires_nursing": nursing,
+        "location_does_not_require_nursing": not_nursing,
+    }
+
+
+def generate_chunk(rng, spec, patient_ids):
+    # Every table for the patients with `patient_ids`
+    patients = generate_patients(rng, spec, patient_ids)
+    registrations = generate_registrations(rng, spec, patients)
+    return {
+        "patients": patients,
+        "clinical_events": generate_clinical_events(rng, spec, patients),
+        "medications": generate_medications(rng, spec, patients),
+        "apcs": generate_apcs(rng, spec, patients),
+        "ecds": generate_ecds(rng, spec, patients),
+        "sgss": generate_sgss(rng, spec, patients),
+        "vaccinations": generate_vaccinations(rng, spec, patients),
+        "ons_deaths": generate_ons_deaths(rng, spec, patients),
+        "registrations": registrations,
+        "addresses": generate_addresses(rng, patients, registrations),
+    }
+
+
+ARROW_TABLE_TYPES = {
+    "int": pa.int64(),
+    "date": pa.date32(),
+    "str": pa.string(),
+    "float": pa.float64(),
+    "bool": pa.bool_(),
+}
+
+
+def table_path(output_dir, table):
+    return os.path.join(output_dir, f"{table}.parquet")
+
+
+def write_chunk(job):
+    # Generates chunk `number` and writes one part file per table; returns
+    # the number of rows of each table
+    spec, output_dir, number, first_patient_id, size, seed = job
+    patient_ids = np.arange(first_patient_id, first_patient_id + size, dtype="int64")
+    tables = generate_chunk(np.random.default_rng(seed), spec, patient_ids)
+    rows = {}
+    for table, columns in tables.items():
+        schema = pa.schema(
+            [
+                (column, ARROW_TABLE_TYPES[column_type])
+                for column, column_type in TABLE_COLUMNS[table].items()
+            ]
+        )
+        arrow_table = pa.Table.from_arrays(
+            [
+                pa.array(columns[field.name], type=field.type, from_pandas=True)
+                for field in schema
+            ],
+            schema=schema,
+        )
+        pq.write_table(
+            arrow_table,
+            os.path.join(table_path(output_dir, table), f"part-{number:05d}.parquet"),
+            compression="zstd",
+        )
+        rows[table] = arrow_table.num_rows
+    return rows
+
+
+def clear_tables(output_dir):
+    # Removes the tables of an earlier run, so no old part files remain
+    for table in TABLE_COLUMNS:
+        path = table_path(output_dir, table)
+        if os.path.isdir(path):
+            for part in glob.glob(os.path.join(path, "part-*.parquet")):
+                os.remove(part)
+        elif os.path.exists(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+
+
+def write_fixtures(spec, output_dir, patients, seed, chunk_size=100_000, processes=1):
+    # Writes every table for `patients` patients (numbered from 1) in chunks
+    # of `chunk_size`, by `processes` processes; returns the rows per table
+    clear_tables(output_dir)
+    chunks = -(-patients // chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    jobs = [
+        (
+            spec,
+            output_dir,
+            number,
+            number * chunk_size + 1,
+            min(chunk_size, patients - number * chunk_size),
+            seeds[number],
+        )
+        for number in range(chunks)
+    ]
+    totals = {table: 0 for table in TABLE_COLUMNS}
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(write_chunk, jobs))
+    else:
+        results = [write_chunk(job) for job in jobs]
+    for rows in results:
+        for table, count in rows.items():
+            totals[table] += count
+    return totals
@@ -0,0 +1,176 @@
+# Multi-wave extraction from a single scan of each source table
+# The wave study definitions differ only in their index date and end date,
+# so every wave reads the same source tables. Here the code and date
+# restrictions of all waves are merged into one scan plan per table, each
+# table is read once, and every wave is evaluated against the shared frames.
+# The era exposures are a study of their own (written to input_era), which
+# shares the scans with the waves.
+# A calendar series evaluates the wave variables at every index date from a
+# start date to an end date (see load_series_studies) in the same way: one
+# scan of each table for every snapshot, and the event timelines of the
+# code-matching variables built once (see extraction/timelines.py).
+# With a cache directory, evaluated variables are cached per variable (see
+# extraction/cache.py), so a rerun after a change to the study definitions
+# only evaluates the changed variables.
+# With a profile directory, each study's per-variable profile is written
+# there (see extraction/profile.py).
+# A streamed extraction scans and evaluates the patients a batch at a time
+# instead (see extraction/streaming.py).
+# With compression threads, csv.gz output is block-compressed (see
+# extraction/blocks.py).
+
+from extraction.backend import (
+    BMI_CODE,
+    EVENT_QUERY_TABLES,
+    LocalBackend,
+    codelist_codes,
+)
+from extraction.cache import VariableCache
+from extraction.dates import date_series, is_iso_date, to_date
+from extraction.output import is_typed_format, output_path, write_cohort
+from extraction.pool import bounded_map
+from extraction.profile import ExtractionProfile, profile_path
+from extraction.tables import TABLE_COLUMNS
+
+
+def wave_keys(config):
+    return [key for key in config if key.startswith("wave")]
+
+
+def load_wave_studies(keys):
+    # Builds the study definition for each wave key (variables that do not
+    # depend on the wave are shared between the studies)
+    from study_factory import build_study
+
+    return {key: build_study(key) for key in keys}
+
+
+def load_era_study():
+    # The era exposures are extracted once for all waves (input_era)
+    from study_factory import build_era_study
+
+    return build_era_study()
+
+
+def load_series_studies(start, end, step):
+    # One study per index date from `start` to `end` every `step` (e.g.
+    # "1 month"), keyed series_<index date>; each snapshot is followed up
+    # until the day before the next index date
+    from study_factory import build_dated_study
+
+    dates, after = date_series(start, end, step)
+    end_dates = [str(to_date(date) - 1) for date in dates[1:] + [after]]
+    return {
+        f"series_{date}": build_dated_study(date, end_date)
+        for date, end_date in zip(dates, end_dates)
+    }
+
+
+def query_codes(query_type, query_args):
+    # Codes a query restricts its table to, or None if it needs every row
+    if query_type == "most_recent_bmi":
+        return {BMI_CODE}
+    if "codelist" in query_args:
+        return set(codelist_codes(query_args["codelist"])[0])
+    if query_type == "attended_emergency_care" and query_args.get("with_these_diagnoses"):
+        return set(query_args["with_these_diagnoses"])
+    return None
+
+
+def query_window(query_type, query_args):
+    # Date window a query reads, with None for an open bound; bounds that
+    # refer to other columns are unknown until evaluation so count as open
+    if query_type == "with_test_result_in_sgss" and query_args.get(
+        "restrict_to_earliest_specimen_date", True
+    ):
+        return None, None
+    start, end = query_args.get("between") or (None, None)
+    return (
+        start if is_iso_date(start) else None,
+        end if is_iso_date(end) else None,
+    )
+
+
+def plan_scans(studies):
+    # One scan per source table, covering the union of codes and dates that
+    # any variable in any of the studies needs
+    plan = {table: None for table in TABLE_COLUMNS}
+    scanned = set()
+    for study in studies:
+        for query_type, query_args in study.covariate_definitions.values():
+            if query_type == "with_ethnicity_from_sus":
+                # Reads every APCS and ECDS record
+                for table in ("apcs", "ecds"):
+                    plan[table] = merge_scan(plan[table], None, (None, None))
+                    scanned.add(table)
+                continue
+            table = EVENT_QUERY_TABLES.get(query_type)
+            if table is None:
+                continue
+            codes = query_codes(query_type, query_args)
+            window = query_window(query_type, query_args)
+            plan[table] = merge_scan(plan[table], codes, window)
+            scanned.add(table)
+    return {
+        table: plan[table] if table in scanned else {"codes": None, "start": None, "end": None}
+        for table in TABLE_COLUMNS
+    }
+
+
+def merge_scan(scan, codes, window):
+    start, end = window
+    if scan is None:
+        return {"codes": None if codes is None else set(codes), "start": start, "end": end}
+    if scan["codes"] is not None and codes is not None:
+        scan["codes"] |= codes
+    else:
+        scan["codes"] = None
+    scan["start"] = None if scan["start"] is None or start is None else min(scan["start"], start)
+    scan["end"] = None if scan["end"] is None or end is None else max(scan["end"], end)
+    return scan
+
+
+def scan_tables(source, plan, patient_range=None, connections=1, timeout=None):
+    # Scans every table, up to `connections` at a time (see
+    # extraction/pool.py), each within `timeout` seconds if given
+    def scan(table):
+        return source.scan(
+            table, **plan[table], patient_range=patient_range, timeout=timeout
+        )
+
+    return dict(zip(TABLE_COLUMNS, bounded_map(scan, TABLE_COLUMNS, connections)))
+
+
+def extract_waves(
+    source,
+    studies,
+    output_dir,
+    output_format="feather",
+    cache_dir=None,
+    workers=1,
+    population_pushdown=False,
+    profile_dir=None,
+    connections=1,
+    timeout=None,
+    compression_threads=None,
+):
+    # Reads each source table once, then evaluates and writes every wave
+    tables = scan_tables(
+        source, plan_scans(studies.values()), connections=connections, timeout=timeout
+    )
+    cache = VariableCache(cache_dir, source.snapshot()) if cache_dir else None
+    backend = LocalBackend(tables, cache, workers, population_pushdown)
+    paths = {}
+    for key, study in studies.items():
+        paths[key] = output_path(output_dir, f"input_{key}", output_format)
+        profile = ExtractionProfile(key) if profile_dir else None
+        backend.hooks = [profile] if profile else []
+        cohort = backend.to_dataframe(
+            study.covariate_definitions, is_typed_format(paths[key])
+        )
+        write_cohort(cohort, paths[key], study.covariate_definitions, compression_threads)
+        del cohort
+        if profile:
+            profile.cohort_written(paths[key])
+            profile.write(profile_path(profile_dir, key))
+    return paths
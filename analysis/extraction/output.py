@@ -0,0 +1,279 @@
+# Writing extracted cohorts in the formats cohortextractor produces
+# CSV output holds formatted strings. The typed formats (Arrow IPC "feather",
+# as written by cohortextractor, and Parquet) use a schema derived from the
+# study definition: dates as date32, flags as booleans, and categorical
+# columns (str columns and IMD) dictionary-encoded.
+# CohortWriter writes a cohort in chunks, for cohorts generated a chunk at a
+# time (see extraction/dummy.py and extraction/streaming.py). An Arrow IPC
+# file has a single dictionary per categorical column, which later chunks
+# may only extend, and an empty dictionary cannot be extended; so feather
+# chunks are written to a temporary IPC stream (where each chunk has a
+# dictionary of its own) and, once the values of every chunk are known,
+# copied a chunk at a time to the file against one dictionary per column.
+# With compression threads, csv.gz output is block-compressed by that many
+# threads and indexed by patient (see extraction/blocks.py).
+# column_bytes reads back the size of each column of a written cohort (for
+# extraction profiles).
+
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from extraction.blocks import BlockWriter
+
+OUTPUT_FORMATS = ("csv", "csv.gz", "feather", "parquet")
+
+TYPED_FORMATS = ("feather", "parquet")
+
+ARROW_TYPES = {
+    "date": pa.date32(),
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "str": pa.dictionary(pa.int32(), pa.string()),
+}
+
+# Rows formatted at a time when a whole cohort is block-compressed
+BLOCK_WRITE_ROWS = 100_000
+
+# Integer columns that are categorical (as cohortextractor treats them)
+CATEGORICAL_RETURNING = ("index_of_multiple_deprivation", "rural_urban_classification")
+
+
+def output_path(output_dir, name, output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    return os.path.join(output_dir, f"{name}.{output_format}")
+
+
+def is_typed_format(path):
+    return path.endswith(tuple(f".{output_format}" for output_format in TYPED_FORMATS))
+
+
+def arrow_type(query_args):
+    if query_args.get("returning") in CATEGORICAL_RETURNING:
+        return pa.dictionary(pa.int32(), pa.int64())
+    return ARROW_TYPES[query_args["column_type"]]
+
+
+def arrow_schema(covariate_definitions):
+    # Schema for patient_id and each visible column in definition order
+    fields = [pa.field("patient_id", pa.int64(), nullable=False)]
+    for name, (_, query_args) in covariate_definitions.items():
+        if name == "population" or query_args.get("hidden"):
+            continue
+        fields.append(pa.field(name, arrow_type(query_args)))
+    return pa.schema(fields)
+
+
+def arrow_column(values, field_type):
+    if isinstance(values, pd.Categorical):
+        # Already encoded; empty categories have code -1
+        codes = pa.array(values.codes, mask=values.codes < 0).cast(field_type.index_type)
+        categories = pa.array(
+            np.asarray(values.categories), type=field_type.value_type
+        )
+        return pa.DictionaryArray.from_arrays(codes, categories)
+    values = np.asarray(values)
+    if pa.types.is_dictionary(field_type):
+        if values.dtype == object:
+            # Empty strings are missing categories
+            values = np.where(values == "", None, values)
+        array = pa.array(values, type=field_type.value_type, from_pandas=True)
+        return array.dictionary_encode().cast(field_type)
+    return pa.array(values, type=field_type, from_pandas=True)
+
+
+def to_arrow(frame, covariate_definitions):
+    # `frame` is a DataFrame or a dict of arrays (see backend.output_columns)
+    schema = arrow_schema(covariate_definitions)
+    columns = []
+    for field in schema:
+        values = frame[field.name]
+        if isinstance(values, pd.Series):
+            values = values.array
+        columns.append(arrow_column(values, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_cohort(frame, path, covariate_definitions=None, compression_threads=None):
+    # Typed formats need the typed frame (LocalBackend.to_dataframe with
+    # typed=True) and the covariate definitions for the schema
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if compression_threads and path.endswith(".gz"):
+        with CohortWriter(path, covariate_definitions, compression_threads) as writer:
+            for start in range(0, max(len(frame), 1), BLOCK_WRITE_ROWS):
+                writer.write(frame.iloc[start : start + BLOCK_WRITE_ROWS])
+    elif path.endswith(".feather"):
+        feather.write_feather(
+            to_arrow(frame, covariate_definitions), path, compression="zstd"
+        )
+    elif path.endswith(".parquet"):
+        pq.write_table(to_arrow(frame, covariate_definitions), path, compression="zstd")
+    else:
+        compression = "gzip" if path.endswith(".gz") else None
+        frame.to_csv(path, index=False, compression=compression)
+
+
+def column_bytes(path):
+    # Bytes of each column of a written cohort before compression: the text
+    # of its values and their separators for CSV (with its header), the
+    # Arrow buffers of its values for feather (with its dictionary, written
+    # once), and its encoded (dictionary and run-length encoded, but not
+    # compressed) column chunks for Parquet
+    if path.endswith(".parquet"):
+        metadata = pq.ParquetFile(path).metadata
+        totals = dict.fromkeys(metadata.schema.names, 0)
+        for number in range(metadata.num_row_groups):
+            row_group = metadata.row_group(number)
+            for column in map(row_group.column, range(row_group.num_columns)):
+                totals[column.path_in_schema] += column.total_uncompressed_size
+        return totals
+    if path.endswith(".feather"):
+        dictionaries = {}
+        with pa.ipc.open_file(pa.memory_map(path)) as reader:
+            totals = dict.fromkeys(reader.schema.names, 0)
+            for number in range(reader.num_record_batches):
+                batch = reader.get_batch(number)
+                for name, column in zip(batch.schema.names, batch.columns):
+                    if isinstance(column, pa.DictionaryArray):
+                        dictionaries[name] = column.dictionary.nbytes
+                        column = column.indices
+                    totals[name] += column.nbytes
+        for name, size in dictionaries.items():
+            totals[name] += size
+        return totals
+    with (gzip.open if path.endswith(".gz") else open)(path, "rt", newline="") as f:
+        header = f.readline().rstrip("\r\n").split(",")
+    totals = {name: len(name.encode()) + 1 for name in header}
+    convert_options = pa_csv.ConvertOptions(
+        column_types=dict.fromkeys(header, pa.string()), strings_can_be_null=False
+    )
+    with pa_csv.open_csv(path, convert_options=convert_options) as reader:
+        for batch in reader:
+            for name, column in zip(header, batch.columns):
+                # Each value is followed by a comma or a newline
+                length = pc.sum(pc.binary_length(column)).as_py() or 0
+                totals[name] += length + len(column)
+    return totals
+
+
+class CohortWriter:
+    # Writes a cohort to `path` as a sequence of frames (chunks of patients,
+    # each with every column); as write_cohort, typed formats need typed
+    # frames and the covariate definitions, and csv.gz is block-compressed
+    # with compression threads
+
+    def __init__(self, path, covariate_definitions=None, compression_threads=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.covariate_definitions = covariate_definitions
+        self.writer = None
+        self.file = None
+        self.blocks = None
+        # Values of each categorical column so far (feather only)
+        self.dictionaries = {}
+        if path.endswith(".feather"):
+            self.writer = pa.ipc.new_stream(
+                self.stream_path(),
+                arrow_schema(covariate_definitions),
+                options=pa.ipc.IpcWriteOptions(compression="zstd"),
+            )
+        elif path.endswith(".parquet"):
+            self.writer = pq.ParquetWriter(
+                path, arrow_schema(covariate_definitions), compression="zstd"
+            )
+        elif compression_threads and path.endswith(".gz"):
+            self.blocks = BlockWriter(path, compression_threads)
+        else:
+            self.file = gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w")
+        self.header = True
+
+    def write(self, frame):
+        # `frame` may be a dict of arrays for typed formats
+        if self.writer is not None:
+            table = to_arrow(frame, self.covariate_definitions)
+            if self.path.endswith(".feather"):
+                self.extend_dictionaries(table)
+            self.writer.write_table(table)
+        elif self.blocks is not None:
+            if self.header:
+                self.blocks.write_header(frame.iloc[:0].to_csv(index=False))
+            self.blocks.write_rows(
+                frame.to_csv(index=False, header=False), frame["patient_id"].to_numpy()
+            )
+            self.header = False
+        else:
+            frame.to_csv(self.file, index=False, header=self.header)
+            self.header = False
+
+    def stream_path(self):
+        return f"{self.path}.stream"
+
+    def extend_dictionaries(self, table):
+        # Adds the values of the chunk's categorical columns not seen in
+        # earlier chunks to their dictionaries
+        for field, column in zip(table.schema, table.columns):
+            if not pa.types.is_dictionary(field.type):
+                continue
+            dictionary = column.combine_chunks().dictionary
+            known = self.dictionaries.get(field.name)
+            if known is not None:
+                new = pc.filter(dictionary, pc.invert(pc.is_in(dictionary, known)))
+                dictionary = pa.concat_arrays([known, new])
+            self.dictionaries[field.name] = dictionary
+
+    def encode_dictionaries(self, batch):
+        # Re-encodes a chunk's categorical columns against the dictionaries
+        # of the whole cohort
+        columns = []
+        for field, column in zip(batch.schema, batch.columns):
+            if pa.types.is_dictionary(field.type):
+                dictionary = self.dictionaries[field.name]
+                indices = pc.index_in(column.dictionary, value_set=dictionary).take(
+                    column.indices
+                )
+                column = pa.DictionaryArray.from_arrays(
+                    indices.cast(field.type.index_type), dictionary
+                )
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=batch.schema)
+
+    def write_file(self):
+        # Copies the chunks of the stream to the IPC file
+        self.writer.close()
+        with pa.ipc.open_stream(self.stream_path()) as reader, pa.ipc.new_file(
+            self.path, reader.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+        ) as writer:
+            for batch in reader:
+                writer.write_batch(self.encode_dictionaries(batch))
+
+    def close(self, complete=True):
+        # An incomplete cohort (after a failure) is not copied to the file
+        if self.path.endswith(".feather"):
+            try:
+                if complete:
+                    self.write_file()
+                else:
+                    self.writer.close()
+            finally:
+                os.remove(self.stream_path())
+        elif self.writer is not None:
+            self.writer.close()
+        elif self.blocks is not None:
+            self.blocks.close()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
@@ -0,0 +1,153 @@
+# Shared-scan planning for code-matching variables
+# Most variables in a wave are with_these_clinical_events (or
+# with_these_medications) queries over the same table that differ only in
+# codelist and date window. Rather than one pass over the table per
+# variable, such variables are grouped per table and evaluated together
+# (see LocalBackend.evaluate_shared_scan): each distinct code in the table is
+# given a bitmask of the codelists containing it, the table is filtered and
+# sorted once into an event timeline per codelist (see
+# extraction/timelines.py), and each variable's result is then found in its
+# codelist's timeline. Timelines are kept, so a later study (another wave)
+# asking for the same codelist at another date does not scan the table.
+
+import numpy as np
+
+from extraction.dates import is_iso_date
+
+# Query types that can share a scan, with the table they read
+SHARED_SCAN_QUERIES = {
+    "with_these_clinical_events": "clinical_events",
+    "with_these_medications": "medications",
+}
+
+SHARED_SCAN_RETURNING = (
+    "binary_flag",
+    "date",
+    "number_of_matches_in_period",
+    "numeric_value",
+    "code",
+    "category",
+)
+
+BITS_PER_WORD = 64
+
+
+def is_fixed_bound(value):
+    # Bounds that refer to other columns differ per patient, and depend on
+    # the order of evaluation, so those variables are evaluated on their own
+    return value is None or is_iso_date(value)
+
+
+def can_share_scan(query_type, query_args):
+    if query_type not in SHARED_SCAN_QUERIES:
+        return False
+    if query_args.get("returning", "binary_flag") not in SHARED_SCAN_RETURNING:
+        return False
+    if query_args.get("ignore_days_where_these_codes_occur") or query_args.get(
+        "episode_defined_as"
+    ):
+        return False
+    between = query_args.get("between") or (None, None)
+    return all(is_fixed_bound(bound) for bound in between)
+
+
+def plan_shared_scans(covariate_definitions):
+    # Names of the variables to evaluate together, by table (a variable on
+    # its own still builds a timeline for later studies)
+    groups = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if can_share_scan(query_type, query_args):
+            groups.setdefault(SHARED_SCAN_QUERIES[query_type], []).append(name)
+    return groups
+
+
+def variable_bit(number):
+    # Word and bit mask for the number-th variable of a group
+    return number // BITS_PER_WORD, np.uint64(1) << np.uint64(number % BITS_PER_WORD)
+
+
+def code_bitmasks(memberships):
+    # `memberships` holds, for each variable in a group, a boolean array over
+    # the distinct codes of the table. Returns a (codes, words) uint64 array
+    # with bit n of a code set if the code is in the n-th variable's codelist
+    words = -(-len(memberships) // BITS_PER_WORD)
+    size = len(memberships[0]) if memberships else 0
+    bitmasks = np.zeros((size, words), dtype="uint64")
+    for number, found in enumerate(memberships):
+        word, bit = variable_bit(number)
+        bitmasks[found, word] |= bit
+    return bitmasks
+
+
+# Era binning
+# Variables that run the same query over different, non-overlapping fixed
+# date windows (such as the per-era exposures in dict_era_exposure_vars.py)
+# are evaluated from one scan over the union of the windows: each matched
+# event is assigned to the window containing it, and the first or last date
+# is taken per window and patient (see LocalBackend.evaluate_era_bins).
+# Code-matching queries are left to the shared scans above.
+ERA_BIN_QUERIES = (
+    "admitted_to_hospital",
+    "attended_emergency_care",
+    "with_test_result_in_sgss",
+    "with_these_codes_on_death_certificate",
+    "with_tpp_vaccination_record",
+)
+
+ERA_BIN_RETURNING = ("date", "date_admitted", "date_arrived", "date_of_death")
+
+# Arguments that may differ between the variables of an era-binned group
+ERA_BIN_VARYING_ARGS = ("between", "return_expectations", "hidden")
+
+
+def can_bin_by_era(query_type, query_args):
+    if query_type not in ERA_BIN_QUERIES:
+        return False
+    if query_args.get("returning") not in ERA_BIN_RETURNING:
+        return False
+    if query_type == "with_test_result_in_sgss" and query_args.get(
+        "restrict_to_earliest_specimen_date", True
+    ):
+        # The window is applied after picking each patient's earliest
+        # specimen, so it cannot be widened
+        return False
+    between = query_args.get("between") or (None, None)
+    return all(bound is not None and is_iso_date(bound) for bound in between)
+
+
+def bin_args(query_args):
+    return {
+        key: value
+        for key, value in query_args.items()
+        if key not in ERA_BIN_VARYING_ARGS
+    }
+
+
+def windows_overlap(windows):
+    windows = sorted(windows)
+    return any(
+        start <= previous_end
+        for (_, previous_end), (start, _) in zip(windows, windows[1:])
+    )
+
+
+def plan_era_bins(covariate_definitions):
+    # Lists of (query type, names) for variables that differ only in their
+    # fixed, non-overlapping date windows (only groups of more than one)
+    groups = []
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if not can_bin_by_era(query_type, query_args):
+            continue
+        for group_type, names in groups:
+            first_args = covariate_definitions[names[0]][1]
+            windows = [tuple(covariate_definitions[other][1]["between"]) for other in names]
+            if (
+                group_type == query_type
+                and bin_args(first_args) == bin_args(query_args)
+                and not windows_overlap(windows + [tuple(query_args["between"])])
+            ):
+                names.append(name)
+                break
+        else:
+            groups.append((query_type, [name]))
+    return [(query_type, names) for query_type, names in groups if len(names) > 1]
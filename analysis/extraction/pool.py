@@ -0,0 +1,30 @@
+# Bounded concurrent execution of independent source queries
+# The source tables are independent of each other, so their scans can run
+# concurrently on a database that serves parallel reads. bounded_map runs
+# them on at most `workers` threads, each scan holding one connection of
+# its own (so `workers` bounds the connections open at once), and only
+# submits a query when one of the running queries has finished, so queries
+# wait in the caller rather than pile up in the executor (backpressure).
+# Results are returned in the order of the items; the first failure (such
+# as a query timing out, see DatabaseSource.scan) cancels the queries not
+# yet started and is raised.
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def bounded_map(function, items, workers):
+    items = list(items)
+    if workers <= 1:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+        for number, item in enumerate(items):
+            pending[executor.submit(function, item)] = number
+            if len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+        for future in list(pending):
+            results[pending.pop(future)] = future.result()
+    return results
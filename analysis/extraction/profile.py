@@ -0,0 +1,121 @@
+# Per-variable extraction profile
+# An ExtractionProfile is one of LocalBackend's hooks while a study is
+# evaluated, and records for each variable: a hash of its query (as the
+# variable cache fingerprints it, so the same query has the same hash in
+# every run), the wall-clock start and end of its evaluation, its time
+# (including its share of any scan shared with other variables), the source
+# rows it read and the rows it returned (patients with a non-empty value).
+# A variable evaluated by several shards or batches has a record for each.
+# Once the cohort is written, a single record for the whole cohort holds the
+# size of the output file (cohort_bytes) and the bytes written for each
+# column (bytes_written, by variable; see output.column_bytes).
+# Profiles are written as JSON lines, one record per variable in evaluation
+# order then the cohort record, to logs/extract_<wave>_profile.jsonl.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from extraction.cache import query_fingerprint
+from extraction.output import column_bytes
+
+
+def query_hash(query_type, query_args):
+    fingerprint = query_fingerprint(query_type, query_args)
+    return hashlib.sha1(repr(fingerprint).encode()).hexdigest()
+
+
+def profile_path(profile_dir, key):
+    return os.path.join(profile_dir, f"extract_{key}_profile.jsonl")
+
+
+class ExtractionProfile:
+    def __init__(self, study_key):
+        self.study_key = study_key
+        # Records in the order the variables finished
+        self.records = []
+        self.started = {}
+        # Record of the output file, once written
+        self.cohort = None
+        # Covariates may be evaluated by several threads (see
+        # LocalBackend.workers)
+        self.lock = threading.Lock()
+
+    def variable_started(self, name, query_type, query_args):
+        with self.lock:
+            self.started[name] = time.time()
+
+    def variable_finished(self, name, query_type, query_args, stats):
+        finished = time.time()
+        record = {
+            "study": self.study_key,
+            "variable": name,
+            "query_type": query_type,
+            "query_hash": query_hash(query_type, query_args),
+            "started": self.started.pop(name, finished),
+            "finished": finished,
+            "seconds": stats["seconds"],
+            "rows_scanned": stats["rows_scanned"],
+            "rows_returned": stats["rows_returned"],
+            "cached": stats["cached"],
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def cohort_written(self, path):
+        # Called once the cohort is written (and closed) to `path`
+        self.cohort = {
+            "study": self.study_key,
+            "cohort_bytes": os.path.getsize(path),
+            "bytes_written": column_bytes(path),
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for record in self.records + ([self.cohort] if self.cohort else []):
+                f.write(json.dumps(record) + "\n")
+
+
+def read_profile(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def is_cohort_record(record):
+    return "cohort_bytes" in record
+
+
+def slowest_variables(records, count=10):
+    records = [record for record in records if not is_cohort_record(record)]
+    return sorted(records, key=lambda record: record["seconds"], reverse=True)[:count]
+
+
+def format_summary(records, count=10):
+    # The `count` slowest variables of `records`, one per line, then the
+    # bytes written for each cohort and its largest column
+    cohorts = [record for record in records if is_cohort_record(record)]
+    records = [record for record in records if not is_cohort_record(record)]
+    lines = [f"Slowest {min(count, len(records))} of {len(records)} variables:"]
+    for record in slowest_variables(records, count):
+        study = record["study"]
+        if "shard" in record:
+            study += f" (shard {record['shard']})"
+        if "batch" in record:
+            study += f" (batch {record['batch']})"
+        lines.append(
+            f"  {record['seconds']:8.2f}s  {study} {record['variable']} "
+            f"({record['query_type']}, {record['rows_scanned']} rows scanned, "
+            f"{record['rows_returned']} returned)"
+        )
+    for cohort in cohorts:
+        columns = dict(cohort["bytes_written"])
+        columns.pop("patient_id", None)
+        line = f"  {cohort['study']}: {cohort['cohort_bytes']} bytes written"
+        if columns:
+            largest = max(columns, key=columns.get)
+            line += f" (largest column {largest}, {columns[largest]} bytes)"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,213 @@
+# Sharded extraction by patient_id range
+# Every variable is evaluated per patient, so the patients can be split into
+# shards that are extracted independently. The patients are divided into
+# contiguous patient_id ranges of about equal numbers of patients (see
+# shard_ranges); each shard scans only its patients' rows and evaluates
+# every study in a process of its own, writing its part of each cohort to a
+# temporary directory. The ranges are contiguous and every part is sorted by
+# patient_id, so the k-way merge of the parts is their concatenation in
+# range order: the merged cohort has the rows of a serial extraction, in the
+# same order, and is written by the same writer, so the output is the same.
+# Streamed (with a batch size or a memory ceiling), each shard evaluates its
+# patients a batch at a time, writing a part per batch (see
+# extraction/streaming.py), and the parts are written to the output one
+# batch of rows at a time (see part_batches) rather than concatenated.
+
+import itertools
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from extraction.multiwave import plan_scans
+from extraction.output import is_typed_format, output_path, write_cohort
+from extraction.profile import ExtractionProfile, profile_path
+from extraction.streaming import (
+    DEFAULT_BATCH_SIZE,
+    BatchSizer,
+    cohort_batches,
+    write_batches,
+)
+
+
+def shard_ranges(patient_ids, shards):
+    # Up to `shards` (first, stop) patient_id ranges holding about as many
+    # patients each; the first range has no lower bound and the last no
+    # upper bound, so together they cover every patient_id
+    patient_ids = np.unique(patient_ids)
+    firsts = [int(part[0]) for part in np.array_split(patient_ids, shards) if len(part)]
+    bounds = [None] + firsts[1:] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def part_path(parts_dir, key, number, batch=0):
+    return os.path.join(parts_dir, key, f"part-{number:05d}-{batch:05d}.pkl")
+
+
+def part_paths(parts_dir, key):
+    # Every part of a cohort, in shard then batch order
+    directory = os.path.join(parts_dir, key)
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+
+def part_batches(paths, batch_sizes):
+    # Batches of the rows of the parts at `paths`, in order, each part read
+    # only once the batches of the previous part are written
+    sizes = iter(batch_sizes)
+    for path in paths:
+        part = pd.read_pickle(path)
+        start = 0
+        while True:
+            stop = start + next(sizes)
+            yield part.iloc[start:stop]
+            if stop >= len(part):
+                break
+            start = stop
+        del part
+
+
+def extract_shard(job):
+    # Evaluates every study for the patients of one shard (a batch of them
+    # at a time with a batch size or a memory ceiling) and writes each part
+    # of each cohort to the parts directory; returns the profile records of
+    # each study (none without profiling)
+    (
+        source,
+        plan,
+        studies,
+        paths,
+        number,
+        patient_range,
+        parts_dir,
+        cache_dir,
+        workers,
+        population_pushdown,
+        profile,
+        connections,
+        timeout,
+        batch_size,
+        max_rss_mb,
+    ) = job
+    profiles = {key: ExtractionProfile(key) for key in studies} if profile else None
+    sizer = (
+        BatchSizer(batch_size or DEFAULT_BATCH_SIZE, max_rss_mb)
+        if batch_size or max_rss_mb
+        else None
+    )
+    batches = cohort_batches(
+        source,
+        plan,
+        studies,
+        {key: is_typed_format(path) for key, path in paths.items()},
+        patient_range,
+        sizer,
+        cache_dir,
+        workers,
+        population_pushdown,
+        profiles,
+        connections,
+        timeout,
+    )
+    parts = {key: 0 for key in studies}
+    for key, cohort in batches:
+        path = part_path(parts_dir, key, number, parts[key])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cohort.to_pickle(path)
+        parts[key] += 1
+        del cohort
+    records = {}
+    for key, shard_profile in (profiles or {}).items():
+        for record in shard_profile.records:
+            record["shard"] = number
+        records[key] = shard_profile.records
+    return records
+
+
+def extract_sharded(
+    source,
+    studies,
+    output_dir,
+    output_format="feather",
+    cache_dir=None,
+    workers=1,
+    population_pushdown=False,
+    profile_dir=None,
+    shards=2,
+    processes=None,
+    connections=1,
+    timeout=None,
+    batch_size=None,
+    max_rss_mb=None,
+    compression_threads=None,
+):
+    # As extract_waves, with the patients split into `shards` shards
+    # extracted by `processes` processes (one per shard, up to the number of
+    # CPUs, unless given)
+    ranges = shard_ranges(source.scan("patients")["patient_id"].to_numpy(), shards)
+    processes = processes or min(len(ranges), os.cpu_count() or 1)
+    paths = {
+        key: output_path(output_dir, f"input_{key}", output_format) for key in studies
+    }
+    definitions = {key: study.covariate_definitions for key, study in studies.items()}
+    plan = plan_scans(studies.values())
+    os.makedirs(output_dir, exist_ok=True)
+    parts_dir = tempfile.mkdtemp(prefix=".shards-", dir=output_dir)
+    try:
+        jobs = [
+            (
+                source,
+                plan,
+                definitions,
+                paths,
+                number,
+                patient_range,
+                parts_dir,
+                cache_dir,
+                workers,
+                population_pushdown,
+                profile_dir is not None,
+                connections,
+                timeout,
+                batch_size,
+                max_rss_mb,
+            )
+            for number, patient_range in enumerate(ranges)
+        ]
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                results = list(executor.map(extract_shard, jobs))
+        else:
+            results = [extract_shard(job) for job in jobs]
+
+        # Merge the parts of each cohort in range order, one cohort at a time
+        for key, study in studies.items():
+            parts = part_paths(parts_dir, key)
+            if batch_size or max_rss_mb:
+                # Every shard has been extracted, so the memory ceiling is not
+                # enforced while the parts are written
+                batch_sizes = itertools.repeat(batch_size or DEFAULT_BATCH_SIZE)
+                write_batches(
+                    part_batches(parts, batch_sizes),
+                    paths[key],
+                    study.covariate_definitions,
+                    compression_threads,
+                )
+            else:
+                cohort = pd.concat(map(pd.read_pickle, parts), ignore_index=True)
+                write_cohort(
+                    cohort, paths[key], study.covariate_definitions, compression_threads
+                )
+                del cohort
+            if profile_dir:
+                profile = ExtractionProfile(key)
+                profile.records = [
+                    record for records in results for record in records[key]
+                ]
+                profile.cohort_written(paths[key])
+                profile.write(profile_path(profile_dir, key))
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return paths
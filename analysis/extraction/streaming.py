@@ -0,0 +1,234 @@
+# Streamed extraction under a memory ceiling
+# Evaluating a whole cohort holds every patient's source rows, evaluated
+# columns and formatted output at once. A streamed extraction takes the
+# patients a batch at a time instead: each batch is a contiguous patient_id
+# range (as a shard is, see extraction/shards.py) whose rows are scanned
+# from the source, every study is evaluated for those patients only and
+# appended to its output (through a CohortWriter), and the batch is
+# released before the next range is scanned. Every variable is evaluated
+# per patient and the ranges are in patient_id order, so the outputs have
+# the rows of a whole-cohort extraction, in the same order. The source is
+# scanned once per batch, so a smaller batch trades time for memory.
+# A BatchSizer sets the number of patients in each batch: after each batch
+# is written it reads the resident set size of the process, and while that
+# is above the ceiling it halves the batch size, down to MINIMUM_BATCH_SIZE.
+# Above the ceiling at the smallest batch size, the extraction fails (and
+# the partial outputs are removed) rather than grow further. Where only the
+# peak resident set size can be read (see rss_mb), which never comes down,
+# the batches are halved but the extraction does not fail.
+
+import contextlib
+import os
+import resource
+import sys
+
+import numpy as np
+
+from extraction.backend import LocalBackend
+from extraction.blocks import index_path
+from extraction.cache import VariableCache
+from extraction.multiwave import plan_scans, scan_tables
+from extraction.output import CohortWriter, is_typed_format, output_path
+from extraction.profile import ExtractionProfile, profile_path
+
+DEFAULT_BATCH_SIZE = 100_000
+
+MINIMUM_BATCH_SIZE = 1_000
+
+
+def rss_mb():
+    # (resident set size, whether it is current): the current size from /proc
+    # or psutil where either is available, otherwise the peak size
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20, True
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (2**20 if sys.platform == "darwin" else 1024), False
+    return psutil.Process().memory_info().rss / 2**20, True
+
+
+class BatchSizer:
+    # Iterating gives the current batch size, for patient_batches
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_rss_mb=None):
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be at least 1, not {batch_size}")
+        self.size = batch_size
+        self.max_rss_mb = max_rss_mb
+
+    def __iter__(self):
+        while True:
+            yield self.size
+
+    def update(self):
+        # Called after each batch is written
+        if self.max_rss_mb is None:
+            return
+        rss, current = rss_mb()
+        if rss <= self.max_rss_mb:
+            return
+        if self.size <= MINIMUM_BATCH_SIZE:
+            if not current:
+                return
+            raise MemoryError(
+                f"Resident set size of {rss:.0f} MB is above the ceiling of "
+                f"{self.max_rss_mb:.0f} MB at a batch size of {self.size}"
+            )
+        self.size = max(self.size // 2, MINIMUM_BATCH_SIZE)
+
+
+def patient_batches(patient_ids, batch_sizes, patient_range=None):
+    # (first, stop) patient_id ranges of consecutive batches of the
+    # `patient_ids`, each of the next size in `batch_sizes` (read as the
+    # batch is started, so a BatchSizer's update applies to the next batch).
+    # The ranges start and end at the bounds of `patient_range` (none by
+    # default), so together they cover every patient_id in it; there is
+    # always at least one batch, so an empty cohort has its header written
+    patient_ids = np.unique(patient_ids)
+    first, stop = patient_range or (None, None)
+    sizes = iter(batch_sizes)
+    start = 0
+    while True:
+        end = start + next(sizes)
+        if end >= len(patient_ids):
+            yield first, stop
+            return
+        yield first, int(patient_ids[end])
+        first = int(patient_ids[end])
+        start = end
+
+
+def cohort_batches(
+    source,
+    plan,
+    studies,
+    typed,
+    patient_range=None,
+    sizer=None,
+    cache_dir=None,
+    workers=1,
+    population_pushdown=False,
+    profiles=None,
+    connections=1,
+    timeout=None,
+):
+    # Evaluates each study (covariate definitions by key, `typed` by key)
+    # for the patients in `patient_range` a batch at a time, yielding
+    # (key, cohort) for each study of each batch in turn; without a sizer
+    # the patients are one batch. Cached entries hold the batch's patients,
+    # so are cached per batch range. `profiles` (by key) record the
+    # variables of every batch, numbered by batch when there are batches
+    ranges = [patient_range or (None, None)]
+    if sizer:
+        patients = source.scan("patients", patient_range=patient_range, timeout=timeout)
+        ranges = patient_batches(patients["patient_id"].to_numpy(), sizer, patient_range)
+        del patients
+    for number, batch_range in enumerate(ranges):
+        tables = scan_tables(source, plan, batch_range, connections, timeout)
+        cache = (
+            VariableCache(cache_dir, (source.snapshot(), batch_range))
+            if cache_dir
+            else None
+        )
+        backend = LocalBackend(tables, cache, workers, population_pushdown)
+        del tables
+        for key, covariate_definitions in studies.items():
+            profile = profiles[key] if profiles else None
+            backend.hooks = [profile] if profile else []
+            recorded = len(profile.records) if profile else 0
+            yield key, backend.to_dataframe(covariate_definitions, typed[key])
+            if profile and sizer:
+                for record in profile.records[recorded:]:
+                    record["batch"] = number
+        del backend
+        if sizer:
+            sizer.update()
+
+
+def remove_output(path):
+    # Removes a partial output and its block index (see extraction/blocks.py)
+    for partial in (path, index_path(path)):
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def extract_streamed(
+    source,
+    studies,
+    output_dir,
+    output_format="feather",
+    cache_dir=None,
+    workers=1,
+    population_pushdown=False,
+    profile_dir=None,
+    connections=1,
+    timeout=None,
+    batch_size=None,
+    max_rss_mb=None,
+    compression_threads=None,
+):
+    # As extract_waves, evaluating and writing every study a batch of
+    # patients at a time
+    paths = {
+        key: output_path(output_dir, f"input_{key}", output_format) for key in studies
+    }
+    definitions = {key: study.covariate_definitions for key, study in studies.items()}
+    typed = {key: is_typed_format(path) for key, path in paths.items()}
+    profiles = (
+        {key: ExtractionProfile(key) for key in studies} if profile_dir else None
+    )
+    batches = cohort_batches(
+        source,
+        plan_scans(studies.values()),
+        definitions,
+        typed,
+        sizer=BatchSizer(batch_size or DEFAULT_BATCH_SIZE, max_rss_mb),
+        cache_dir=cache_dir,
+        workers=workers,
+        population_pushdown=population_pushdown,
+        profiles=profiles,
+        connections=connections,
+        timeout=timeout,
+    )
+    try:
+        with contextlib.ExitStack() as stack:
+            writers = {
+                key: stack.enter_context(
+                    CohortWriter(paths[key], definitions[key], compression_threads)
+                )
+                for key in studies
+            }
+            for key, cohort in batches:
+                writers[key].write(cohort)
+                del cohort
+    except BaseException:
+        for path in paths.values():
+            remove_output(path)
+        raise
+    for key, profile in (profiles or {}).items():
+        profile.cohort_written(paths[key])
+        profile.write(profile_path(profile_dir, key))
+    return paths
+
+
+def write_batches(batches, path, covariate_definitions, compression_threads=None):
+    # Writes each batch (a frame of output rows) to `path` in turn; returns
+    # the number of rows written
+    rows = 0
+    try:
+        with CohortWriter(path, covariate_definitions, compression_threads) as writer:
+            for batch in batches:
+                writer.write(batch)
+                rows += len(batch)
+                del batch
+    except BaseException:
+        remove_output(path)
+        raise
+    return rows
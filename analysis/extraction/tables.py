@@ -0,0 +1,358 @@
+# Source tables for the local extraction layer
+# Each table mirrors the parts of the corresponding TPP table that the study
+# definitions in this repo use. Event tables are held in long format (one row
+# per coded event / diagnosis / cause of death).
+# Tables are read from a directory of Parquet files or from a SQLite or
+# DuckDB database file (see open_source); every source pushes the code and
+# date restrictions of a scan down into the read, and the patient_id range
+# of a shard (see extraction/shards.py). A scan running longer than its
+# `timeout` (in seconds) raises TimeoutError.
+
+import contextlib
+import datetime
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from extraction.dates import OPEN_END_DATE, to_date_array
+
+TABLE_COLUMNS = {
+    "patients": {
+        "patient_id": "int",
+        "date_of_birth": "date",
+        "sex": "str",
+        "date_of_death": "date",
+    },
+    "clinical_events": {
+        "patient_id": "int",
+        "date": "date",
+        "code": "str",
+        "numeric_value": "float",
+        "comparator": "str",
+    },
+    "medications": {
+        "patient_id": "int",
+        "date": "date",
+        "code": "str",
+    },
+    "apcs": {
+        "patient_id": "int",
+        "admission_date": "date",
+        "admission_method": "str",
+        "diagnosis": "str",
+        "ethnicity": "str",
+    },
+    "ecds": {
+        "patient_id": "int",
+        "arrival_date": "date",
+        "diagnosis": "str",
+        "ethnicity": "str",
+    },
+    "sgss": {
+        "patient_id": "int",
+        "specimen_date": "date",
+        "pathogen": "str",
+        "result": "str",
+    },
+    "vaccinations": {
+        "patient_id": "int",
+        "date": "date",
+        "target_disease": "str",
+        "product_name": "str",
+    },
+    "ons_deaths": {
+        "patient_id": "int",
+        "date": "date",
+        "cause": "str",
+        "underlying": "bool",
+    },
+    "registrations": {
+        "patient_id": "int",
+        "start_date": "date",
+        "end_date": "date",
+        "stp_code": "str",
+        "nuts1_region_name": "str",
+    },
+    "addresses": {
+        "patient_id": "int",
+        "start_date": "date",
+        "end_date": "date",
+        "imd_rounded": "int",
+        "is_potential_care_home": "bool",
+        "location_requires_nursing": "str",
+        "location_does_not_require_nursing": "str",
+    },
+}
+
+# Column holding the event date, for tables that can be restricted by date
+EVENT_DATE_COLUMNS = {
+    "clinical_events": "date",
+    "medications": "date",
+    "apcs": "admission_date",
+    "ecds": "arrival_date",
+    "sgss": "specimen_date",
+    "vaccinations": "date",
+    "ons_deaths": "date",
+}
+
+# Column holding the event code, for tables that can be restricted by code
+# (ICD-10 diagnoses in apcs and ons_deaths are prefix-matched, so they are
+# only restricted in memory)
+CODE_COLUMNS = {
+    "clinical_events": "code",
+    "medications": "code",
+    "ecds": "diagnosis",
+}
+
+
+def normalise_table(table, frame):
+    # Coerces a raw frame to the column types in TABLE_COLUMNS
+    columns = TABLE_COLUMNS[table]
+    frame = frame.reindex(columns=list(columns))
+    for column, column_type in columns.items():
+        values = frame[column]
+        if column_type == "date":
+            dates = to_date_array(values)
+            if column == "end_date":
+                dates[np.isnat(dates)] = OPEN_END_DATE
+            frame[column] = dates
+        elif column_type == "int":
+            frame[column] = values.fillna(0).astype("int64")
+        elif column_type == "float":
+            frame[column] = values.astype("float64")
+        elif column_type == "bool":
+            frame[column] = values.fillna(False).astype(bool)
+        else:
+            frame[column] = values.fillna("").astype(str)
+    return frame.reset_index(drop=True)
+
+
+def file_snapshot(paths):
+    # Identifies the current contents of a source (for the variable cache) by
+    # the size and modification time of each of its files; a partitioned
+    # table is a directory of part files
+    files = []
+    for path in paths:
+        parts = [path]
+        if os.path.isdir(path):
+            parts = sorted(glob.glob(os.path.join(path, "*")))
+        for part in parts:
+            if os.path.isfile(part):
+                stat = os.stat(part)
+                name = os.path.relpath(part, os.path.dirname(path))
+                files.append((name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1(repr(files).encode()).hexdigest()
+
+
+class ParquetSource:
+    # Reads tables from `<directory>/<table>.parquet` (dates stored as date32),
+    # either a file or a directory of part files (see extraction/fixtures.py),
+    # pushing code and date restrictions down into the Parquet reader so each
+    # table is read once. A Parquet read cannot be interrupted, so `timeout`
+    # is checked between the record batches of a scan
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, table):
+        return os.path.join(self.directory, f"{table}.parquet")
+
+    def snapshot(self):
+        return file_snapshot([self.path(table) for table in TABLE_COLUMNS])
+
+    def scan(
+        self, table, codes=None, start=None, end=None, patient_range=None, timeout=None
+    ):
+        # `patient_range` is (first, stop): patient_ids from `first` up to but
+        # not including `stop`, where either may be None
+        started = time.monotonic()
+        filters = []
+        first, stop = patient_range or (None, None)
+        if first is not None:
+            filters.append(("patient_id", ">=", int(first)))
+        if stop is not None:
+            filters.append(("patient_id", "<", int(stop)))
+        if codes is not None and table in CODE_COLUMNS:
+            filters.append((CODE_COLUMNS[table], "in", sorted(codes)))
+        if table in EVENT_DATE_COLUMNS:
+            date_column = EVENT_DATE_COLUMNS[table]
+            if start is not None:
+                filters.append((date_column, ">=", datetime.date.fromisoformat(start)))
+            if end is not None:
+                filters.append((date_column, "<=", datetime.date.fromisoformat(end)))
+        if not os.path.exists(self.path(table)):
+            return normalise_table(table, pd.DataFrame())
+        scanner = ds.dataset(
+            self.path(table), format="parquet", partitioning="hive"
+        ).scanner(
+            columns=list(TABLE_COLUMNS[table]),
+            filter=pq.filters_to_expression(filters) if filters else None,
+        )
+        batches = []
+        for batch in scanner.to_batches():
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(
+                    f"Scan of {table} did not finish within {timeout} seconds"
+                )
+            batches.append(batch)
+        frame = pa.Table.from_batches(batches, scanner.projected_schema).to_pandas()
+        return normalise_table(table, frame)
+
+
+class DatabaseSource:
+    # Reads tables of the same names and columns from a database file, as a
+    # SELECT with the code and date restrictions in its WHERE clause. Codes
+    # are joined from a temporary table, as codelists can be longer than the
+    # number of parameters a statement may have. Dates may be stored as DATE
+    # or as ISO 8601 strings (see SQLiteSource). Each scan opens a connection of its own, so scans
+    # can run concurrently (see extraction/pool.py); a scan running longer
+    # than its `timeout` (in seconds) is interrupted and raises TimeoutError.
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+
+    def snapshot(self):
+        return file_snapshot([self.path])
+
+    def scan(
+        self, table, codes=None, start=None, end=None, patient_range=None, timeout=None
+    ):
+        with self.connect() as connection:
+            if table not in self.table_names(connection):
+                return normalise_table(table, pd.DataFrame())
+            conditions = []
+            parameters = []
+            first, stop = patient_range or (None, None)
+            if first is not None:
+                conditions.append("patient_id >= ?")
+                parameters.append(int(first))
+            if stop is not None:
+                conditions.append("patient_id < ?")
+                parameters.append(int(stop))
+            if codes is not None and table in CODE_COLUMNS:
+                connection.execute("CREATE TEMPORARY TABLE scan_codes (code TEXT)")
+                connection.executemany(
+                    "INSERT INTO scan_codes VALUES (?)", [(code,) for code in sorted(codes)]
+                )
+                conditions.append(
+                    f"{CODE_COLUMNS[table]} IN (SELECT code FROM scan_codes)"
+                )
+            if table in EVENT_DATE_COLUMNS:
+                date_column = EVENT_DATE_COLUMNS[table]
+                if start is not None:
+                    conditions.append(self.date_condition(date_column, ">="))
+                    parameters.append(start)
+                if end is not None:
+                    conditions.append(self.date_condition(date_column, "<="))
+                    parameters.append(end)
+            columns = [
+                column
+                for column in TABLE_COLUMNS[table]
+                if column in self.column_names(connection, table)
+            ]
+            query = f"SELECT {', '.join(columns)} FROM {table}"
+            if conditions:
+                query += f" WHERE {' AND '.join(conditions)}"
+            timer = None
+            interrupted = threading.Event()
+            if timeout is not None:
+
+                def interrupt():
+                    interrupted.set()
+                    connection.interrupt()
+
+                timer = threading.Timer(timeout, interrupt)
+                timer.start()
+            try:
+                frame = self.read(connection, query, parameters)
+            except Exception as error:
+                if interrupted.is_set():
+                    raise TimeoutError(
+                        f"Scan of {table} did not finish within {timeout} seconds"
+                    ) from error
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        return normalise_table(table, frame)
+
+    def date_condition(self, column, operator):
+        return f"CAST({column} AS DATE) {operator} CAST(? AS DATE)"
+
+
+class SQLiteSource(DatabaseSource):
+    # SQLite has no DATE type, so dates must be stored as ISO 8601 strings
+    # ("2021-06-01", optionally with a time); they are compared through
+    # date(), which drops the time (and is NULL for any other format)
+
+    def connect(self):
+        return contextlib.closing(sqlite3.connect(f"file:{self.path}?mode=ro", uri=True))
+
+    def table_names(self, connection):
+        rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return {name for (name,) in rows}
+
+    def column_names(self, connection, table):
+        return {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+
+    def date_condition(self, column, operator):
+        return f"date({column}) {operator} date(?)"
+
+    def read(self, connection, query, parameters):
+        return pd.read_sql_query(query, connection, params=parameters)
+
+
+class DuckDBSource(DatabaseSource):
+    # Needs the duckdb package, which is only imported for DuckDB sources
+
+    def connect(self):
+        import duckdb
+
+        return contextlib.closing(duckdb.connect(self.path, read_only=True))
+
+    def table_names(self, connection):
+        return {name for (name,) in connection.execute("SHOW TABLES").fetchall()}
+
+    def column_names(self, connection, table):
+        return {
+            name
+            for (name,) in connection.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = ?",
+                [table],
+            ).fetchall()
+        }
+
+    def read(self, connection, query, parameters):
+        return connection.execute(query, parameters).df()
+
+
+DATABASE_SOURCES = {
+    ".sqlite": SQLiteSource,
+    ".sqlite3": SQLiteSource,
+    ".db": SQLiteSource,
+    ".duckdb": DuckDBSource,
+}
+
+
+def open_source(path):
+    # Source for a directory of Parquet files or a SQLite/DuckDB file
+    if os.path.isdir(path):
+        return ParquetSource(path)
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in DATABASE_SOURCES:
+        raise ValueError(
+            f"Unsupported source: {path} (expected a directory of Parquet files "
+            f"or a {', '.join(DATABASE_SOURCES)} file)"
+        )
+    return DATABASE_SOURCES[extension](path)
@@ -0,0 +1,107 @@
+# Shared fixtures for the extraction tests
+# Source tables are built by hand (make_tables), so that each test states
+# the rows a query should match, or generated at a small scale from the
+# study definitions (fixture_source) for tests comparing extraction modes.
+# The study definitions read config.json and the codelists relative to the
+# repository root, so the tests run from there.
+
+import gzip
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+ANALYSIS_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+REPOSITORY_DIR = os.path.dirname(ANALYSIS_DIR)
+
+if ANALYSIS_DIR not in sys.path:
+    sys.path.insert(0, ANALYSIS_DIR)
+
+from extraction.tables import TABLE_COLUMNS, normalise_table  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def repository_dir():
+    working_dir = os.getcwd()
+    os.chdir(REPOSITORY_DIR)
+    yield REPOSITORY_DIR
+    os.chdir(working_dir)
+
+
+def build_tables(**frames):
+    # Every source table, normalised, with `frames` (table name -> dict of
+    # columns) and the other tables empty
+    return {
+        table: normalise_table(table, pd.DataFrame(frames.get(table, {})))
+        for table in TABLE_COLUMNS
+    }
+
+
+@pytest.fixture
+def make_tables():
+    return build_tables
+
+
+@pytest.fixture(scope="session")
+def studies(repository_dir):
+    # The wave studies and the era study, by key
+    from extraction.multiwave import load_era_study, load_wave_studies, wave_keys
+    from study_factory import load_config
+
+    studies = load_wave_studies(wave_keys(load_config()))
+    studies["era"] = load_era_study()
+    return studies
+
+
+@pytest.fixture(scope="session")
+def fixture_source(tmp_path_factory, studies):
+    # Synthetic source tables for every study, as Parquet
+    from extraction.fixtures import FixtureSpec, write_fixtures
+    from extraction.tables import ParquetSource
+    from study_factory import load_config
+
+    directory = str(tmp_path_factory.mktemp("fixtures"))
+    spec = FixtureSpec(list(studies.values()), load_config(), events_per_patient=20)
+    write_fixtures(spec, directory, 600, seed=1, chunk_size=250)
+    return ParquetSource(directory)
+
+
+@pytest.fixture(scope="session")
+def serial_outputs(tmp_path_factory, fixture_source, studies):
+    # Output paths of a serial extraction of every study from
+    # fixture_source, by output format then study key (extracted once per
+    # format), for tests comparing other extraction modes with it
+    from extraction.multiwave import extract_waves
+
+    outputs = {}
+
+    def extract(output_format):
+        if output_format not in outputs:
+            directory = str(tmp_path_factory.mktemp(f"serial-{output_format}"))
+            outputs[output_format] = extract_waves(
+                fixture_source, studies, directory, output_format
+            )
+        return outputs[output_format]
+
+    return extract
+
+
+def assert_same_outputs(paths, expected_paths):
+    # Outputs with the same content: identical files (decompressed for
+    # csv.gz, whose gzip header records the time it was written), or for
+    # typed formats identical frames (Arrow metadata may differ)
+    assert list(paths) == list(expected_paths)
+    for key, path in paths.items():
+        if path.endswith((".feather", ".parquet")):
+            read = pd.read_feather if path.endswith(".feather") else pd.read_parquet
+            assert read(path).equals(read(expected_paths[key])), key
+        else:
+            read = gzip.open if path.endswith(".gz") else open
+            with read(path, "rb") as f, read(expected_paths[key], "rb") as expected:
+                assert f.read() == expected.read(), key
+
+
+@pytest.fixture
+def same_outputs():
+    return assert_same_outputs
@@ -0,0 +1,265 @@
+# LocalBackend against the query semantics of cohortextractor's TPP backend
+# Each test evaluates a small study definition over hand-built tables and
+# checks the values the TPP backend returns for them: event windows are
+# inclusive of both bounds, first/last matches are by date, registrations
+# and addresses are active from their start date up to (not including)
+# their end date, and empty values are written as cohortextractor writes
+# them. The outputs of the wave and era studies are checked against
+# cohortextractor's own validation of a cohort file's columns and of the
+# format of each value (for CSV, the text the TPP backend writes; typed
+# formats store dates as date32, where cohortextractor writes timestamps).
+# The source rows each variable reads are counted in its stats.
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+from cohortextractor.validate_dummy_data import (
+    validate_dummy_data,
+    validate_expected_columns,
+)
+
+from extraction.backend import LocalBackend, coerce_column
+from extraction.output import output_path, write_cohort
+
+CODES = codelist(["X1", "X2"], system="ctv3")
+
+CATEGORISED_CODES = codelist([("X1", "1"), ("X2", "2")], system="ctv3")
+
+PATIENTS = {
+    "patient_id": [1, 2, 3],
+    "date_of_birth": ["1980-06-01", "1980-06-02", "2000-01-01"],
+    "sex": ["F", "M", "F"],
+    "date_of_death": [None, None, "2021-03-01"],
+}
+
+REGISTRATIONS = {
+    "patient_id": [1, 1, 2, 3],
+    "start_date": ["2010-01-01", "2021-06-01", "2010-01-01", "2010-01-01"],
+    "end_date": ["2021-06-01", None, None, None],
+    "stp_code": ["E1", "E2", "E3", "E4"],
+    "nuts1_region_name": ["London", "North West", "London", "London"],
+}
+
+CLINICAL_EVENTS = {
+    "patient_id": [1, 1, 1, 2, 3],
+    "date": ["2020-03-01", "2021-06-01", "2021-06-02", "2019-01-01", "2021-01-01"],
+    "code": ["X1", "X2", "X1", "X1", "Y1"],
+    "numeric_value": [30.0, 40.0, 50.0, 60.0, 70.0],
+}
+
+
+def evaluate(tables, population=None, **variables):
+    # The output frame (as written to CSV) of a study of `variables`,
+    # indexed by patient_id; every patient is registered throughout 2010-2019
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=population
+        or patients.registered_with_one_practice_between("2010-01-01", "2019-12-31"),
+        **variables,
+    )
+    frame = LocalBackend(tables).to_dataframe(study.covariate_definitions)
+    return frame.set_index("patient_id")
+
+
+@pytest.fixture
+def tables(make_tables):
+    return make_tables(
+        patients=PATIENTS, registrations=REGISTRATIONS, clinical_events=CLINICAL_EVENTS
+    )
+
+
+def test_event_window_includes_both_bounds(tables):
+    frame = evaluate(
+        tables,
+        last=patients.with_these_clinical_events(
+            CODES,
+            between=["2020-03-01", "index_date"],
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        first=patients.with_these_clinical_events(
+            CODES,
+            between=["2020-03-01", "index_date"],
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+    )
+    assert frame["last"].to_dict() == {1: "2021-06-01", 2: "", 3: ""}
+    assert frame["first"].to_dict() == {1: "2020-03-01", 2: "", 3: ""}
+
+
+def test_on_or_before_index_date(tables):
+    frame = evaluate(
+        tables,
+        flag=patients.with_these_clinical_events(CODES, on_or_before="index_date"),
+        count=patients.with_these_clinical_events(
+            CODES, on_or_before="index_date", returning="number_of_matches_in_period"
+        ),
+        month=patients.with_these_clinical_events(
+            CODES,
+            on_or_before="index_date",
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM",
+        ),
+    )
+    assert frame["flag"].to_dict() == {1: 1, 2: 1, 3: 0}
+    assert frame["count"].to_dict() == {1: 2, 2: 1, 3: 0}
+    assert frame["month"].to_dict() == {1: "2021-06", 2: "2019-01", 3: ""}
+
+
+def test_returning_values_of_the_selected_match(tables):
+    frame = evaluate(
+        tables,
+        code=patients.with_these_clinical_events(
+            CODES, on_or_before="index_date", returning="code", find_last_match_in_period=True
+        ),
+        category=patients.with_these_clinical_events(
+            CATEGORISED_CODES,
+            on_or_before="index_date",
+            returning="category",
+            find_first_match_in_period=True,
+        ),
+        value=patients.with_these_clinical_events(
+            CODES,
+            on_or_before="index_date",
+            returning="numeric_value",
+            find_last_match_in_period=True,
+        ),
+    )
+    assert frame["code"].to_dict() == {1: "X2", 2: "X1", 3: ""}
+    assert frame["category"].to_dict() == {1: "1", 2: "1", 3: ""}
+    assert frame["value"].to_dict() == {1: 40.0, 2: 60.0, 3: 0.0}
+
+
+def test_as_of_patient_attributes(tables):
+    frame = evaluate(
+        tables,
+        age=patients.age_as_of("index_date"),
+        stp=patients.registered_practice_as_of("index_date", returning="stp_code"),
+        died=patients.died_from_any_cause(
+            on_or_before="index_date", returning="date_of_death", date_format="YYYY-MM-DD"
+        ),
+    )
+    # Patient 2 is a day short of their birthday
+    assert frame["age"].to_dict() == {1: 41, 2: 40, 3: 21}
+    # A registration ending on the index date is no longer active
+    assert frame["stp"].to_dict() == {1: "E2", 2: "E3", 3: "E4"}
+    assert frame["died"].to_dict() == {1: "", 2: "", 3: ""}
+
+
+def test_population_requires_registration_throughout(tables):
+    # Patient 1 changed practice on the index date
+    frame = evaluate(
+        tables,
+        population=patients.registered_with_one_practice_between(
+            "2020-06-01", "index_date"
+        ),
+        sex=patients.sex(),
+    )
+    assert list(frame.index) == [2, 3]
+
+
+def test_expressions_over_other_variables(tables):
+    frame = evaluate(
+        tables,
+        age=patients.age_as_of("index_date"),
+        sex=patients.sex(),
+        older_woman=patients.satisfying("age > 40 AND sex = 'F'"),
+        age_group=patients.categorised_as(
+            {"0": "DEFAULT", "young": "age < 30", "old": "age >= 30"},
+            return_expectations={
+                "category": {"ratios": {"young": 0.5, "old": 0.5}},
+                "incidence": 1,
+            },
+        ),
+    )
+    assert frame["older_woman"].to_dict() == {1: 1, 2: 0, 3: 0}
+    assert frame["age_group"].to_dict() == {1: "old", 2: "old", 3: "young"}
+
+
+@pytest.mark.parametrize("population_pushdown", [False, True])
+def test_rows_scanned(tables, population_pushdown):
+    study = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=patients.registered_with_one_practice_between(
+            "2020-06-01", "index_date"
+        ),
+        sex=patients.sex(),
+        age=patients.age_as_of("index_date"),
+        older_woman=patients.satisfying("age > 40 AND sex = 'F'"),
+        first=patients.with_these_clinical_events(
+            CODES, returning="date", find_first_match_in_period=True
+        ),
+        count=patients.with_these_clinical_events(
+            CODES, returning="number_of_matches_in_period"
+        ),
+    )
+    backend = LocalBackend(tables, population_pushdown=population_pushdown)
+    backend.evaluate(study.covariate_definitions)
+    rows = {
+        name: stats["rows_scanned"] for name, stats in backend.variable_stats.items()
+    }
+    # With pushdown, patients 2 and 3 only; the codes are matched in one
+    # shared scan of every event, split between its variables
+    patient_rows = 2 if population_pushdown else 3
+    assert rows == {
+        "population": 4,
+        "sex": patient_rows,
+        "age": patient_rows,
+        "older_woman": 0,
+        "first": 3,
+        "count": 2,
+    }
+
+
+@pytest.mark.parametrize("output_format", ["csv", "feather"])
+def test_outputs_pass_cohortextractor_validation(
+    fixture_source, studies, tmp_path, output_format
+):
+    # Every visible column, and only those, with values in the format
+    # cohortextractor writes for its column type and date format
+    from extraction.multiwave import plan_scans, scan_tables
+    from extraction.output import is_typed_format
+
+    backend = LocalBackend(scan_tables(fixture_source, plan_scans(studies.values())))
+    for key, study in studies.items():
+        path = output_path(str(tmp_path), f"input_{key}", output_format)
+        frame = backend.to_dataframe(
+            study.covariate_definitions, typed=is_typed_format(path)
+        )
+        assert len(frame)
+        write_cohort(frame, path, study.covariate_definitions)
+        if output_format == "csv":
+            validate_dummy_data(study.covariate_definitions, pathlib.Path(path))
+        else:
+            validate_expected_columns(
+                pd.read_feather(path), study.covariate_definitions
+            )
+
+
+def test_coerce_column():
+    def coerce(values, column_type, empty_value):
+        return coerce_column(np.array(values, dtype=object), column_type, empty_value)
+
+    flags = coerce([1, True, "1", 0, "", False], "bool", False)
+    assert flags.tolist() == [True, True, True, False, False, False]
+    assert coerce(["12", "", 3], "int", -1).tolist() == [12, -1, 3]
+    assert coerce([1.5, np.nan], "float", 0.0).tolist() == [1.5, 0.0]
+    assert coerce(["E1", None], "str", "").tolist() == ["E1", ""]
+    assert coerce([3, None, 1.5], "str", "").tolist() == ["3", "", "1.5"]
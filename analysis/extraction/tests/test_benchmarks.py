@@ -0,0 +1,89 @@
+# Benchmark results against a baseline, and the peak RSS of each variable
+
+import resource
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import extraction.benchmarks
+from extraction.benchmarks import MINIMUM_SECONDS, PeakMemory, compare
+
+
+def results(**group_seconds):
+    # Results of wave1 at 10k patients with the given times by group
+    groups = {group: {"seconds": seconds} for group, seconds in group_seconds.items()}
+    return {"10000": {"wave1": {"groups": groups}}}
+
+
+def test_groups_slower_than_the_threshold_are_regressions():
+    baseline = results(demographics=1.0, outcomes=1.0, comorbidities=1.0)
+    regressions = compare(
+        results(demographics=1.3, outcomes=1.1, comorbidities=0.5), baseline, 0.2
+    )
+    assert regressions == [
+        {
+            "scale": "10000",
+            "study": "wave1",
+            "group": "demographics",
+            "baseline_seconds": 1.0,
+            "seconds": 1.3,
+            "change": pytest.approx(0.3),
+        }
+    ]
+    # Within a larger threshold
+    assert compare(results(demographics=1.3), baseline, 0.5) == []
+
+
+def test_small_differences_are_not_regressions():
+    # Twice as slow, but by less than MINIMUM_SECONDS
+    baseline = results(demographics=0.01, outcomes=0.0)
+    assert compare(results(demographics=0.02, outcomes=0.01), baseline, 0.2) == []
+    slower = 0.01 + 2 * MINIMUM_SECONDS
+    regressions = compare(results(demographics=slower, outcomes=slower), baseline, 0.2)
+    assert [regression["group"] for regression in regressions] == [
+        "demographics",
+        "outcomes",
+    ]
+    # A group that took no time before has no relative change
+    assert regressions[1]["change"] is None
+
+
+def test_results_missing_from_the_baseline_are_not_compared():
+    baseline = results(demographics=1.0)
+    assert compare(results(demographics=1.0, outcomes=9.0), baseline, 0.2) == []
+    assert compare({"100000": results(demographics=9.0)["10000"]}, baseline, 0.2) == []
+    assert compare(results(demographics=9.0), {}, 0.2) == []
+
+
+@pytest.mark.parametrize("platform, units", [("darwin", 2**20), ("linux", 2**10)])
+def test_peak_rss_units(monkeypatch, platform, units):
+    # Without /proc, the peak is read from ru_maxrss
+    def no_proc(*args, **kwargs):
+        raise OSError
+
+    monkeypatch.setattr("builtins.open", no_proc)
+    monkeypatch.setattr(sys, "platform", platform)
+    monkeypatch.setattr(
+        resource, "getrusage", lambda _: SimpleNamespace(ru_maxrss=300 * units)
+    )
+    assert extraction.benchmarks.peak_rss_mb() == 300
+    assert not extraction.benchmarks.reset_peak_rss()
+
+
+def test_peak_rss_of_each_variable():
+    memory = PeakMemory()
+    if not memory.resettable:
+        pytest.skip("The peak RSS cannot be reset on this platform")
+    memory.variable_started("small", None, {})
+    memory.variable_finished("small", None, {}, {})
+    memory.variable_started("large", None, {})
+    np.ones(2**25).sum()  # 256 MB
+    memory.variable_finished("large", None, {}, {})
+    memory.variable_started("after", None, {})
+    memory.variable_finished("after", None, {}, {})
+    assert memory.peaks["large"] > memory.peaks["small"] + 200
+    # The peak of a later variable does not include the earlier ones
+    assert memory.peaks["after"] < memory.peaks["large"] - 200
+    assert memory.process_peak_mb() >= memory.peaks["large"]
@@ -0,0 +1,134 @@
+# Block-compressed (BGZF) CSV output and its patient index
+
+import gzip
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from extraction.blocks import (
+    BLOCK_SIZE,
+    EOF_BLOCK,
+    BlockWriter,
+    block_size,
+    compress_block,
+    decompress_block,
+    index_path,
+    read_blocks,
+    read_index,
+)
+from extraction.output import write_cohort
+
+
+@pytest.fixture
+def frame():
+    # Enough rows for several blocks; patient_ids in order with gaps
+    rng = np.random.default_rng(0)
+    size = 20000
+    return pd.DataFrame(
+        {
+            "patient_id": np.arange(1, size + 1) * 3,
+            "age": rng.integers(0, 100, size),
+            "stp": rng.choice(["E1", "E2", ""], size),
+            "value": rng.normal(50, 10, size).round(2),
+        }
+    )
+
+
+def write_blocks(frame, path, threads, chunk_size=7000):
+    writer = BlockWriter(path, threads)
+    writer.write_header(frame.iloc[:0].to_csv(index=False))
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start : start + chunk_size]
+        writer.write_rows(
+            chunk.to_csv(index=False, header=False), chunk["patient_id"].to_numpy()
+        )
+    writer.close()
+
+
+@pytest.mark.parametrize("size", [0, 100, BLOCK_SIZE])
+def test_block_round_trip(size):
+    data = np.random.default_rng(size).bytes(size)
+    block = compress_block(data)
+    # Incompressible data is stored, so still fits the 16-bit size field
+    assert len(block) <= 0x10000
+    assert block_size(block[:18]) == len(block)
+    assert decompress_block(block) == data
+    assert gzip.decompress(block) == data
+
+
+def test_empty_block_ends_the_file():
+    assert gzip.decompress(EOF_BLOCK) == b""
+    assert block_size(EOF_BLOCK[:18]) == len(EOF_BLOCK)
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_blocks_are_read_as_gzip(frame, tmp_path, threads):
+    path = str(tmp_path / "input.csv.gz")
+    write_blocks(frame, path, threads)
+    with gzip.open(path, "rb") as f:
+        assert f.read() == frame.to_csv(index=False).encode()
+    assert pd.read_csv(path, keep_default_na=False).astype(frame.dtypes).equals(frame)
+
+
+def test_index(frame, tmp_path):
+    path = str(tmp_path / "input.csv.gz")
+    write_blocks(frame, path, 2)
+    index = read_index(path)
+    assert len(index) > 3
+    assert index["rows"].sum() == len(frame)
+    assert index["first_patient_id"].iloc[0] == frame["patient_id"].iloc[0]
+    assert index["last_patient_id"].iloc[-1] == frame["patient_id"].iloc[-1]
+    # Blocks are contiguous and in patient_id order, after the header block
+    ends = (index["offset"] + index["size"]).to_numpy()
+    assert (index["offset"].to_numpy()[1:] == ends[:-1]).all()
+    assert ends[-1] + len(EOF_BLOCK) == os.path.getsize(path)
+    first_patient_ids = index["first_patient_id"].to_numpy()
+    assert (first_patient_ids[1:] > index["last_patient_id"].to_numpy()[:-1]).all()
+    # Each block holds its rows
+    with open(path, "rb") as f:
+        data = f.read()
+    for block in index.itertuples():
+        rows = zlib.decompress(
+            data[block.offset : block.offset + block.size], wbits=31
+        ).splitlines()
+        assert len(rows) == block.rows
+        assert int(rows[0].split(b",")[0]) == block.first_patient_id
+        assert int(rows[-1].split(b",")[0]) == block.last_patient_id
+
+
+@pytest.mark.parametrize(
+    "first_patient_id, stop_patient_id",
+    [(None, None), (None, 301), (30000, None), (12345, 40000), (70000, None)],
+)
+@pytest.mark.parametrize("threads", [1, 2])
+def test_read_blocks(frame, tmp_path, first_patient_id, stop_patient_id, threads):
+    path = str(tmp_path / "input.csv.gz")
+    write_blocks(frame, path, 2)
+    rows = np.ones(len(frame), dtype=bool)
+    if first_patient_id is not None:
+        rows &= frame["patient_id"] >= first_patient_id
+    if stop_patient_id is not None:
+        rows &= frame["patient_id"] < stop_patient_id
+    expected = frame[rows].reset_index(drop=True)
+    read = read_blocks(
+        path,
+        first_patient_id,
+        stop_patient_id,
+        threads,
+        dtype=dict(frame.dtypes),
+        keep_default_na=False,
+    )
+    assert read.equals(expected)
+
+
+def test_threaded_cohort_matches_serial(frame, tmp_path):
+    serial = str(tmp_path / "serial.csv")
+    threaded = str(tmp_path / "threaded.csv.gz")
+    write_cohort(frame, serial)
+    write_cohort(frame, threaded, compression_threads=2)
+    with open(serial, "rb") as f, gzip.open(threaded, "rb") as g:
+        assert g.read() == f.read()
+    assert os.path.exists(index_path(threaded))
@@ -0,0 +1,120 @@
+# Per-variable result cache: which changes to a study invalidate a cached
+# column, reruns restoring the cached columns, and eviction
+
+import os
+
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+import extraction.cache
+from extraction.backend import LocalBackend
+from extraction.cache import VariableCache
+
+CLINICAL_EVENTS = {
+    "patient_id": [1, 1, 2, 3],
+    "date": ["2020-03-01", "2021-01-01", "2019-01-01", "2021-05-01"],
+    "code": ["X1", "X2", "X1", "X2"],
+    "numeric_value": [30.0, 40.0, 50.0, 60.0],
+}
+
+
+@pytest.fixture
+def tables(make_tables):
+    return make_tables(
+        patients={
+            "patient_id": [1, 2, 3],
+            "date_of_birth": ["1980-01-01", "1990-01-01", "2000-01-01"],
+            "sex": ["F", "M", "F"],
+        },
+        registrations={"patient_id": [1, 2, 3], "start_date": ["2000-01-01"] * 3},
+        clinical_events=CLINICAL_EVENTS,
+    )
+
+
+def definitions(codes=("X1",), index_date="2021-06-01", date_format="YYYY-MM-DD"):
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date=index_date,
+        population=patients.registered_with_one_practice_between(
+            "2010-01-01", "index_date"
+        ),
+        event=patients.with_these_clinical_events(
+            codelist(list(codes), system="ctv3"),
+            on_or_before="index_date",
+            returning="date",
+            find_first_match_in_period=True,
+            date_format=date_format,
+        ),
+        after_event=patients.with_these_clinical_events(
+            codelist(["X2"], system="ctv3"),
+            between=["event", "index_date"],
+            returning="number_of_matches_in_period",
+        ),
+        age=patients.age_as_of("index_date"),
+    ).covariate_definitions
+
+
+def test_keys_change_with_the_query_and_its_dependencies(tmp_path):
+    cache = VariableCache(str(tmp_path), "snapshot")
+    keys = cache.keys(definitions())
+    # Output formatting does not change the values
+    assert cache.keys(definitions(date_format="YYYY-MM")) == keys
+    changed = cache.keys(definitions(codes=("X1", "X2")))
+    assert changed["event"] != keys["event"]
+    assert changed["after_event"] != keys["after_event"]
+    assert changed["age"] == keys["age"]
+    # Index dates are substituted into the queries
+    moved = cache.keys(definitions(index_date="2021-07-01"))
+    assert moved["age"] != keys["age"]
+
+
+def test_keys_change_with_the_source_and_extraction_code(tmp_path, monkeypatch):
+    keys = VariableCache(str(tmp_path), "snapshot").keys(definitions())
+    other_source = VariableCache(str(tmp_path), "other").keys(definitions())
+    assert all(other_source[name] != keys[name] for name in keys)
+    monkeypatch.setattr(extraction.cache, "source_hash", lambda: "other")
+    other_code = VariableCache(str(tmp_path), "snapshot").keys(definitions())
+    assert all(other_code[name] != keys[name] for name in keys)
+
+
+def test_rerun_restores_cached_columns(tables, tmp_path):
+    uncached = LocalBackend(dict(tables)).to_dataframe(definitions())
+    first = LocalBackend(dict(tables), VariableCache(str(tmp_path), "snapshot"))
+    assert first.to_dataframe(definitions()).equals(uncached)
+    second = LocalBackend(dict(tables), VariableCache(str(tmp_path), "snapshot"))
+    assert second.to_dataframe(definitions()).equals(uncached)
+    assert all(stats["cached"] for stats in second.variable_stats.values())
+    assert not any(stats["rows_scanned"] for stats in second.variable_stats.values())
+
+
+def test_unreadable_entries_are_evaluated_again(tables, tmp_path):
+    cache = VariableCache(str(tmp_path), "snapshot")
+    expected = LocalBackend(dict(tables), cache).to_dataframe(definitions())
+    for key in cache.keys(definitions()).values():
+        with open(cache.path(key), "wb") as f:
+            f.write(b"partial")
+    rerun = LocalBackend(dict(tables), cache).to_dataframe(definitions())
+    assert rerun.equals(expected)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = VariableCache(str(tmp_path), "snapshot", max_bytes=4000)
+    entry = b"x" * 1000
+    for number in range(3):
+        cache.store(f"key{number}", entry)
+        os.utime(cache.path(f"key{number}"), (number, number))
+    # Loading key0 makes key1 the least recently used
+    assert cache.load("key0") == entry
+    cache.store("key3", entry)
+    cache.store("key4", entry)
+    assert [cache.contains(f"key{number}") for number in range(5)] == [
+        True,
+        False,
+        False,
+        True,
+        True,
+    ]
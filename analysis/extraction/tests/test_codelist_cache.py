@@ -0,0 +1,99 @@
+# Compiled codelist cache: hits, invalidation when a CSV or the codelist
+# manifest changes, and reading CSVs directly when the cache is off
+
+import os
+
+import pytest
+
+import codelist_cache
+from codelist_cache import cached_codelist_from_csv
+
+
+@pytest.fixture
+def parses(monkeypatch, tmp_path):
+    # Files parsed from CSV, with the cache in tmp_path/cache and the
+    # manifest in tmp_path
+    parsed = []
+    parse = codelist_cache.codelist_from_csv
+
+    def counting_parse(filename, *args, **kwargs):
+        parsed.append(os.path.basename(filename))
+        return parse(filename, *args, **kwargs)
+
+    monkeypatch.setattr(codelist_cache, "codelist_from_csv", counting_parse)
+    monkeypatch.setattr(codelist_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    manifest = tmp_path / "codelists.json"
+    manifest.write_text('{"files": {}}')
+    monkeypatch.setattr(codelist_cache, "MANIFEST", str(manifest))
+    codelist_cache.manifest_sha.cache_clear()
+    yield parsed
+    codelist_cache.manifest_sha.cache_clear()
+
+
+def write_csv(tmp_path, rows, name="codes.csv"):
+    path = tmp_path / name
+    path.write_text("code,term,category\n" + "".join(f"{row}\n" for row in rows))
+    return str(path)
+
+
+def cache_files(tmp_path):
+    return sorted(os.listdir(tmp_path / "cache"))
+
+
+def test_cache_hit(tmp_path, parses):
+    path = write_csv(tmp_path, ["X1,first,1", "X2,second,2"])
+    first = cached_codelist_from_csv(path, system="ctv3")
+    assert len(cache_files(tmp_path)) == 1
+    second = cached_codelist_from_csv(path, system="ctv3")
+    assert parses == ["codes.csv"]
+    assert list(second) == list(first) == ["X1", "X2"]
+    assert second.system == "ctv3"
+    # With categories, the same CSV is a different cache entry
+    categorised = cached_codelist_from_csv(path, system="ctv3", category_column="category")
+    cached = cached_codelist_from_csv(path, system="ctv3", category_column="category")
+    assert parses == ["codes.csv", "codes.csv"]
+    assert list(cached) == list(categorised) == [("X1", "1"), ("X2", "2")]
+    assert cached.has_categories
+    assert len(cache_files(tmp_path)) == 2
+
+
+def test_changed_csv_is_parsed_again(tmp_path, parses):
+    path = write_csv(tmp_path, ["X1,first,1"])
+    assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1"]
+    write_csv(tmp_path, ["X1,first,1", "X3,third,1"])
+    assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1", "X3"]
+    assert parses == ["codes.csv", "codes.csv"]
+    # Reverting the CSV finds its earlier entry
+    write_csv(tmp_path, ["X1,first,1"])
+    assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1"]
+    assert len(parses) == 2
+
+
+def test_changed_manifest_is_parsed_again(tmp_path, parses):
+    path = write_csv(tmp_path, ["X1,first,1"])
+    cached_codelist_from_csv(path, system="ctv3")
+    (tmp_path / "codelists.json").write_text('{"files": {"codes.csv": {}}}')
+    codelist_cache.manifest_sha.cache_clear()
+    cached_codelist_from_csv(path, system="ctv3")
+    assert len(parses) == 2
+
+
+def test_unreadable_cache_file_is_parsed_again(tmp_path, parses):
+    path = write_csv(tmp_path, ["X1,first,1"])
+    cached_codelist_from_csv(path, system="ctv3")
+    (cache_file,) = cache_files(tmp_path)
+    (tmp_path / "cache" / cache_file).write_bytes(b"")
+    assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1"]
+    assert len(parses) == 2
+    # and is written again
+    assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1"]
+    assert len(parses) == 2
+
+
+def test_cache_off_without_a_directory(tmp_path, parses, monkeypatch):
+    monkeypatch.setattr(codelist_cache, "CACHE_DIR", None)
+    path = write_csv(tmp_path, ["X1,first,1"])
+    for _ in range(2):
+        assert list(cached_codelist_from_csv(path, system="ctv3")) == ["X1"]
+    assert parses == ["codes.csv", "codes.csv"]
+    assert not os.path.exists(tmp_path / "cache")
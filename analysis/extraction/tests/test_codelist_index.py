@@ -0,0 +1,94 @@
+# Codelist membership through the integer / fixed-width index, against
+# plain string matching
+
+import numpy as np
+import pytest
+from cohortextractor import codelist
+
+from codelist_index import CodelistIndex, encode_codes
+
+
+def matches(codes, column, system):
+    index = CodelistIndex.from_codelist(codelist(codes, system=system))
+    return index.isin(index.encode(column)).tolist()
+
+
+def test_snomed_codes_match_as_integers():
+    column = ["22298006", "401303003", "", None, "0401303003", "1234x", "22298006 "]
+    assert matches(["22298006", "401303003"], column, "snomed") == [
+        True,
+        True,
+        False,
+        False,
+        # Only the exact code matches, as a string comparison would
+        False,
+        False,
+        False,
+    ]
+
+
+def test_ctv3_codes_match_exactly():
+    # CTV3 codes are case sensitive and may end in dots
+    column = ["XaIP3", "xaip3", "22K..", "22K.", "", None]
+    assert matches(["XaIP3", "22K.."], column, "ctv3") == [
+        True,
+        False,
+        True,
+        False,
+        False,
+        False,
+    ]
+
+
+def test_non_ascii_codes():
+    column = ["Xa\u00e9P3", "XaeP3", "\u00e9", "", "XaIP3"]
+    assert matches(["Xa\u00e9P3", "\u00e9"], column, "ctv3") == [
+        True,
+        False,
+        True,
+        False,
+        False,
+    ]
+    # Not valid integer codes
+    assert matches(["22298006"], ["2229800\u0666", "22298006"], "snomed") == [
+        False,
+        True,
+    ]
+
+
+def test_index_is_built_once_per_codelist():
+    codes = ["XaIP3", "22K.."]
+    index = CodelistIndex.from_codelist(codelist(codes, system="ctv3"))
+    # Codelists are copied by StudyDefinition, so are matched by content
+    assert CodelistIndex.from_codelist(codelist(list(codes), system="ctv3")) is index
+    assert CodelistIndex.from_codelist(codelist(codes, system="icd10")) is not index
+    categorised = codelist([("XaIP3", "1"), ("22K..", "2")], system="ctv3")
+    # In code order
+    assert CodelistIndex.from_codelist(categorised).categories.tolist() == ["2", "1"]
+
+
+def test_matches_string_membership_on_random_codes():
+    rng = np.random.default_rng(0)
+    column = rng.integers(10**5, 10**5 + 500, size=5000).astype(str).tolist()
+    codes = sorted(set(rng.choice(column, size=50).tolist()))
+    expected = [code in set(codes) for code in column]
+    assert matches(codes, column, "snomed") == expected
+    assert matches(codes, column, "ctv3") == expected
+
+
+def test_categories():
+    index = CodelistIndex.from_codelist(
+        codelist([("XaIP3", "1"), ("22K..", "2")], system="ctv3")
+    )
+    encoded = encode_codes(np.array(["22K..", "Y", "XaIP3"], dtype=object), "ctv3")
+    assert index.category(encoded).tolist() == ["2", "", "1"]
+
+
+def test_empty_codelist_matches_nothing():
+    index = CodelistIndex([], "snomed")
+    assert index.isin(index.encode(["22298006"])).tolist() == [False]
+
+
+def test_invalid_integer_codelist():
+    with pytest.raises(ValueError, match="not valid snomed codes"):
+        CodelistIndex(["22298006", "X123"], "snomed")
@@ -0,0 +1,83 @@
+# Lazy codelist loading, and the codelists each study definition uses
+
+import pytest
+from cohortextractor import StudyDefinition, codelist, combine_codelists, patients
+
+from codelist_registry import CodelistRegistry, DeferredCodelist
+
+
+@pytest.fixture
+def registry():
+    loaded = []
+
+    def build(codes, system):
+        loaded.append(codes[0])
+        return codelist(codes, system=system)
+
+    namespace = {
+        "first": DeferredCodelist(build, ["A1", "A2"], "ctv3"),
+        "second": DeferredCodelist(build, ["B1"], "ctv3"),
+        "third": DeferredCodelist(build, ["C1"], "ctv3"),
+        "unused": DeferredCodelist(build, ["D1"], "ctv3"),
+    }
+    registry = CodelistRegistry("test_codelists", namespace)
+    registry.loaded = loaded
+    return registry
+
+
+def study(**variables):
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=patients.registered_with_one_practice_between(
+            "2020-06-01", "index_date"
+        ),
+        **variables,
+    )
+
+
+def test_codelists_load_on_first_access(registry):
+    assert registry.names() == ["first", "second", "third", "unused"]
+    assert registry.namespace == {}
+    first = registry.resolve("first")
+    assert list(first) == ["A1", "A2"]
+    # Later lookups find the loaded codelist in the namespace
+    assert registry.namespace["first"] is first
+    assert registry.loaded == ["A1"]
+    assert list(registry.touched) == ["first"]
+    with pytest.raises(AttributeError, match="has no attribute 'fourth'"):
+        registry.resolve("fourth")
+
+
+def test_used_by(registry):
+    first, second, third, unused = (
+        registry.resolve(name) for name in ("first", "second", "third", "unused")
+    )
+    definitions = study(
+        direct=patients.with_these_clinical_events(first),
+        combined=patients.with_these_clinical_events(
+            registry.combine(combine_codelists, second, third)
+        ),
+    ).covariate_definitions
+    assert registry.used_by(definitions) == ["first", "second", "third"]
+    # A codelist sharing codes with a used codelist is not used
+    definitions = study(
+        other=patients.with_these_clinical_events(codelist(["A1", "D1"], system="ctv3"))
+    ).covariate_definitions
+    assert registry.used_by(definitions) == []
+
+
+def test_study_codelists(studies):
+    # Every wave study loads the same dict modules, but each study uses only
+    # the codelists of its own variables
+    from study_factory import study_codelists
+
+    wave = study_codelists(studies["wave1"])
+    era = study_codelists(studies["era"])
+    assert "hypertension_codes" in wave and "hypertension_codes" not in era
+    assert "covid_primary_care_code" in era and "covid_primary_care_code" not in wave
+    assert "covid_icd10" in wave and "covid_icd10" in era
@@ -0,0 +1,91 @@
+# References between covariates, evaluation order, and pruning the
+# variables the outputs do not need
+
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+from extraction.dependencies import (
+    flatten_variables,
+    prune_variables,
+    topological_levels,
+    variable_dependencies,
+)
+from study_factory import load_config, output_variables
+
+CODES = codelist(["X1"], system="ctv3")
+
+
+def variables():
+    return dict(
+        population=patients.satisfying("age >= 18", age=patients.age_as_of("index_date")),
+        first_event=patients.with_these_clinical_events(
+            CODES, returning="date", find_first_match_in_period=True, date_format="YYYY-MM-DD"
+        ),
+        next_event=patients.with_these_clinical_events(
+            CODES,
+            between=["first_event + 1 day", "index_date"],
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        # bp_sys is only defined as an extra column of bp_ht
+        bp_ht=patients.satisfying(
+            "bp_sys > 140",
+            bp_sys=patients.with_these_clinical_events(
+                CODES, returning="numeric_value", find_last_match_in_period=True
+            ),
+        ),
+        bp_high=patients.satisfying("bp_sys > 160"),
+        sex=patients.sex(),
+        unused=patients.satisfying("sex = 'F'"),
+    )
+
+
+def test_dependencies():
+    flattened, owners = flatten_variables(variables())
+    assert owners["bp_sys"] == "bp_ht"
+    assert list(flattened).index("bp_sys") < list(flattened).index("bp_ht")
+    dependencies = variable_dependencies(flattened)
+    assert dependencies["next_event"] == ["first_event"]
+    assert dependencies["bp_high"] == ["bp_sys"]
+    assert dependencies["unused"] == ["sex"]
+    # `returning` names a source column, not the covariate of that name
+    assert dependencies["sex"] == []
+
+
+def test_topological_levels():
+    assert topological_levels({"a": ["b"], "b": [], "c": ["a", "b"], "d": []}) == [
+        ["b", "d"],
+        ["a"],
+        ["c"],
+    ]
+    with pytest.raises(ValueError, match="Circular references between: a, b"):
+        topological_levels({"a": ["b"], "b": ["a"]})
+
+
+def test_prune_keeps_outputs_and_their_references():
+    pruned = prune_variables(variables(), ["next_event", "sex"])
+    assert list(pruned) == ["population", "first_event", "next_event", "sex"]
+
+
+def test_prune_moves_extra_columns_of_dropped_variables():
+    # bp_high refers to an extra column of the dropped bp_ht, which becomes
+    # an extra column of bp_high so it stays hidden
+    pruned = prune_variables(variables(), ["bp_high"])
+    assert list(pruned) == ["population", "bp_high"]
+    assert list(pruned["bp_high"][1]["extra_columns"]) == ["bp_sys"]
+    study = StudyDefinition(
+        default_expectations={"date": {"earliest": "2000-01-01", "latest": "2021-06-01"}},
+        index_date="2021-06-01",
+        **pruned,
+    )
+    assert study.covariate_definitions["bp_sys"][1]["hidden"]
+    assert not study.covariate_definitions["bp_high"][1].get("hidden")
+
+
+def test_output_variables_include_extracted_columns(repository_dir):
+    config = load_config()
+    outputs = output_variables(config)
+    assert set(config["extracted_columns"]) <= outputs
+    assert set(config["outcome_vars"]) <= outputs
+    assert "wt_positive_test_date" not in outputs
@@ -0,0 +1,120 @@
+# Dummy cohorts: columns drawn in dependency order agree with each other as
+# extracted columns would (dose gaps, outcome windows, derived categories
+# and the population), and are reproducible for a seed; and the options of
+# generate_dummy_data.py
+
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from extraction.dummy import study_seed, write_dummy_cohort
+
+SIZE = 3000
+
+
+def date_column(frame, name):
+    return pd.to_datetime(frame[name].replace("", None))
+
+
+@pytest.fixture(scope="module", params=["wave2", "wavejn1"])
+def wave(request, tmp_path_factory):
+    # (config of the wave, its dummy cohort as written to CSV)
+    from study_factory import build_study, load_config
+
+    key = request.param
+    path = str(tmp_path_factory.mktemp("dummy") / f"input_{key}.csv")
+    write_dummy_cohort(build_study(key), path, SIZE, study_seed(0, key), chunk_size=1000)
+    return load_config()[key], pd.read_csv(path, keep_default_na=False)
+
+
+def test_every_patient_is_in_the_population(wave):
+    _, frame = wave
+    assert frame["patient_id"].tolist() == list(range(1, SIZE + 1))
+    assert frame["age"].between(18, 110).all()
+    assert frame["sex"].isin(["M", "F"]).all()
+
+
+def test_vaccination_doses_are_at_least_14_days_apart(wave):
+    config, frame = wave
+    dose = 1
+    while f"covid_vax_date_{dose + 1}" in frame:
+        previous = date_column(frame, f"covid_vax_date_{dose}")
+        current = date_column(frame, f"covid_vax_date_{dose + 1}")
+        # A dose is only present after the previous one
+        assert not (current.notna() & previous.isna()).any(), dose
+        gaps = (current - previous).dt.days.dropna()
+        # (later doses become rare)
+        assert len(gaps) or dose > 2, dose
+        assert (gaps >= 14).all(), dose
+        dose += 1
+    assert (date_column(frame, "covid_vax_date_1").dropna() <= config["end_date"]).all()
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["covid_hospitalisation_date", "covid_emergency_date", "covid_death_date", "died_any_date"],
+)
+def test_outcome_dates_are_in_the_wave(wave, name):
+    config, frame = wave
+    dates = date_column(frame, name).dropna()
+    assert len(dates)
+    assert dates.between(config["start_date"], config["end_date"]).all()
+
+
+def test_rrt_cat_agrees_with_its_inputs(wave):
+    _, frame = wave
+    dialysis = frame["dialysis"] == 1
+    transplant = frame["kidney_transplant"] == 1
+    # ISO dates compare as strings
+    later_dialysis = frame["dialysis_date"] > frame["kidney_transplant_date"]
+    expected = pd.Series("0", index=frame.index)
+    expected[(dialysis & ~transplant) | (dialysis & transplant & later_dialysis)] = "1"
+    expected[(transplant & ~dialysis) | (transplant & dialysis & ~later_dialysis)] = "2"
+    assert frame["rrt_cat"].astype(str).tolist() == expected.tolist()
+    assert set(expected) == {"0", "1", "2"}
+    # Dates of match are present exactly where their flags are
+    assert ((frame["dialysis_date"] != "") == dialysis).all()
+    assert ((frame["kidney_transplant_date"] != "") == transplant).all()
+
+
+def test_cohorts_are_reproducible(tmp_path):
+    from study_factory import build_study
+
+    study = build_study("wave1")
+    paths = []
+    for name, seed in (("first", 1), ("second", 1), ("other", 2)):
+        path = str(tmp_path / f"{name}.csv")
+        write_dummy_cohort(study, path, 500, study_seed(seed, "wave1"), chunk_size=200)
+        paths.append(path)
+    first, second, other = (open(path).read() for path in paths)
+    assert first == second
+    assert first != other
+
+
+def run_generate_dummy_data(*args):
+    return subprocess.run(
+        [sys.executable, "analysis/generate_dummy_data.py", *args],
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_generate_dummy_data(tmp_path):
+    result = run_generate_dummy_data(
+        "--output-format=csv", "--population-size=40", str(tmp_path), "wave1"
+    )
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(tmp_path) == ["input_wave1.csv"]
+    assert len(pd.read_csv(tmp_path / "input_wave1.csv")) == 40
+
+
+def test_generate_dummy_data_rejects_unknown_options(tmp_path):
+    # Abbreviations of options are not accepted either
+    for option in ("--population=40", "--sizes=40"):
+        result = run_generate_dummy_data(option, str(tmp_path))
+        assert result.returncode == 2
+        assert f"unrecognized arguments: {option}" in result.stderr
+    assert os.listdir(tmp_path) == []
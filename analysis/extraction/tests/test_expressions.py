@@ -0,0 +1,89 @@
+# Parsing and evaluation of categorised_as / satisfying expressions
+
+import numpy as np
+import pytest
+
+from extraction.expressions import (
+    InvalidExpressionError,
+    evaluate_expression,
+    names_in_expression,
+    parse_expression,
+)
+
+COLUMNS = {
+    "age": np.array([15, 40, 70, 0]),
+    "sex": np.array(["F", "M", "F", ""], dtype=object),
+    "flag": np.array([True, False, True, False]),
+    "imd": np.array(["1", "5", "", "3"], dtype=object),
+    "died": np.array(["2021-01-01", "NaT", "2020-06-01", "NaT"], dtype="datetime64[D]"),
+}
+
+EMPTY_VALUES = {"age": 0, "sex": "", "flag": False, "imd": "", "died": None}
+
+
+def evaluate(expression):
+    return evaluate_expression(expression, COLUMNS, EMPTY_VALUES).tolist()
+
+
+def test_precedence():
+    # AND binds tighter than OR, NOT tighter than AND
+    assert parse_expression("a OR b AND NOT c") == (
+        "or",
+        ("name", "a"),
+        ("and", ("name", "b"), ("not", ("name", "c"))),
+    )
+    assert parse_expression("a + b * 2 > 3") == (
+        "compare",
+        ">",
+        ("arith", "+", ("name", "a"), ("arith", "*", ("name", "b"), ("literal", 2))),
+        ("literal", 3),
+    )
+
+
+def test_keywords_are_case_insensitive():
+    assert parse_expression("a and not b") == parse_expression("a AND NOT b")
+
+
+def test_names_in_expression():
+    assert names_in_expression("(age >= 18 AND sex = 'F') OR died") == {
+        "age",
+        "sex",
+        "died",
+    }
+
+
+@pytest.mark.parametrize(
+    "expression", ["age >", "(age > 1", "age > 1)", "age $ 1", "age > 1 age"]
+)
+def test_invalid_expressions(expression):
+    with pytest.raises(InvalidExpressionError):
+        parse_expression(expression)
+
+
+def test_unknown_column():
+    with pytest.raises(InvalidExpressionError, match="Unknown column: height"):
+        evaluate("height > 1")
+
+
+def test_comparisons_and_arithmetic():
+    assert evaluate("age >= 40 AND sex = 'F'") == [False, False, True, False]
+    assert evaluate("age * 2 - 10 > 60") == [False, True, True, False]
+    assert evaluate("NOT (age < 18 OR age > 65)") == [False, True, False, False]
+
+
+def test_bare_names_are_true_when_not_empty():
+    assert evaluate("age") == [True, True, True, False]
+    assert evaluate("sex") == [True, True, True, False]
+    assert evaluate("flag") == [True, False, True, False]
+    assert evaluate("died") == [True, False, True, False]
+
+
+def test_numeric_literals_against_categories():
+    # IMD and similar categories are strings compared with numbers
+    assert evaluate("imd = 5 OR imd = 1") == [True, True, False, False]
+
+
+def test_missing_dates_never_compare():
+    assert evaluate("died > '2020-01-01'") == [True, False, True, False]
+    assert evaluate("died <= '2020-12-31'") == [False, False, True, False]
+    assert evaluate("NOT died > '2020-12-31'") == [False, True, True, True]
@@ -0,0 +1,93 @@
+# Synthetic source tables: every table is written with its schema, no event
+# follows the patient's death, and background codes match no codelist code
+# (nor, for prefix-matched ICD-10 tables, start with one)
+
+import pyarrow.parquet as pq
+import pytest
+
+from extraction.fixtures import (
+    ARROW_TABLE_TYPES,
+    BACKGROUND_CODES,
+    FixtureSpec,
+    background_codes,
+    query_pool_entries,
+    table_path,
+    write_fixtures,
+)
+from extraction.tables import EVENT_DATE_COLUMNS, TABLE_COLUMNS, ParquetSource
+
+
+@pytest.fixture(scope="module")
+def spec(studies):
+    from study_factory import load_config
+
+    return FixtureSpec(list(studies.values()), load_config(), events_per_patient=20)
+
+
+@pytest.fixture(scope="module")
+def fixtures(tmp_path_factory, spec):
+    # (output directory, rows written per table)
+    directory = str(tmp_path_factory.mktemp("fixtures"))
+    return directory, write_fixtures(spec, directory, 500, seed=2, chunk_size=200)
+
+
+def test_every_table_has_its_schema(fixtures):
+    directory, rows = fixtures
+    assert set(rows) == set(TABLE_COLUMNS)
+    for table, columns in TABLE_COLUMNS.items():
+        dataset = pq.ParquetDataset(table_path(directory, table))
+        assert [(field.name, field.type) for field in dataset.schema] == [
+            (column, ARROW_TABLE_TYPES[column_type])
+            for column, column_type in columns.items()
+        ], table
+        assert len(dataset.fragments) == 3, table
+        assert rows[table] == dataset.read().num_rows > 0, table
+
+
+def test_no_event_follows_death(fixtures):
+    directory, _ = fixtures
+    source = ParquetSource(directory)
+    patients = source.scan("patients").set_index("patient_id")
+    assert patients["date_of_death"].notna().any()
+    date_columns = {table: [column] for table, column in EVENT_DATE_COLUMNS.items()}
+    date_columns["registrations"] = date_columns["addresses"] = ["start_date", "end_date"]
+    for table, columns in date_columns.items():
+        frame = source.scan(table)
+        date_of_death = patients["date_of_death"].reindex(frame["patient_id"]).to_numpy()
+        for column in columns:
+            # (comparisons with a missing date are false)
+            assert not (frame[column].to_numpy() > date_of_death).any(), (table, column)
+    # Each death is recorded on the date of death
+    deaths = source.scan("ons_deaths")
+    assert (
+        deaths["date"].to_numpy()
+        == patients["date_of_death"].reindex(deaths["patient_id"]).to_numpy()
+    ).all()
+
+
+def test_background_codes_match_no_codelist(studies, spec):
+    matching = {table: set() for table in spec.pools}
+    for study in studies.values():
+        for query_type, query_args in study.covariate_definitions.values():
+            for table, codes, _, _ in query_pool_entries(study, query_type, query_args):
+                if table in matching:
+                    matching[table].update(codes)
+    for table, codes in matching.items():
+        background = background_codes(table, codes, BACKGROUND_CODES)
+        assert len(background) == len(set(background)) == BACKGROUND_CODES, table
+        assert not set(background) & codes, table
+        if table in ("apcs", "ons_deaths"):
+            assert codes, table
+            assert not [code for code in background if code.startswith(tuple(codes))]
+        # The spec samples from the codelist codes followed by these
+        assert list(spec.pools[table].codes[-BACKGROUND_CODES:]) == background, table
+
+
+@pytest.mark.parametrize("table", ["apcs", "ons_deaths"])
+def test_background_diagnoses_share_no_prefix(table):
+    # (the studies' own ICD-10 codes come after the background codes)
+    codes = {"A0", "B12", "C999"}
+    background = background_codes(table, codes, BACKGROUND_CODES)
+    assert len(background) == BACKGROUND_CODES
+    assert not [code for code in background if code.startswith(tuple(codes))]
+    assert "A100" in background and "B130" in background
@@ -0,0 +1,213 @@
+# Shared scans of code-matching variables, and era bins of variables over
+# fixed date windows, against evaluating each variable with its own query
+
+import numpy as np
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+import extraction.backend
+from extraction.backend import LocalBackend
+from extraction.planner import code_bitmasks, plan_era_bins, plan_shared_scans
+
+RETURNING = ("binary_flag", "date", "number_of_matches_in_period", "numeric_value", "code")
+
+WINDOWS = (
+    ["2015-01-01", "2021-06-01"],
+    [None, "2020-01-01"],
+    ["2020-01-01", None],
+    ["2021-06-01", "2021-06-01"],
+)
+
+
+@pytest.fixture
+def tables(make_tables):
+    rng = np.random.default_rng(1)
+    size = 4000
+    patient_ids = np.arange(1, 201)
+    return make_tables(
+        patients={
+            "patient_id": patient_ids,
+            "date_of_birth": ["1970-01-01"] * len(patient_ids),
+            "sex": ["F"] * len(patient_ids),
+        },
+        registrations={
+            "patient_id": patient_ids,
+            "start_date": ["2000-01-01"] * len(patient_ids),
+        },
+        clinical_events={
+            "patient_id": rng.choice(patient_ids, size),
+            "date": np.datetime64("2014-01-01")
+            + rng.integers(0, 365 * 8, size).astype("timedelta64[D]"),
+            "code": np.char.add("C", rng.integers(0, 100, size).astype(str)),
+            "numeric_value": rng.normal(50, 10, size).round(1),
+        },
+    )
+
+
+def study(count):
+    # `count` variables with random codelists, windows and return values
+    rng = np.random.default_rng(count)
+    variables = {}
+    for number in range(count):
+        codes = sorted({f"C{code}" for code in rng.integers(0, 100, 10)})
+        returning = RETURNING[number % len(RETURNING)]
+        variables[f"variable_{number}"] = patients.with_these_clinical_events(
+            codelist(codes, system="ctv3"),
+            between=WINDOWS[number % len(WINDOWS)],
+            returning=returning,
+            find_first_match_in_period=bool(number % 2),
+            find_last_match_in_period=not number % 2,
+            date_format="YYYY-MM-DD" if returning == "date" else None,
+        )
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=patients.registered_with_one_practice_between(
+            "2019-01-01", "2021-06-01"
+        ),
+        **variables,
+    )
+
+
+@pytest.mark.parametrize("count", [1, 5, 70])
+def test_shared_scan_matches_separate_scans(tables, monkeypatch, count):
+    # 70 variables need two words of codelist bits per code
+    definitions = study(count).covariate_definitions
+    assert len(plan_shared_scans(definitions)["clinical_events"]) == count
+    shared = LocalBackend(dict(tables)).to_dataframe(definitions)
+    monkeypatch.setattr(extraction.backend, "plan_shared_scans", lambda _: {})
+    separate = LocalBackend(dict(tables)).to_dataframe(definitions)
+    assert shared.equals(separate)
+
+
+def test_variables_with_per_patient_bounds_are_not_shared():
+    definitions = StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=patients.all(),
+        first=patients.with_these_clinical_events(
+            codelist(["C1"], system="ctv3"),
+            returning="date",
+            on_or_before="index_date",
+            date_format="YYYY-MM-DD",
+        ),
+        after_first=patients.with_these_clinical_events(
+            codelist(["C2"], system="ctv3"), between=["first + 1 day", "index_date"]
+        ),
+    ).covariate_definitions
+    assert plan_shared_scans(definitions) == {"clinical_events": ["first"]}
+
+
+def test_code_bitmasks():
+    memberships = [np.array([True, False, True])] + [np.array([False, True, False])] * 64
+    bitmasks = code_bitmasks(memberships)
+    assert bitmasks.shape == (3, 2)
+    assert bitmasks[:, 0].tolist() == [1, (2**64 - 1) ^ 1, 1]
+    assert bitmasks[:, 1].tolist() == [0, 1, 0]
+
+
+def era_study():
+    # The era exposures with a vaccination date in each era, which also bins
+    from dict_era_exposure_vars import era_exposure_variables, eras
+
+    vaccinations = {
+        f"{era}_vaccination_date": patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS",
+            between=[start_date, end_date],
+            returning="date",
+            date_format="YYYY-MM-DD",
+            find_first_match_in_period=True,
+        )
+        for era, start_date, end_date in eras
+    }
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2020-01-01", "latest": "2024-01-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2023-12-03",
+        population=patients.registered_with_one_practice_between(
+            "2019-01-01", "2023-12-03"
+        ),
+        **era_exposure_variables,
+        **vaccinations,
+    )
+
+
+@pytest.fixture
+def era_tables(make_tables):
+    # Events on and either side of every era edge, and at random dates;
+    # patients 151 to 200 have none
+    from dict_era_exposure_vars import eras
+
+    rng = np.random.default_rng(2)
+    patient_ids = np.arange(1, 201)
+    edges = np.array(
+        [np.datetime64(date) for _, start, end in eras for date in (start, end)]
+    )
+    edges = np.concatenate([edges - 1, edges, edges + 1])
+    size = 3000
+    dates = np.concatenate(
+        [
+            np.repeat(edges, 20),
+            np.datetime64("2020-01-01")
+            + rng.integers(0, 365 * 4, size).astype("timedelta64[D]"),
+        ]
+    )
+    size = len(dates)
+
+    def events(date_column, **columns):
+        return {
+            "patient_id": rng.choice(patient_ids[:150], size),
+            date_column: rng.permutation(dates),
+            **{name: rng.choice(values, size) for name, values in columns.items()},
+        }
+
+    return make_tables(
+        patients={"patient_id": patient_ids, "date_of_birth": ["1970-01-01"] * 200},
+        registrations={"patient_id": patient_ids, "start_date": ["2000-01-01"] * 200},
+        sgss=events(
+            "specimen_date",
+            pathogen=["SARS-CoV-2", "Other"],
+            result=["positive", "negative"],
+        ),
+        apcs=events(
+            "admission_date",
+            diagnosis=["U071", "U072", "J10"],
+            admission_method=["21", "11"],
+        ),
+        ecds=events("arrival_date", diagnosis=["1240751000000100", "1"]),
+        vaccinations=events(
+            "date",
+            target_disease=["SARS-2 CORONAVIRUS", "INFLUENZA"],
+            product_name=["X"],
+        ),
+    )
+
+
+def test_era_bins_match_separate_queries(era_tables, monkeypatch):
+    definitions = era_study().covariate_definitions
+    bins = plan_era_bins(definitions)
+    assert sorted(len(names) for _, names in bins) == [6, 6, 6, 6]
+    binned = LocalBackend(dict(era_tables)).to_dataframe(definitions)
+    monkeypatch.setattr(extraction.backend, "plan_era_bins", lambda _: [])
+    separate = LocalBackend(dict(era_tables)).to_dataframe(definitions)
+    assert binned.equals(separate)
+    # Events on the edges are in their era, and patients without events have
+    # no dates
+    from dict_era_exposure_vars import eras
+
+    for era, start_date, end_date in eras:
+        assert end_date in binned[f"{era}_positive_test_date"].tolist()
+        assert start_date in binned[f"{era}_vaccination_date"].tolist()
+    without_events = binned[binned["patient_id"] > 150].drop(columns="patient_id")
+    assert (without_events == "").all().all()
@@ -0,0 +1,86 @@
+# Concurrent source scans: bounded_map, and extractions scanning tables over
+# several connections against a serial extraction
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from extraction.multiwave import extract_waves
+from extraction.pool import bounded_map
+from extraction.tables import TABLE_COLUMNS, SQLiteSource
+
+
+def test_bounded_map_keeps_item_order():
+    def square(item):
+        # Later items finish first
+        time.sleep((10 - item) / 1000)
+        return item * item
+
+    assert bounded_map(square, range(10), 3) == [item * item for item in range(10)]
+    assert bounded_map(square, range(10), 1) == [item * item for item in range(10)]
+
+
+def test_bounded_map_bounds_running_calls():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def call(item):
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(item)
+        return item
+
+    bounded_map(call, range(12), 3)
+    assert max(peak) == 3
+
+
+def test_bounded_map_stops_submitting_after_a_failure():
+    started = []
+
+    def call(item):
+        started.append(item)
+        if item == 1:
+            raise TimeoutError("Scan of apcs did not finish within 1 seconds")
+        time.sleep(0.05)
+        return item
+
+    with pytest.raises(TimeoutError):
+        bounded_map(call, range(20), 2)
+    assert len(started) < 20
+
+
+@pytest.fixture(scope="module")
+def sqlite_source(tmp_path_factory, fixture_source):
+    # The fixture tables in a SQLite database, dates as ISO strings
+    path = str(tmp_path_factory.mktemp("sqlite") / "source.sqlite")
+    with sqlite3.connect(path) as connection:
+        for table in TABLE_COLUMNS:
+            frame = fixture_source.scan(table)
+            for column, column_type in TABLE_COLUMNS[table].items():
+                if column_type == "date":
+                    frame[column] = frame[column].dt.strftime("%Y-%m-%d")
+            frame.to_sql(table, connection, index=False)
+    return SQLiteSource(path)
+
+
+@pytest.mark.parametrize("connections", [1, 4])
+def test_pooled_database_scans_match_serial(
+    sqlite_source, studies, serial_outputs, same_outputs, tmp_path, connections
+):
+    paths = extract_waves(
+        sqlite_source, studies, str(tmp_path), "csv", connections=connections
+    )
+    same_outputs(paths, serial_outputs("csv"))
+
+
+def test_pooled_parquet_scans_match_serial(
+    fixture_source, studies, serial_outputs, same_outputs, tmp_path
+):
+    paths = extract_waves(fixture_source, studies, str(tmp_path), "feather", connections=3)
+    same_outputs(paths, serial_outputs("feather"))
@@ -0,0 +1,78 @@
+# Extraction profiles: per-variable records and the size of the written
+# cohort and of each of its columns
+
+import os
+
+import pandas as pd
+import pytest
+
+from extraction.output import column_bytes, write_cohort
+from extraction.profile import ExtractionProfile, format_summary, read_profile
+
+STATS = {"seconds": 1.5, "rows_scanned": 10, "rows_returned": 3, "cached": False}
+
+
+def test_profile_records_the_cohort_file_size(tmp_path):
+    profile = ExtractionProfile("wave1")
+    profile.variable_started("age", "age_as_of", {"reference_date": "2021-06-01"})
+    profile.variable_finished("age", "age_as_of", {"reference_date": "2021-06-01"}, STATS)
+    cohort = tmp_path / "input_wave1.csv"
+    cohort.write_text("patient_id,age\n1,40\n")
+    profile.cohort_written(str(cohort))
+    path = str(tmp_path / "logs" / "profile.jsonl")
+    profile.write(path)
+    record, cohort_record = read_profile(path)
+    assert record["variable"] == "age"
+    assert record["rows_returned"] == 3
+    assert "cohort_bytes" not in record
+    # One record for the whole cohort, with each column's own bytes
+    assert cohort_record == {
+        "study": "wave1",
+        "cohort_bytes": len("patient_id,age\n1,40\n"),
+        "bytes_written": {"patient_id": len("patient_id,1,"), "age": len("age\n40\n")},
+    }
+    summary = format_summary([record, cohort_record])
+    assert "Slowest 1 of 1 variables" in summary
+    assert "age (age_as_of, 10 rows scanned, 3 returned)" in summary
+    assert "wave1: 20 bytes written (largest column age, 7 bytes)" in summary
+
+
+COVARIATE_DEFINITIONS = {
+    "age": ("age_as_of", {"column_type": "int"}),
+    "stp": ("registered_practice_as_of", {"column_type": "str"}),
+    "note": ("registered_practice_as_of", {"column_type": "str"}),
+}
+
+
+@pytest.mark.parametrize(
+    "output_format, compression_threads",
+    [("csv", None), ("csv.gz", None), ("csv.gz", 2), ("feather", None), ("parquet", None)],
+)
+def test_column_bytes(tmp_path, output_format, compression_threads):
+    size = 50000
+    frame = pd.DataFrame(
+        {
+            "patient_id": range(size),
+            "age": [40] * size,
+            "stp": pd.Categorical(["E1", "E2"] * (size // 2)),
+            "note": pd.Categorical(["a much longer value"] * size),
+        }
+    )
+    path = str(tmp_path / f"input.{output_format}")
+    write_cohort(frame, path, COVARIATE_DEFINITIONS, compression_threads)
+    totals = column_bytes(path)
+    assert list(totals) == ["patient_id", "age", "stp", "note"]
+    if output_format.startswith("csv"):
+        # Decompressed, the columns add up to the file
+        assert totals["age"] == len("age,") + len("40,") * size
+        assert totals["note"] == len("note\n") + len("a much longer value\n") * size
+        if output_format == "csv":
+            assert sum(totals.values()) == os.path.getsize(path)
+    elif output_format == "feather":
+        # Fixed-width values, and dictionary indices with one dictionary
+        assert totals["age"] >= 8 * size
+        assert 4 * size <= totals["stp"] < 5 * size
+        assert 4 * size <= totals["note"] < 5 * size
+    else:
+        # Encoded, so a repeated value takes less than distinct ones
+        assert totals["patient_id"] > 10 * totals["age"] > 0
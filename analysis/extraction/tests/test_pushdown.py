@@ -0,0 +1,94 @@
+# Population pushdown (evaluating the population first and semi-joining the
+# tables with it) against evaluating every covariate for every patient
+
+import pytest
+from cohortextractor import StudyDefinition, patients
+
+from extraction.backend import LocalBackend
+from extraction.multiwave import plan_scans, scan_tables
+
+
+@pytest.fixture(scope="module")
+def tables(fixture_source, studies):
+    return scan_tables(fixture_source, plan_scans(studies.values()))
+
+
+def evaluate(tables, covariate_definitions, population_pushdown, typed=False):
+    backend = LocalBackend(dict(tables), population_pushdown=population_pushdown)
+    return backend.to_dataframe(covariate_definitions, typed)
+
+
+@pytest.mark.parametrize("typed", [False, True])
+def test_pushdown_matches_whole_cohort(tables, studies, typed):
+    for key, study in studies.items():
+        definitions = study.covariate_definitions
+        pushed_down = evaluate(tables, definitions, True, typed)
+        assert len(pushed_down), key
+        assert pushed_down.equals(evaluate(tables, definitions, False, typed)), key
+
+
+def study(population_expression):
+    # The population's own variables (registered, prior_events) are not
+    # output; age is in both, and is read by output variables after the
+    # population is pushed down
+    import codelists
+
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": "2021-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2021-06-01",
+        population=patients.satisfying(
+            population_expression,
+            registered=patients.registered_with_one_practice_between(
+                "2020-06-01", "index_date"
+            ),
+            prior_events=patients.with_these_clinical_events(
+                codelists.hypertension_codes, on_or_before="2019-12-31"
+            ),
+        ),
+        age=patients.age_as_of("index_date"),
+        sex=patients.sex(),
+        age_group=patients.categorised_as(
+            {"0": "DEFAULT", "young": "age < 50", "old": "age >= 50"},
+            return_expectations={
+                "category": {"ratios": {"young": 0.5, "old": 0.5}},
+                "incidence": 1,
+            },
+        ),
+        older_woman=patients.satisfying("age > 60 AND sex = 'F'"),
+        events=patients.with_these_clinical_events(
+            codelists.hypertension_codes,
+            between=["2020-01-01", "index_date"],
+            returning="number_of_matches_in_period",
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "population_expression",
+    [
+        "registered AND age >= 30",
+        "registered AND (prior_events OR age >= 70)",
+        "registered AND age > 200",
+    ],
+)
+def test_pushdown_of_population_variables(tables, population_expression):
+    definitions = study(population_expression).covariate_definitions
+    pushed_down = evaluate(tables, definitions, True)
+    assert pushed_down.equals(evaluate(tables, definitions, False))
+    assert list(pushed_down.columns) == [
+        "patient_id",
+        "age",
+        "sex",
+        "age_group",
+        "older_woman",
+        "events",
+    ]
+    if "200" in population_expression:
+        # A population that matches nobody restricts every table to no rows
+        assert pushed_down.empty
+    else:
+        assert (pushed_down["events"] > 0).any()
@@ -0,0 +1,83 @@
+# Calendar series of index dates, and the options of extract_multiwave.py
+
+import subprocess
+import sys
+
+import pytest
+
+from extraction.dates import date_series
+from extraction.multiwave import load_series_studies
+
+
+def test_monthly_series():
+    assert date_series("2021-01-15", "2021-04-15", "1 month") == (
+        ["2021-01-15", "2021-02-15", "2021-03-15", "2021-04-15"],
+        "2021-05-15",
+    )
+    assert date_series("2021-01-28", "2021-03-27", "1 month") == (
+        ["2021-01-28", "2021-02-28"],
+        "2021-03-28",
+    )
+
+
+def test_daily_and_weekly_series():
+    assert date_series("2021-01-30", "2021-02-01", "1 day") == (
+        ["2021-01-30", "2021-01-31", "2021-02-01"],
+        "2021-02-02",
+    )
+    assert date_series("2021-01-31", "2021-02-14", "2 weeks") == (
+        ["2021-01-31", "2021-02-14"],
+        "2021-02-28",
+    )
+
+
+@pytest.mark.parametrize("step", ["1 month", "3 months", "1 year"])
+def test_series_of_months_must_start_by_day_28(step):
+    with pytest.raises(ValueError, match="must start on day 1 to 28"):
+        date_series("2021-01-29", "2021-12-31", step)
+
+
+def test_month_end_series_is_rejected_before_building_studies():
+    # cohortextractor cannot evaluate "index_date - 3 months" from the
+    # 31st of May, so the series is rejected up front
+    with pytest.raises(ValueError, match="not 2021-01-31"):
+        load_series_studies("2021-01-31", "2021-12-31", "1 month")
+
+
+def test_series_studies_from_day_28():
+    studies = load_series_studies("2021-01-28", "2021-12-31", "1 month")
+    assert list(studies)[:3] == [
+        "series_2021-01-28",
+        "series_2021-02-28",
+        "series_2021-03-28",
+    ]
+    assert len(studies) == 12
+
+
+def run_extract_multiwave(*args):
+    return subprocess.run(
+        [sys.executable, "analysis/extract_multiwave.py", *args],
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_unknown_options_are_rejected(tmp_path):
+    # Abbreviations of options are not accepted either
+    result = run_extract_multiwave("--shard=2", "--profile", str(tmp_path))
+    assert result.returncode == 2
+    assert "unrecognized arguments: --shard=2" in result.stderr
+
+
+def test_series_bounds_are_given_together(tmp_path):
+    result = run_extract_multiwave("--series-start=2021-01-01", str(tmp_path))
+    assert result.returncode == 2
+    assert "--series-start and --series-end must be given together" in result.stderr
+
+
+def test_invalid_series_is_reported(tmp_path):
+    result = run_extract_multiwave(
+        "--series-start=2021-01-31", "--series-end=2021-12-31", str(tmp_path)
+    )
+    assert result.returncode == 1
+    assert result.stderr.startswith("Invalid series: A series stepping by months")
@@ -0,0 +1,54 @@
+# Sharded extraction against a serial extraction of the same source
+
+import os
+
+import numpy as np
+import pytest
+
+from extraction.shards import extract_sharded, shard_ranges
+
+
+def test_shard_ranges_cover_every_patient():
+    patient_ids = np.array([9, 3, 5, 3, 12, 20, 7])
+    ranges = shard_ranges(patient_ids, 3)
+    assert ranges == [(None, 7), (7, 12), (12, None)]
+    # More shards than patients
+    assert shard_ranges(np.array([4, 8]), 5) == [(None, 8), (8, None)]
+
+
+@pytest.mark.parametrize(
+    "output_format, shards, processes",
+    [("csv", 3, 1), ("csv.gz", 2, 2), ("feather", 4, 2)],
+)
+def test_sharded_matches_serial(
+    fixture_source,
+    studies,
+    serial_outputs,
+    same_outputs,
+    tmp_path,
+    output_format,
+    shards,
+    processes,
+):
+    paths = extract_sharded(
+        fixture_source,
+        studies,
+        str(tmp_path),
+        output_format,
+        shards=shards,
+        processes=processes,
+    )
+    same_outputs(paths, serial_outputs(output_format))
+    # The parts are removed once merged
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(path) for path in paths.values()
+    )
+
+
+def test_streamed_sharded_matches_serial(
+    fixture_source, studies, serial_outputs, same_outputs, tmp_path
+):
+    paths = extract_sharded(
+        fixture_source, studies, str(tmp_path), "csv", shards=3, batch_size=70
+    )
+    same_outputs(paths, serial_outputs("csv"))
@@ -0,0 +1,154 @@
+# Streamed extraction (a batch of patients at a time) against a serial
+# extraction of the same source
+
+import os
+import resource
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import extraction.streaming
+from extraction.blocks import index_path
+from extraction.output import CohortWriter
+from extraction.streaming import (
+    BatchSizer,
+    extract_streamed,
+    patient_batches,
+    write_batches,
+)
+
+
+def test_patient_batches_cover_every_patient():
+    patient_ids = np.array([9, 3, 5, 3, 12, 20, 7])
+    assert list(patient_batches(patient_ids, iter([2, 2, 2]))) == [
+        (None, 7),
+        (7, 12),
+        (12, None),
+    ]
+    # Within a shard's range, and with no patients at all
+    assert list(patient_batches(patient_ids, iter([4, 4]), (3, 25))) == [
+        (3, 12),
+        (12, 25),
+    ]
+    assert list(patient_batches(np.array([]), iter([4]))) == [(None, None)]
+
+
+def test_batch_sizer_halves_above_the_ceiling(monkeypatch):
+    monkeypatch.setattr(extraction.streaming, "rss_mb", lambda: (500, True))
+    sizer = BatchSizer(5000, max_rss_mb=100)
+    sizer.update()
+    assert next(iter(sizer)) == 2500
+    sizer.update()
+    sizer.update()
+    assert sizer.size == extraction.streaming.MINIMUM_BATCH_SIZE
+    with pytest.raises(MemoryError, match="above the ceiling"):
+        sizer.update()
+    # Below the ceiling the size is kept
+    sizer = BatchSizer(5000, max_rss_mb=1000)
+    sizer.update()
+    assert sizer.size == 5000
+
+
+def test_batch_sizer_with_the_peak_size(monkeypatch):
+    # A peak above the ceiling never comes down, so only shrinks the batches
+    monkeypatch.setattr(extraction.streaming, "rss_mb", lambda: (500, False))
+    sizer = BatchSizer(2000, max_rss_mb=100)
+    for _ in range(3):
+        sizer.update()
+    assert sizer.size == extraction.streaming.MINIMUM_BATCH_SIZE
+
+
+@pytest.mark.parametrize("platform, units", [("darwin", 2**20), ("linux", 2**10)])
+def test_peak_rss_units(monkeypatch, platform, units):
+    # Without /proc or psutil, the peak is read from ru_maxrss
+    def no_proc(*args, **kwargs):
+        raise OSError
+
+    monkeypatch.setattr("builtins.open", no_proc)
+    monkeypatch.setitem(sys.modules, "psutil", None)
+    monkeypatch.setattr(sys, "platform", platform)
+    monkeypatch.setattr(
+        resource, "getrusage", lambda _: SimpleNamespace(ru_maxrss=300 * units)
+    )
+    assert extraction.streaming.rss_mb() == (300, False)
+
+
+@pytest.mark.parametrize(
+    "output_format, compression_threads",
+    [("csv", None), ("csv.gz", 2), ("feather", None)],
+)
+def test_streamed_matches_serial(
+    fixture_source,
+    studies,
+    serial_outputs,
+    same_outputs,
+    tmp_path,
+    output_format,
+    compression_threads,
+):
+    paths = extract_streamed(
+        fixture_source,
+        studies,
+        str(tmp_path),
+        output_format,
+        batch_size=70,
+        compression_threads=compression_threads,
+    )
+    expected = serial_outputs(output_format)
+    if compression_threads:
+        # Block-compressed, so compared decompressed
+        for key, path in paths.items():
+            assert pd.read_csv(path).equals(pd.read_csv(expected[key])), key
+            assert os.path.exists(index_path(path))
+    else:
+        same_outputs(paths, expected)
+
+
+COVARIATE_DEFINITIONS = {
+    "age": ("age_as_of", {"column_type": "int"}),
+    "stp": ("registered_practice_as_of", {"column_type": "str"}),
+}
+
+
+def test_feather_chunks_with_new_categories(tmp_path):
+    # The first chunk has no categories (an empty dictionary) at all
+    path = str(tmp_path / "input_test.feather")
+    chunks = [
+        {
+            "patient_id": [1, 2],
+            "age": [40, 50],
+            "stp": pd.Categorical([None, None], categories=pd.Index([], dtype=object)),
+        },
+        {"patient_id": [3, 4], "age": [60, 70], "stp": pd.Categorical(["E2", ""])},
+        {"patient_id": [5], "age": [80], "stp": pd.Categorical(["E1"])},
+    ]
+    with CohortWriter(path, COVARIATE_DEFINITIONS) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    frame = pd.read_feather(path)
+    assert frame["patient_id"].tolist() == [1, 2, 3, 4, 5]
+    # Categories in order of first appearance
+    assert frame["stp"].cat.categories.tolist() == ["", "E2", "E1"]
+    assert frame["stp"].fillna("").tolist() == ["", "", "E2", "", "E1"]
+    assert os.listdir(tmp_path) == ["input_test.feather"]
+
+
+@pytest.mark.parametrize("output_format", ["csv.gz", "feather"])
+def test_failed_batches_leave_no_output(tmp_path, output_format):
+    path = str(tmp_path / f"input_test.{output_format}")
+
+    def batches():
+        yield {"patient_id": [1, 2], "age": [40, 50], "stp": pd.Categorical(["E1", ""])}
+        raise RuntimeError("Batch failed")
+
+    if output_format == "csv.gz":
+        batches = (pd.DataFrame(batch) for batch in batches())
+    else:
+        batches = batches()
+    with pytest.raises(RuntimeError, match="Batch failed"):
+        write_batches(batches, path, COVARIATE_DEFINITIONS, compression_threads=2)
+    assert os.listdir(tmp_path) == []
+    assert not os.path.exists(index_path(path))
@@ -0,0 +1,66 @@
+# Source tables: scans of SQLite and DuckDB databases against scans of the
+# same tables as Parquet, with code, date and patient restrictions
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from extraction.tables import TABLE_COLUMNS, DuckDBSource, SQLiteSource
+
+
+def scans(fixture_source):
+    codes = fixture_source.scan("clinical_events")["code"].unique()[:20]
+    return [
+        ("patients", None, None, None, None),
+        ("registrations", None, None, None, (None, 300)),
+        ("clinical_events", set(codes), "2020-03-01", "2021-12-31", (100, 400)),
+        ("sgss", None, "2021-01-01", None, None),
+        ("vaccinations", None, None, "2021-06-30", (250, None)),
+    ]
+
+
+def same_scan(source, expected_source, table, codes, start, end, patient_range):
+    scanned, expected = (
+        scan_source.scan(table, codes, start, end, patient_range)
+        .sort_values(list(TABLE_COLUMNS[table]))
+        .reset_index(drop=True)
+        for scan_source in (source, expected_source)
+    )
+    assert len(expected), table
+    pd.testing.assert_frame_equal(scanned, expected)
+
+
+def test_sqlite_dates_with_times(tmp_path, fixture_source):
+    # Dates stored as ISO strings with a time are compared as dates
+    path = str(tmp_path / "source.sqlite")
+    with sqlite3.connect(path) as connection:
+        for table in TABLE_COLUMNS:
+            frame = fixture_source.scan(table)
+            for column, column_type in TABLE_COLUMNS[table].items():
+                if column_type == "date":
+                    frame[column] = frame[column].dt.strftime("%Y-%m-%d 00:00:00")
+            frame.to_sql(table, connection, index=False)
+    for scan in scans(fixture_source):
+        same_scan(SQLiteSource(path), fixture_source, *scan)
+
+
+def test_duckdb_scans_match_parquet(tmp_path, fixture_source):
+    duckdb = pytest.importorskip("duckdb")
+    path = str(tmp_path / "source.duckdb")
+    with duckdb.connect(path) as connection:
+        for table in TABLE_COLUMNS:
+            frame = fixture_source.scan(table)  # noqa: F841 (read by the query)
+            connection.execute(f"CREATE TABLE {table} AS SELECT * FROM frame")
+    for scan in scans(fixture_source):
+        same_scan(DuckDBSource(path), fixture_source, *scan)
+    # A table missing from the database is empty
+    with duckdb.connect(path) as connection:
+        connection.execute("DROP TABLE ons_deaths")
+    assert DuckDBSource(path).scan("ons_deaths").empty
+
+
+def test_parquet_scan_timeout(fixture_source):
+    assert len(fixture_source.scan("clinical_events", timeout=60))
+    with pytest.raises(TimeoutError, match="Scan of clinical_events did not finish"):
+        fixture_source.scan("clinical_events", timeout=0)
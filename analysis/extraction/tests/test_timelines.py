@@ -0,0 +1,127 @@
+# As-of lookups over event timelines, against filtering each patient's
+# events directly, and timelines reused by later studies
+
+import numpy as np
+import pytest
+from cohortextractor import StudyDefinition, codelist, patients
+
+from extraction.backend import LocalBackend
+from extraction.timelines import EventTimeline
+
+WINDOWS = [
+    None,
+    (None, "2020-06-30"),
+    ("2020-01-01", None),
+    ("2020-01-01", "2020-12-31"),
+    ("2020-03-15", "2020-03-15"),
+    # Bounds outside the span of the events
+    ("1990-01-01", "2030-01-01"),
+    ("2030-01-01", None),
+    (None, "1990-01-01"),
+]
+
+
+@pytest.fixture(scope="module")
+def events():
+    rng = np.random.default_rng(3)
+    size = 50
+    count = 400
+    # Patients 0 and 49 have no events
+    positions = np.sort(rng.integers(1, size - 1, count))
+    dates = np.datetime64("2019-01-01") + rng.integers(0, 900, count).astype(
+        "timedelta64[D]"
+    )
+    order = np.lexsort((dates, positions))
+    rows = rng.permutation(count)
+    return rows[order], positions[order], dates[order], size
+
+
+@pytest.mark.parametrize("between", WINDOWS)
+@pytest.mark.parametrize("find_first_match_in_period", [True, False])
+def test_window_matches_direct_filtering(events, between, find_first_match_in_period):
+    rows, positions, dates, size = events
+    timeline = EventTimeline(rows, positions, dates, size)
+    matched_rows, counts = timeline.window(between, find_first_match_in_period)
+    start, end = between or (None, None)
+    for patient in range(size):
+        selected = positions == patient
+        if start is not None:
+            selected &= dates >= np.datetime64(start)
+        if end is not None:
+            selected &= dates <= np.datetime64(end)
+        matches = rows[selected]
+        assert counts[patient] == len(matches)
+        if not len(matches):
+            assert matched_rows[patient] == -1
+        else:
+            expected = matches[0] if find_first_match_in_period else matches[-1]
+            assert matched_rows[patient] == expected
+
+
+def test_empty_timeline():
+    timeline = EventTimeline(
+        np.array([], dtype="int64"),
+        np.array([], dtype="int64"),
+        np.array([], dtype="datetime64[D]"),
+        3,
+    )
+    rows, counts = timeline.window(("2020-01-01", "2020-12-31"), True)
+    assert rows.tolist() == [-1, -1, -1]
+    assert counts.tolist() == [0, 0, 0]
+
+
+def study(index_date):
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2000-01-01", "latest": index_date},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date=index_date,
+        population=patients.registered_with_one_practice_between(
+            "2019-01-01", "index_date"
+        ),
+        last=patients.with_these_clinical_events(
+            codelist(["C1", "C2"], system="ctv3"),
+            on_or_before="index_date",
+            returning="date",
+            find_last_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        recent=patients.with_these_clinical_events(
+            codelist(["C1", "C2"], system="ctv3"),
+            between=["index_date - 90 days", "index_date"],
+            returning="number_of_matches_in_period",
+        ),
+    ).covariate_definitions
+
+
+def test_timelines_are_reused_for_later_index_dates(make_tables):
+    rng = np.random.default_rng(4)
+    size = 2000
+    patient_ids = np.arange(1, 101)
+    tables = make_tables(
+        patients={
+            "patient_id": patient_ids,
+            "date_of_birth": ["1970-01-01"] * len(patient_ids),
+            "sex": ["M"] * len(patient_ids),
+        },
+        registrations={
+            "patient_id": patient_ids,
+            "start_date": ["2000-01-01"] * len(patient_ids),
+        },
+        clinical_events={
+            "patient_id": rng.choice(patient_ids, size),
+            "date": np.datetime64("2019-01-01")
+            + rng.integers(0, 900, size).astype("timedelta64[D]"),
+            "code": rng.choice(["C1", "C2", "C3"], size),
+        },
+    )
+    index_dates = ["2020-03-01", "2020-09-01", "2021-03-01"]
+    backend = LocalBackend(dict(tables))
+    for number, index_date in enumerate(index_dates):
+        reused = backend.to_dataframe(study(index_date))
+        if number:
+            assert len(backend.timelines) == 1
+        fresh = LocalBackend(dict(tables)).to_dataframe(study(index_date))
+        assert reused.equals(fresh)
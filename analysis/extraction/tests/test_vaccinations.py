@@ -0,0 +1,107 @@
+# Chains of vaccination dose dates, found from one sort of the records,
+# against evaluating each covid_vax_date_N variable on its own
+
+import numpy as np
+import pytest
+from cohortextractor import StudyDefinition, patients
+
+import extraction.backend
+from extraction.backend import LocalBackend
+from extraction.vaccinations import dose_sequence, plan_vaccination_sequences
+from study_factory import covid_vaccination_sequence
+
+
+def study(**variables):
+    return StudyDefinition(
+        default_expectations={
+            "date": {"earliest": "2020-12-01", "latest": "2022-06-01"},
+            "rate": "uniform",
+            "incidence": 0.5,
+        },
+        index_date="2022-06-01",
+        population=patients.registered_with_one_practice_between(
+            "2019-01-01", "2022-06-01"
+        ),
+        **variables,
+    ).covariate_definitions
+
+
+@pytest.fixture
+def tables(make_tables):
+    rng = np.random.default_rng(2)
+    size = 3000
+    patient_ids = np.arange(1, 301)
+    return make_tables(
+        patients={
+            "patient_id": patient_ids,
+            "date_of_birth": ["1970-01-01"] * len(patient_ids),
+            "sex": ["F"] * len(patient_ids),
+        },
+        registrations={
+            "patient_id": patient_ids,
+            "start_date": ["2000-01-01"] * len(patient_ids),
+        },
+        vaccinations={
+            "patient_id": rng.choice(patient_ids, size),
+            # Records before the first dose window and after its end, and
+            # repeated records on a day
+            "date": np.datetime64("2020-10-01")
+            + rng.integers(0, 700, size).astype("timedelta64[D]"),
+            "target_disease": rng.choice(
+                ["SARS-2 CORONAVIRUS", "INFLUENZA"], size, p=[0.8, 0.2]
+            ),
+            "product_name": [""] * size,
+        },
+    )
+
+
+def test_dose_chain_is_planned():
+    definitions = study(**covid_vaccination_sequence("2022-06-01", 4))
+    assert plan_vaccination_sequences(definitions) == [
+        [
+            ("covid_vax_date_1", None),
+            ("covid_vax_date_2", 14),
+            ("covid_vax_date_3", 14),
+            ("covid_vax_date_4", 14),
+        ]
+    ]
+
+
+def test_variables_with_other_records_are_not_chained():
+    variables = dict(covid_vaccination_sequence("2022-06-01", 2))
+    variables["covid_vax_date_3"] = patients.with_tpp_vaccination_record(
+        target_disease_matches="INFLUENZA",
+        between=["covid_vax_date_2 + 14 days", "2022-06-01"],
+        find_first_match_in_period=True,
+        returning="date",
+        date_format="YYYY-MM-DD",
+    )
+    assert plan_vaccination_sequences(study(**variables)) == [
+        [("covid_vax_date_1", None), ("covid_vax_date_2", 14)]
+    ]
+
+
+@pytest.mark.parametrize("doses", [2, 5])
+def test_dose_chain_matches_separate_variables(tables, monkeypatch, doses):
+    definitions = study(**covid_vaccination_sequence("2022-06-01", doses))
+    chained = LocalBackend(dict(tables)).to_dataframe(definitions)
+    monkeypatch.setattr(extraction.backend, "plan_vaccination_sequences", lambda _: [])
+    separate = LocalBackend(dict(tables)).to_dataframe(definitions)
+    assert (chained[f"covid_vax_date_{doses}"] != "").any()
+    assert chained.equals(separate)
+
+
+def test_dose_sequence():
+    # Patient 0: records on days 0, 5, 20 and 40; patient 1 has none, and
+    # patient 2 a record before the start and one after the end
+    positions = np.array([0, 0, 0, 0, 2, 2])
+    dates = np.array(
+        ["2021-01-20", "2021-01-01", "2021-01-06", "2021-02-10", "2020-12-01", "2021-06-01"],
+        dtype="datetime64[D]",
+    )
+    first, second, third = dose_sequence(
+        positions, dates, 3, "2021-01-01", "2021-03-01", [14, 14]
+    )
+    assert first.astype(str).tolist() == ["2021-01-01", "NaT", "NaT"]
+    assert second.astype(str).tolist() == ["2021-01-20", "NaT", "NaT"]
+    assert third.astype(str).tolist() == ["2021-02-10", "NaT", "NaT"]
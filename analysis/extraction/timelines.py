@@ -0,0 +1,74 @@
+# As-of evaluation over per-codelist event timelines
+# Most immunosuppression and comorbidity flags are "last match on or before
+# index_date" queries, and every wave (or every date of a calendar series)
+# asks the same codelist the same question with a different index date.
+# An EventTimeline holds the events matching one codelist sorted by patient
+# then date, built once over the source table (see
+# LocalBackend.evaluate_shared_scan) and kept for later studies, including
+# those restricted to their population; the matches of a fixed window are
+# then found for every patient with events at once by binary search of the
+# window bounds, so each further index date costs a search rather than a
+# scan of the table.
+
+import numpy as np
+
+from extraction.cache import fingerprint
+from extraction.dates import to_date
+from extraction.planner import SHARED_SCAN_QUERIES
+
+
+def timeline_key(query_type, query_args):
+    # Variables with the same key match the same events: the table, the
+    # codelist and whether events without a value are dropped
+    return (
+        SHARED_SCAN_QUERIES[query_type],
+        fingerprint(query_args["codelist"]),
+        bool(query_args.get("ignore_missing_values")),
+    )
+
+
+class EventTimeline:
+    def __init__(self, rows, positions, dates, size):
+        # `rows` (of the table), `positions` (patient positions) and `dates`
+        # of the matching events, sorted by patient then date
+        self.rows = rows
+        self.size = size
+        # Events of patient p are offsets[p]:offsets[p + 1]
+        self.offsets = np.searchsorted(positions, np.arange(size + 1))
+        # Only the patients with events are searched
+        self.patients = np.flatnonzero(np.diff(self.offsets))
+        # Events are searched by patient and day together: each patient's
+        # days occupy `span` consecutive keys, with room for a bound before
+        # the earliest event and after the latest
+        days = dates.astype("int64")
+        self.first_day = days.min() if len(days) else 0
+        self.span = (days.max() - self.first_day if len(days) else 0) + 2
+        self.keys = positions.astype("int64") * self.span + (days - self.first_day)
+
+    def bound(self, date, side):
+        # Index of the first event after `date` (side="right") or on or after
+        # it (side="left") of each patient with events
+        day = to_date(date).astype("int64") - self.first_day
+        day = min(max(day, -1), self.span - 1)
+        return np.searchsorted(self.keys, self.patients * self.span + day, side=side)
+
+    def window(self, between, find_first_match_in_period):
+        # The first or last event (as a row of the table, -1 for none) and
+        # the number of events of each patient within `between`, whose
+        # bounds are fixed dates or None
+        start, end = between or (None, None)
+        if start is None:
+            low = self.offsets[self.patients]
+        else:
+            low = self.bound(start, "left")
+        if end is None:
+            high = self.offsets[self.patients + 1]
+        else:
+            high = self.bound(end, "right")
+        counts = np.zeros(self.size, dtype="int64")
+        counts[self.patients] = np.maximum(high - low, 0)
+        has_match = counts[self.patients] > 0
+        rows = np.full(self.size, -1, dtype="int64")
+        selected = low if find_first_match_in_period else high - 1
+        rows[self.patients[has_match]] = self.rows[selected[has_match]]
+        return rows, counts
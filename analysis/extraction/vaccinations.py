@@ -0,0 +1,115 @@
+# Vaccination dose sequences
+# The covid_vax_date_N variables (see covid_vaccination_sequence in
+# study_factory.py) are chained: dose N is the first record at least
+# `gap` days after dose N-1. Evaluated one by one that is a filter and sort
+# of the vaccination table per dose. Here each chain is recognised in the
+# covariate definitions, the patients' records are sorted once, and each
+# dose is found with one searchsorted over the sorted records.
+
+import numpy as np
+
+from extraction.dates import DATE_REFERENCE_REGEX, NAT, is_iso_date, to_date
+
+SEQUENCE_QUERY = "with_tpp_vaccination_record"
+
+
+def chain_gap(previous, query_args):
+    # Gap in days if the variable's window starts a number of days after
+    # `previous`, otherwise None
+    start = (query_args.get("between") or (None, None))[0]
+    if start is None:
+        return None
+    match = DATE_REFERENCE_REGEX.match(start.replace(" ", ""))
+    if (
+        not match
+        or match.group("name") != previous
+        or match.group("operator") != "+"
+        or (match.group("units") or "days").rstrip("s") != "day"
+    ):
+        return None
+    return int(match.group("quantity"))
+
+
+def is_first_match_date(query_args):
+    return query_args.get("returning") == "date" and bool(
+        query_args.get("find_first_match_in_period")
+    )
+
+
+def same_records(query_args, other_args):
+    # Whether two variables select the same records up to the window start
+    keys = ("target_disease_matches", "product_name_matches")
+    end = (query_args.get("between") or (None, None))[1]
+    other_end = (other_args.get("between") or (None, None))[1]
+    return end == other_end and all(
+        query_args.get(key) == other_args.get(key) for key in keys
+    )
+
+
+def plan_vaccination_sequences(covariate_definitions):
+    # Chains of first-match dose dates, as lists of (name, gap) with gap
+    # None for the first dose; only chains of more than one dose
+    sequences = []
+    chained = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        if query_type != SEQUENCE_QUERY or not is_first_match_date(query_args):
+            continue
+        start, end = query_args.get("between") or (None, None)
+        if end is not None and not is_iso_date(end):
+            continue
+        for sequence in sequences:
+            previous, _ = sequence[-1]
+            previous_args = covariate_definitions[previous][1]
+            gap = chain_gap(previous, query_args)
+            if (
+                previous not in chained
+                and gap is not None
+                and same_records(query_args, previous_args)
+            ):
+                sequence.append((name, gap))
+                chained[previous] = name
+                break
+        else:
+            if start is None or is_iso_date(start):
+                sequences.append([(name, None)])
+    return [sequence for sequence in sequences if len(sequence) > 1]
+
+
+def dose_sequence(positions, dates, size, start, end, gaps):
+    # Dose dates for each patient from their records (`positions` into the
+    # patient array, `dates`), where the first dose is the first record on
+    # or after `start` and each further dose the first record at least
+    # gaps[n] days after the previous one; all doses on or before `end`
+    valid = ~np.isnat(dates)
+    if end is not None:
+        valid &= dates <= to_date(end)
+    positions = positions[valid]
+    days = dates[valid].astype("int64")
+    order = np.lexsort((days, positions))
+    positions = positions[order]
+    days = days[order]
+    # Records sorted by one key, so "first record of patient p on or after
+    # day d" is a searchsorted for (p, d)
+    offset = days.min() if len(days) else 0
+    span = (days.max() - offset + 1) if len(days) else 1
+    keys = positions * span + (days - offset)
+    patients = np.arange(size)
+    doses = []
+    threshold = np.full(size, offset, dtype="int64")
+    if start is not None:
+        threshold[:] = max(to_date(start).astype("int64"), offset)
+    has_threshold = np.ones(size, dtype=bool)
+    for gap in [0] + list(gaps):
+        threshold = threshold + gap
+        searchable = has_threshold & (threshold - offset < span)
+        found = np.zeros(size, dtype=bool)
+        dose = np.full(size, NAT, dtype="datetime64[D]")
+        if len(keys):
+            target = patients * span + np.maximum(threshold - offset, 0)
+            rows = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+            found = searchable & (positions[rows] == patients) & (keys[rows] >= target)
+            dose[found] = days[rows[found]].astype("datetime64[D]")
+        doses.append(dose)
+        threshold = np.where(found, dose.astype("int64"), threshold)
+        has_threshold = found
+    return doses
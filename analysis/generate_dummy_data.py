@@ -0,0 +1,84 @@
+######################################
+
+# This script generates dummy cohorts for the waves in config.json (and the
+# era exposures) from the return_expectations of the study definitions, as
+# cohortextractor's dummy data does, but vectorised and written in chunks so
+# the R pipeline can be load-tested at production scale. Variables are drawn
+# in dependency order, so dates respect their bounds, derived categories
+# agree with their inputs and every patient is in the population.
+# Each wave has its own seed, derived from --seed, so the output is
+# reproducible for a given seed, population size and chunk size.
+# Outputs are written as output_dir/input_<wave>.<format> (feather unless
+# --output-format is given: csv, csv.gz, feather or parquet).
+# Usage (see --help for the options):
+#   python analysis/generate_dummy_data.py [options] [output_dir] [waves...]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import argparse
+import json
+
+from extraction.dummy import study_seed, write_dummy_cohort
+from extraction.multiwave import load_era_study, load_wave_studies, wave_keys
+from extraction.output import OUTPUT_FORMATS, output_path
+
+# Import config variables (start_date and end_date of waves)
+with open("analysis/config.json", "r") as f:
+    config = json.load(f)
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description="Generate dummy cohorts from the expectations of the study definitions.",
+    allow_abbrev=False,
+)
+parser.add_argument(
+    "output_dir", nargs="?", default="output", help="output unless given"
+)
+parser.add_argument(
+    "waves",
+    nargs="*",
+    help="waves of config.json and era to generate (all unless given)",
+)
+parser.add_argument(
+    "--output-format",
+    choices=OUTPUT_FORMATS,
+    default="feather",
+    help="feather unless given",
+)
+parser.add_argument(
+    "--population-size",
+    type=int,
+    default=10000,
+    help="patients in each cohort (10000, as in project.yaml, unless given)",
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=1_000_000,
+    help="patients generated and written at a time",
+)
+parser.add_argument(
+    "--seed", type=int, default=0, help="seed from which each wave's seed is derived"
+)
+options = parser.parse_args()
+output_format = options.output_format
+population_size = options.population_size
+chunk_size = options.chunk_size
+seed = options.seed
+output_dir = options.output_dir
+waves = options.waves or wave_keys(config) + ["era"]
+
+# GENERATE ----
+studies = load_wave_studies([wave for wave in waves if wave != "era"])
+if "era" in waves:
+    studies["era"] = load_era_study()
+for wave, study in studies.items():
+    path = write_dummy_cohort(
+        study,
+        output_path(output_dir, f"input_{wave}", output_format),
+        population_size,
+        study_seed(seed, wave),
+        chunk_size,
+    )
+    print(f"{wave}: {path}")
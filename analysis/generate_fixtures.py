@@ -0,0 +1,59 @@
+######################################
+
+# This script generates synthetic event-level source tables (patients,
+# clinical events, medications, APCS, ECDS, SGSS, vaccinations, ONS deaths,
+# registrations and addresses) for the local extraction layer, so that
+# extract_multiwave.py can be run and benchmarked at production-like volume
+# without the TPP database.
+# Codes are drawn from the codelists the study definitions use, and dates
+# are spread over the waves in config.json (see
+# analysis/extraction/fixtures.py). Tables are written as partitioned Parquet
+# (output_dir/<table>.parquet/part-<chunk>.parquet), one chunk of patients
+# per process at a time; the output is reproducible for a given seed and
+# chunk size.
+# Usage:
+#   python analysis/generate_fixtures.py [--patients=<n>] [--events-per-patient=<n>] [--chunk-size=<n>] [--processes=<n>] [--seed=<n>] [output_dir]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import json
+import os
+import sys
+
+from extraction.fixtures import FixtureSpec, write_fixtures
+from extraction.multiwave import load_era_study, load_wave_studies, wave_keys
+
+# Import config variables (start_date and end_date of waves)
+with open("analysis/config.json", "r") as f:
+    config = json.load(f)
+
+# Parse arguments
+options = dict(
+    arg[2:].split("=", 1)
+    for arg in sys.argv[1:]
+    if arg.startswith(
+        (
+            "--patients=",
+            "--events-per-patient=",
+            "--chunk-size=",
+            "--processes=",
+            "--seed=",
+        )
+    )
+)
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+patients = int(options.get("patients", 100_000))
+events_per_patient = float(options.get("events-per-patient", 50))
+chunk_size = int(options.get("chunk-size", 100_000))
+processes = int(options.get("processes", os.cpu_count() or 1))
+seed = int(options.get("seed", 0))
+output_dir = args[0] if args else "output/fixtures"
+
+# GENERATE ----
+studies = load_wave_studies(wave_keys(config))
+studies["era"] = load_era_study()
+spec = FixtureSpec(studies.values(), config, events_per_patient)
+rows = write_fixtures(spec, output_dir, patients, seed, chunk_size, processes)
+for table, count in rows.items():
+    print(f"{table}: {count} rows")
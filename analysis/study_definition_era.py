@@ -0,0 +1,18 @@
+######################################
+
+# This script provides the formal specification of the study data that will
+# be extracted from the OpenSAFELY database.
+# This data extract holds the era exposures (infections in each variant era)
+# for immunocompromised persons. The eras have fixed dates, so they are
+# extracted once and joined onto the data extract of each wave
+# See dict_era_exposure_vars.py for the variables
+
+######################################
+
+# IMPORT STATEMENTS ----
+# Import the study definition builder (see study_factory.py for the population)
+from study_factory import build_era_study
+
+# DEFINE STUDY POPULATION ----
+# Build the era study for all waves in config.json
+study = build_era_study()
@@ -0,0 +1,345 @@
+######################################
+
+# This script builds the study definition for one of the UK pandemic waves
+# from config.json, so the wave modules (study_definition_wave[x].py) only
+# name their wave.
+# The variable sets that do not depend on the wave (demographics,
+# immunosuppression, comorbidities) are built once when this module is
+# imported; the outcome and vaccination sets depend only on the end date of
+# the wave and are memoised per end date. Building several waves in one
+# process (see analysis/extract_multiwave.py) therefore defines each
+# variable and reads each codelist once.
+# The era exposures have fixed dates, so they are not part of the wave
+# studies: they are extracted once for all waves by the era study
+# (study_definition_era.py, see build_era_study) and joined onto each wave
+# in data_process.R.
+# Variables that the analysis does not read, and that no variable it reads
+# refers to, are pruned from the studies (see output_variables).
+
+######################################
+
+# IMPORT STATEMENTS ----
+# Import code building blocks from cohort extractor package
+from cohortextractor import (
+    StudyDefinition,
+    patients,
+)
+
+# Import standard variable sets
+from dict_demographic_vars import demographic_variables
+
+from dict_immunosuppression_vars import immunosuppression_variables
+
+from dict_comorbidity_vars import comorbidity_variables
+
+from dict_era_exposure_vars import era_exposure_variables
+
+from extraction.dependencies import flatten_variables, prune_variables
+
+import codelists
+
+import functools
+import json
+
+
+# Import config variables (start_date and end_date of waves)
+def load_config():
+    with open('analysis/config.json', 'r') as f:
+        return json.load(f)
+
+
+# Variables the analysis reads: the variable lists in config.json and the
+# columns that utils/extract_data.R reads from the extracted files (listed
+# with their types in config.json under extracted_columns)
+def output_variables(config):
+    listed = [
+        name for key, names in config.items() if key.endswith("_vars") for name in names
+    ]
+    return set(listed) | set(config["extracted_columns"])
+
+
+# Define the study population
+# IN AND EXCLUSION CRITERIA
+# (= > 1 year follow up, aged > 18 and no missings in age and sex)
+# missings in age are the ones > 110
+# missings in sex can be sex = U or sex = I (so filter on M and F)
+population = patients.satisfying(
+    """
+    NOT died
+    AND
+    (age >=18 AND age <= 110)
+    AND
+    (sex = "M" OR sex = "F")
+    AND
+    (bone_marrow_transplant OR kidney_transplant OR other_organ_transplant OR haem_cancer OR immunosuppression_diagnosis OR immunosuppression_medication OR radio_chemo)
+    AND
+    index_of_multiple_deprivation != -1
+    """,
+
+    died=patients.died_from_any_cause(
+        on_or_before="index_date",
+        returning="binary_flag",
+        return_expectations={"incidence": 0.01},
+    ),
+)
+
+
+# OUTCOMES (not in dict because end_date is used)
+@functools.lru_cache(maxsize=None)
+def outcome_variables(end_date):
+    return dict(
+        # Covid-related admission
+        covid_hospitalisation_date = patients.admitted_to_hospital(
+            returning="date_admitted",
+            with_these_diagnoses=codelists.covid_icd10,
+            with_admission_method=["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"],
+            between=["index_date",end_date],
+            date_format="YYYY-MM-DD",
+            find_first_match_in_period=True,
+            return_expectations = {
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.2,
+            },
+        ),
+
+        # Covid-related A&E
+        covid_emergency_date = patients.attended_emergency_care(
+            returning="date_arrived",
+            with_these_diagnoses = codelists.covid_emergency,
+            between=["index_date",end_date],
+            date_format="YYYY-MM-DD",
+            find_first_match_in_period=True,
+            return_expectations = {
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.2,
+            },
+        ),
+
+        # Covid-related death
+        covid_death_date=patients.with_these_codes_on_death_certificate(
+            codelists.covid_icd10,  # imported from codelists.py
+            returning="date_of_death",
+            between=["index_date", end_date],
+            match_only_underlying_cause=False,  # boolean for indicating if filters
+            # results to only specified cause of death
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.05,
+            },
+        ),
+
+        # Death from any cause (to be used for censoring)
+        died_any_date=patients.died_from_any_cause(
+            between=["index_date", end_date],
+            returning="date_of_death",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.01,
+            },
+        ),
+
+        # De-registration (to be used for censoring)
+        dereg_date=patients.date_deregistered_from_all_supported_practices(
+            between=["index_date",end_date],
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "index_date", "latest": end_date},
+                "incidence": 0.01,
+            },
+        ),
+    )
+
+
+# VACCINATION HISTORY (not in dict because end_date is used)
+# Dates of first to max_doses-th COVID vaccination - modified from
+# nhs-covid-vaccination-coverage
+# Dose 1 is any dose recorded after 01/12/2020, later doses are searched
+# from minimum_gap_days after the previous dose
+# 01 Sep 2021: 3rd dose (primary) at interval of >=8w recommended for
+# immunosuppressed
+# 14 Sep 2021: 3rd dose (booster) reommended for JCVI groups 1-9 at >=6m
+# 15 Nov 2021: 3rd dose (booster) recommended for 40–49y at >=6m
+# 29 Nov 2021: 3rd dose (booster) recommended for 18–39y at >=3m
+# The doses form one chain (covid_vax_date_1 ... covid_vax_date_<max_doses>),
+# which the local extraction layer evaluates in a single pass over each
+# patient's sorted vaccination records (see extraction/vaccinations.py)
+vaccination_incidence = {1: 0.8, 2: 0.6}
+
+@functools.lru_cache(maxsize=None)
+def covid_vaccination_sequence(end_date, max_doses, minimum_gap_days=14):
+    variables = {}
+    for dose in range(1, max_doses + 1):
+        if dose == 1:
+            start = "2020-12-01"
+        else:
+            start = f"covid_vax_date_{dose - 1} + {minimum_gap_days} days"
+        variables[f"covid_vax_date_{dose}"] = patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS",
+            between=[start, end_date],
+            find_first_match_in_period=True,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "2020-12-01", "latest": end_date},
+                "incidence": vaccination_incidence.get(dose, 0.5),
+            },
+        )
+    return variables
+
+
+# Number of doses: the covid_vax_date_N variables listed in config.json
+def vaccination_doses(config):
+    return sum(
+        name.startswith("covid_vax_date_") for name in config["vaccination_vars"]
+    )
+
+
+# DEFINE STUDY POPULATION ----
+# Define study population and variables for a wave in config.json
+@functools.lru_cache(maxsize=None)
+def build_study(wave_key):
+    config = load_config()
+    wave = config[wave_key]
+    return build_dated_study(wave["start_date"], wave["end_date"])
+
+
+# Define study population and variables for any index date and end of
+# follow-up (a wave, or a snapshot of a calendar series, see
+# extraction/multiwave.py)
+@functools.lru_cache(maxsize=None)
+def build_dated_study(start_date, end_date):
+    config = load_config()
+
+    return StudyDefinition(
+
+        # Configure the expectations framework
+        default_expectations={
+            "date": {"earliest": "1900-01-01", "latest": end_date},
+            "rate": "uniform",
+            "incidence": 0.95,
+        },
+
+        # Set index date to start date
+        index_date=start_date,
+        **prune_variables(
+            dict(
+                population=population,
+
+                # DEMOGRAPHICS
+                **demographic_variables,
+
+                # IMMUNOSUPPRESSION
+                **immunosuppression_variables,
+
+                # COMORBIDITIES
+                **comorbidity_variables,
+
+                # OUTCOMES
+                **outcome_variables(end_date),
+
+                # VACCINATION HISTORY
+                **covid_vaccination_sequence(end_date, vaccination_doses(config)),
+            ),
+            output_variables(config),
+        ),
+    )
+
+
+# DEFINE ERA STUDY POPULATION ----
+# Era exposures for every patient that can be in the population of any wave
+# in config.json: the immunosuppression criteria of the wave populations
+# all look back from the wave start date, so any patient with one of the
+# immunosuppression records on or before the latest wave start date
+@functools.lru_cache(maxsize=None)
+def build_era_study():
+    config = load_config()
+    waves = [config[key] for key in config if key.startswith("wave")]
+    index_date = max(wave["start_date"] for wave in waves)
+    end_date = max(wave["end_date"] for wave in waves)
+
+    return StudyDefinition(
+
+        # Configure the expectations framework
+        default_expectations={
+            "date": {"earliest": "1900-01-01", "latest": end_date},
+            "rate": "uniform",
+            "incidence": 0.95,
+        },
+
+        # Set index date to the latest wave start date
+        index_date=index_date,
+        population=patients.satisfying(
+            """
+            bone_marrow_transplant_ever OR kidney_transplant_ever OR other_organ_transplant_ever OR haem_cancer_ever OR immunosuppression_diagnosis_ever OR immunosuppression_medication_ever OR radio_chemo_ever
+            """,
+            bone_marrow_transplant_ever=patients.with_these_clinical_events(
+                codelists.bone_marrow_transplant_codes,
+                on_or_before="index_date",
+            ),
+            kidney_transplant_ever=patients.with_these_clinical_events(
+                codelists.kidney_transplant_codes,
+                on_or_before="index_date",
+            ),
+            other_organ_transplant_ever=patients.with_these_clinical_events(
+                codelists.other_organ_transplant_codes,
+                on_or_before="index_date",
+            ),
+            haem_cancer_ever=patients.with_these_clinical_events(
+                codelists.haem_cancer_codes,
+                on_or_before="index_date",
+            ),
+            immunosuppression_diagnosis_ever=patients.with_these_clinical_events(
+                codelists.immunosupression_diagnosis_codes,
+                on_or_before="index_date",
+            ),
+            immunosuppression_medication_ever=patients.with_these_medications(
+                codelists.immunosuppression_medication_codes,
+                on_or_before="index_date",
+            ),
+            radio_chemo_ever=patients.with_these_clinical_events(
+                codelists.radio_chemo_codes,
+                on_or_before="index_date",
+            ),
+        ),
+
+        # ERA EXPOSURES
+        **era_exposure_variables,
+    )
+
+
+# VARIABLE GROUPS ----
+# Group of each variable of the wave studies and the era study (extra
+# columns included), for reporting extraction timings by group (see
+# benchmarks/run_benchmarks.py)
+def variable_groups():
+    config = load_config()
+    end_date = config[next(key for key in config if key.startswith("wave"))]["end_date"]
+    groups = {
+        "population": dict(population=population),
+        "demographics": demographic_variables,
+        "immunosuppression": immunosuppression_variables,
+        "comorbidities": comorbidity_variables,
+        "outcomes": outcome_variables(end_date),
+        "vaccinations": covid_vaccination_sequence(end_date, vaccination_doses(config)),
+        "era exposures": era_exposure_variables,
+    }
+    variable_group = {}
+    for group, variables in groups.items():
+        for name in flatten_variables(variables)[0]:
+            # include_date_of_match and include_measurement_date columns
+            for column in (name, f"{name}_date", f"{name}_date_measured"):
+                variable_group.setdefault(column, group)
+    # The era population's criteria are only extracted with the era exposures
+    for name in build_era_study().covariate_definitions:
+        variable_group.setdefault(name, "era exposures")
+    return variable_group
+
+
+# CODELISTS ----
+# Codelists in codelists.py used by a study definition (the wave studies share
+# the dict modules, which load every codelist of their variables on import;
+# a study prunes some of those variables)
+def study_codelists(study):
+    return codelists.registry.used_by(study.covariate_definitions)
@@ -0,0 +1,158 @@
+######################################
+
+# This script benchmarks the extraction of each wave's study definition (and
+# the era exposures) against synthetic source tables at 100k, 1M and 10M
+# patients (or the scales given by --scales; --quick runs 10k only).
+# Fixture tables are generated once per scale (see
+# analysis/extraction/fixtures.py) into --fixtures-dir and reused by later
+# runs. Each study is extracted in a fresh process, recording the wall time,
+# peak RSS, and the time, source rows read and peak RSS of each variable and
+# each variable group (demographics, immunosuppression, comorbidities, era
+# exposures, outcomes, vaccinations).
+# Results are written to benchmarks/latest.json and compared with the
+# baseline (benchmarks/baseline.json unless --baseline is given): any
+# variable group more than --threshold (a fraction) slower than its
+# baseline is reported, and the script exits with status 1.
+# With --save-baseline the results become the new baseline; no baseline is
+# committed, so the first run on a machine must pass --save-baseline (a run
+# without a baseline exits with status 1).
+# Run from the repository root (see --help for the options):
+#   python benchmarks/run_benchmarks.py [options]
+
+######################################
+
+# IMPORT STATEMENTS ----
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, "analysis")
+
+from extraction.benchmarks import (  # noqa: E402
+    compare,
+    read_json,
+    run_case_in_process,
+    write_json,
+)
+from extraction.fixtures import FixtureSpec, write_fixtures  # noqa: E402
+from extraction.multiwave import (  # noqa: E402
+    load_era_study,
+    load_wave_studies,
+    wave_keys,
+)
+
+# Import config variables (start_date and end_date of waves)
+with open("analysis/config.json", "r") as f:
+    config = json.load(f)
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description="Benchmark the extraction of each study against synthetic tables.",
+    allow_abbrev=False,
+)
+scale_options = parser.add_mutually_exclusive_group()
+scale_options.add_argument(
+    "--scales",
+    default="100000,1000000,10000000",
+    help="comma-separated numbers of patients (100k, 1M and 10M unless given)",
+)
+scale_options.add_argument(
+    "--quick",
+    action="store_true",
+    help="benchmark at 10k patients only, instead of --scales",
+)
+parser.add_argument(
+    "--events-per-patient",
+    type=float,
+    default=20,
+    help="mean events per patient in each event table",
+)
+parser.add_argument(
+    "--studies",
+    default=",".join(wave_keys(config) + ["era"]),
+    help="comma-separated waves of config.json and era (all unless given)",
+)
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.2,
+    help="fraction by which a variable group may be slower than its baseline",
+)
+parser.add_argument("--baseline", default="benchmarks/baseline.json")
+parser.add_argument("--fixtures-dir", default="benchmarks/fixtures")
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="processes generating the fixture tables",
+)
+parser.add_argument(
+    "--save-baseline", action="store_true", help="save the results as the baseline"
+)
+options = parser.parse_args()
+scales = [10000] if options.quick else [
+    int(scale) for scale in options.scales.split(",")
+]
+events_per_patient = options.events_per_patient
+studies = options.studies.split(",")
+threshold = options.threshold
+baseline_path = options.baseline
+fixtures_dir = options.fixtures_dir
+processes = options.processes
+save_baseline = options.save_baseline
+
+# GENERATE FIXTURES ----
+spec = None
+fixture_dirs = {}
+for scale in scales:
+    fixture_dirs[scale] = os.path.join(
+        fixtures_dir, f"patients_{scale}_events_{events_per_patient:g}"
+    )
+    if not os.path.exists(os.path.join(fixture_dirs[scale], "complete")):
+        if spec is None:
+            all_studies = load_wave_studies(wave_keys(config))
+            all_studies["era"] = load_era_study()
+            spec = FixtureSpec(all_studies.values(), config, events_per_patient)
+        write_fixtures(spec, fixture_dirs[scale], scale, seed=0, processes=processes)
+        open(os.path.join(fixture_dirs[scale], "complete"), "w").close()
+
+# BENCHMARK ----
+results = {}
+for scale in scales:
+    for key in studies:
+        result = run_case_in_process(fixture_dirs[scale], key)
+        results.setdefault(str(scale), {})[key] = result
+        print(
+            f"{scale} {key}: {result['wall_seconds']:.2f}s "
+            f"(scan {result['scan_seconds']:.2f}s), "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB, "
+            f"population {result['population']}"
+        )
+        for group, totals in sorted(result["groups"].items()):
+            print(
+                f"    {group}: {totals['seconds']:.2f}s, "
+                f"{totals['rows_scanned']} rows scanned, "
+                f"peak RSS {totals['peak_rss_mb']:.0f} MB, "
+                f"{totals['variables']} variables"
+            )
+write_json(results, "benchmarks/latest.json")
+
+# COMPARE ----
+if save_baseline:
+    baseline = read_json(baseline_path)
+    for scale, scale_results in results.items():
+        baseline.setdefault(scale, {}).update(scale_results)
+    write_json(baseline, baseline_path)
+    print(f"Saved baseline: {baseline_path}")
+    sys.exit(0)
+if not os.path.exists(baseline_path):
+    print(f"No baseline at {baseline_path}: run with --save-baseline first")
+    sys.exit(1)
+regressions = compare(results, read_json(baseline_path), threshold)
+for regression in regressions:
+    print(
+        f"REGRESSION {regression['scale']} {regression['study']} {regression['group']}: "
+        f"{regression['baseline_seconds']:.2f}s -> {regression['seconds']:.2f}s"
+    )
+sys.exit(1 if regressions else 0)